@@ -0,0 +1,188 @@
+import asyncio
+import os
+
+import asyncpg
+from dotenv import load_dotenv
+
+from utils import escape_like, init_logging
+
+load_dotenv()
+logger = init_logging(__name__)
+
+PFIZER_TRIALS_QUERY = """select distinct
+                            s.nct_id
+                        FROM
+                            studies s
+                        LEFT JOIN conditions c ON s.nct_id = c.nct_id
+                        LEFT JOIN outcome_analyses oa ON s.nct_id = oa.nct_id
+                        WHERE
+                            s.study_type IN ('Interventional')
+                            AND s.phase IN ('Phase 3')
+                            AND s.overall_status = 'Completed'
+                            AND oa.p_value IS NOT NULL
+                            AND s.source = 'Pfizer'"""
+
+MOST_RECENT_TRIAL_QUERY = """select distinct
+                                s.nct_id,
+                                s.brief_title
+                            FROM
+                                studies s
+                            LEFT JOIN conditions c ON s.nct_id = c.nct_id
+                            LEFT JOIN outcome_analyses oa ON s.nct_id = oa.nct_id
+                            WHERE
+                                s.study_type IN ('Interventional')
+                                AND s.phase IN ('Phase 3')
+                                AND s.overall_status = 'Completed'
+                                AND oa.p_value IS NOT NULL
+                                AND s.source = 'Pfizer'
+                                AND (
+                                    c.downcase_name like '%' || $1 || '%' ESCAPE '\\'
+                                    OR lower(s.brief_title) like '%' || $1 || '%' ESCAPE '\\'
+                                    )
+                                ORDER BY s.nct_id DESC"""
+
+PFIZER_TRIAL_CONDITIONS_QUERY = """select
+                                    s.nct_id,
+                                    s.brief_title,
+                                    coalesce(
+                                        array_agg(distinct c.downcase_name) filter (where c.downcase_name is not null),
+                                        '{}'
+                                    ) as conditions
+                                FROM
+                                    studies s
+                                LEFT JOIN conditions c ON s.nct_id = c.nct_id
+                                WHERE
+                                    s.study_type IN ('Interventional')
+                                    AND s.phase IN ('Phase 3')
+                                    AND s.overall_status = 'Completed'
+                                    AND s.source = 'Pfizer'
+                                    AND EXISTS (
+                                        select 1 from outcome_analyses oa
+                                        where oa.nct_id = s.nct_id AND oa.p_value IS NOT NULL
+                                        )
+                                GROUP BY s.nct_id, s.brief_title"""
+
+# errors after which a pooled connection is discarded and the query retried once on a fresh one
+CONNECTION_ERRORS = (
+    asyncpg.exceptions.ConnectionDoesNotExistError,
+    asyncpg.exceptions.InterfaceError,
+    ConnectionError,
+    OSError,
+)
+
+
+class AACTDatabase:
+    """
+    Long-lived connection pool to the AACT database, created once in the FastAPI lifespan.
+    """
+
+    def __init__(self, host, port, database, min_size=1, max_size=10, statement_timeout_ms=30_000,
+                 connect_timeout=10.0, max_inactive_connection_lifetime=300.0):
+        self.host = host
+        self.port = port
+        self.database = database
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_timeout_ms = statement_timeout_ms
+        self.connect_timeout = connect_timeout
+        self.max_inactive_connection_lifetime = max_inactive_connection_lifetime
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def _get_pool(self):
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    db_username = os.getenv("AACT_USERNAME")
+                    db_password = os.getenv("AACT_PASSWORD")
+
+                    if not db_username or not db_password:
+                        raise ValueError("AACT_USERNAME and AACT_PASSWORD must be set in .env")
+
+                    self._pool = await asyncpg.create_pool(
+                        host=self.host,
+                        port=self.port,
+                        database=self.database,
+                        user=db_username,
+                        password=db_password,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        timeout=self.connect_timeout,
+                        command_timeout=self.statement_timeout_ms / 1000,
+                        max_inactive_connection_lifetime=self.max_inactive_connection_lifetime,
+                        server_settings={"statement_timeout": str(self.statement_timeout_ms)},
+                    )
+        return self._pool
+
+    async def connect(self):
+        """
+        Opens the pool eagerly. A failure is logged only, the pool is opened again on first use.
+        """
+        try:
+            await self._get_pool()
+            logger.info("AACT connection pool opened")
+        except Exception as e:
+            logger.warning(f"Could not open AACT connection pool: {str(e)}")
+
+    async def fetch(self, query, *args):
+        pool = await self._get_pool()
+        try:
+            async with pool.acquire() as conn:
+                return await conn.fetch(query, *args)
+        except CONNECTION_ERRORS as e:
+            # the pool replaces a closed connection when it is released
+            logger.warning(f"AACT connection lost ({str(e)}), retrying on a new connection...")
+            async with pool.acquire() as conn:
+                return await conn.fetch(query, *args)
+
+    async def ping(self):
+        """
+        Return: True if a pooled connection can run a trivial query.
+        """
+        try:
+            await self.fetch("select 1")
+            return True
+        except Exception as e:
+            logger.warning(f"AACT health check failed: {str(e)}")
+            return False
+
+    async def pull_pfizer_trials(self):
+        """
+        Return: NCT IDs of completed, interventional Phase 3 Pfizer trials with reported p-values.
+        """
+        records = await self.fetch(PFIZER_TRIALS_QUERY)
+        return [rec["nct_id"] for rec in records]
+
+    async def pull_pfizer_trial_conditions(self):
+        """
+        Return: the Pfizer candidate trials with their brief titles and lower-case condition names.
+        """
+        records = await self.fetch(PFIZER_TRIAL_CONDITIONS_QUERY)
+        return [
+            {"nct_id": rec["nct_id"], "brief_title": rec["brief_title"] or "", "conditions": list(rec["conditions"])}
+            for rec in records
+        ]
+
+    async def get_most_recent_trial(self, condition):
+        # matched as a substring, wildcards in the condition are taken literally
+        records = await self.fetch(MOST_RECENT_TRIAL_QUERY, escape_like(condition.lower()))
+        return [{"nct_id": rec["nct_id"], "brief_title": rec["brief_title"]} for rec in records]
+
+    async def fetch_trial_rows(self, nct_ids, queries, prefetch=1000):
+        """
+        Runs each query (table name -> SQL taking the NCT ID array as $1) through a server-side cursor.
+        Return: a dict of NCT ID -> table name -> list of row dicts, for the NCT IDs found in the studies table.
+        """
+        pool = await self._get_pool()
+        rows = {}
+        async with pool.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                for table, query in queries.items():
+                    async for rec in conn.cursor(query, list(nct_ids), prefetch=prefetch):
+                        rows.setdefault(rec["nct_id"], {}).setdefault(table, []).append(dict(rec))
+        return {nct_id: tables for nct_id, tables in rows.items() if "studies" in tables}
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
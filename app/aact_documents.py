@@ -0,0 +1,328 @@
+import asyncio
+import re
+from decimal import Decimal
+
+from pipeline import batched
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+# One set-based query per AACT table, each read through a server-side cursor.
+# Rows are ordered so that "first" matches the order in which ClinicalTrials.gov lists them.
+STUDY_QUERIES = {
+    "studies": """select nct_id, brief_title, official_title, overall_status, start_month_year,
+                         primary_completion_month_year, completion_month_year, verification_month_year,
+                         study_first_submitted_date, results_first_submitted_date, last_update_submitted_date,
+                         last_update_posted_date, study_type, phase, enrollment, enrollment_type, source,
+                         source_class, limitations_and_caveats
+                  from studies where nct_id = any($1::varchar[])""",
+    "id_information": """select nct_id, id_source, id_value from id_information
+                         where nct_id = any($1::varchar[]) order by nct_id, id""",
+    "sponsors": """select nct_id, name, agency_class from sponsors
+                   where nct_id = any($1::varchar[]) and lead_or_collaborator = 'lead'""",
+    "brief_summaries": """select nct_id, description from brief_summaries where nct_id = any($1::varchar[])""",
+    "detailed_descriptions": """select nct_id, description from detailed_descriptions
+                                where nct_id = any($1::varchar[])""",
+    "conditions": """select nct_id, name from conditions where nct_id = any($1::varchar[]) order by nct_id, id""",
+    "keywords": """select nct_id, name from keywords where nct_id = any($1::varchar[]) order by nct_id, id""",
+    "designs": """select nct_id, allocation, intervention_model, primary_purpose, masking, subject_masked,
+                         caregiver_masked, investigator_masked, outcomes_assessor_masked
+                  from designs where nct_id = any($1::varchar[])""",
+    "design_groups": """select dg.nct_id, dg.title, dg.group_type, dg.description,
+                               array_remove(array_agg(i.intervention_type || ': ' || i.name order by i.id), null)
+                                   as intervention_names
+                        from design_groups dg
+                        left join design_group_interventions dgi on dgi.design_group_id = dg.id
+                        left join interventions i on i.id = dgi.intervention_id
+                        where dg.nct_id = any($1::varchar[])
+                        group by dg.nct_id, dg.id, dg.title, dg.group_type, dg.description
+                        order by dg.nct_id, dg.id""",
+    "interventions": """select i.nct_id, i.intervention_type, i.name, i.description,
+                               array_remove(array_agg(dg.title order by dg.id), null) as arm_group_labels
+                        from interventions i
+                        left join design_group_interventions dgi on dgi.intervention_id = i.id
+                        left join design_groups dg on dg.id = dgi.design_group_id
+                        where i.nct_id = any($1::varchar[])
+                        group by i.nct_id, i.id, i.intervention_type, i.name, i.description
+                        order by i.nct_id, i.id""",
+    "design_outcomes": """select nct_id, measure, description, time_frame from design_outcomes
+                          where nct_id = any($1::varchar[]) and outcome_type = 'primary' order by nct_id, id""",
+    "eligibilities": """select nct_id, criteria, healthy_volunteers, gender, minimum_age, adult, child, older_adult
+                        from eligibilities where nct_id = any($1::varchar[])""",
+    "participant_flows": """select nct_id, recruitment_details, pre_assignment_details from participant_flows
+                            where nct_id = any($1::varchar[])""",
+    "result_groups": """select nct_id, ctgov_group_code, title, description from result_groups
+                        where nct_id = any($1::varchar[]) and result_type = 'Participant Flow'
+                        order by nct_id, ctgov_group_code""",
+    "outcome_analyses": """select oa.nct_id, oa.outcome_id, oa.groups_description, oa.non_inferiority_type,
+                                  oa.non_inferiority_description, oa.p_value_modifier, oa.p_value,
+                                  oa.p_value_description, oa.method, oa.method_description, oa.param_type,
+                                  oa.param_value, oa.ci_percent, oa.ci_n_sides, oa.ci_lower_limit, oa.ci_upper_limit,
+                                  oa.ci_upper_limit_na_comment, oa.dispersion_type, oa.dispersion_value,
+                                  oa.estimate_description, oa.other_analysis_description,
+                                  array_remove(array_agg(g.ctgov_group_code order by g.ctgov_group_code), null)
+                                      as group_ids
+                           from outcome_analyses oa
+                           left join outcome_analysis_groups oag on oag.outcome_analysis_id = oa.id
+                           left join result_groups g on g.id = oag.result_group_id
+                           where oa.nct_id = any($1::varchar[])
+                           group by oa.nct_id, oa.id
+                           order by oa.nct_id, oa.outcome_id, oa.id""",
+}
+
+_CI_NUM_SIDES = {"1-Sided": "ONE_SIDED", "2-Sided": "TWO_SIDED"}
+_DISPERSION_TYPES = {
+    "Standard Deviation": "STANDARD_DEVIATION",
+    "Standard Error of the Mean": "STANDARD_ERROR_OF_MEAN",
+}
+
+_INTERVENTION_MODELS = {
+    "Parallel Assignment": "PARALLEL",
+    "Crossover Assignment": "CROSSOVER",
+    "Single Group Assignment": "SINGLE_GROUP",
+    "Factorial Assignment": "FACTORIAL",
+    "Sequential Assignment": "SEQUENTIAL",
+}
+
+
+def _enum(value):
+    """
+    Converts an AACT label (e.g. 'Active, not recruiting', 'None (Open Label)') into the
+    ClinicalTrials.gov v2 enum value ('ACTIVE_NOT_RECRUITING', 'NONE').
+    """
+    if value is None:
+        return None
+    value = re.sub(r"\(.*\)", "", value)
+    return re.sub(r"[^A-Z0-9]+", "_", value.upper()).strip("_")
+
+
+def _phases(phase):
+    if not phase:
+        return None
+    if phase == "N/A":
+        return ["NA"]
+    # 'Phase 2/Phase 3' -> ['PHASE2', 'PHASE3'], 'Early Phase 1' -> ['EARLY_PHASE1']
+    return [_enum(p).replace("PHASE_", "PHASE") for p in phase.split("/")]
+
+
+def _healthy_volunteers(value):
+    # older AACT releases store 'No' / 'Accepts Healthy Volunteers' instead of a boolean
+    if value is None or isinstance(value, bool):
+        return value
+    return value.strip().lower() not in ("", "no", "false")
+
+
+def _date(value):
+    return value.isoformat() if value is not None else None
+
+
+def _number(value):
+    """
+    Formats an AACT numeric like the string ClinicalTrials.gov reports, e.g. 0.00001 rather than 1e-05.
+    """
+    if value is None:
+        return None
+    return str(Decimal(str(value)))
+
+
+def _p_value(analysis):
+    if analysis["p_value"] is None:
+        return None
+    return f"{analysis['p_value_modifier'] or ''}{_number(analysis['p_value'])}"
+
+
+def _analysis(a):
+    """
+    Maps an outcome_analyses row to an analysis of the ClinicalTrials.gov v2 JSON, with its field names and in
+    its field order: the analyses are serialized whole into the trial document ("Group IDs"), and so into
+    its content hash.
+    """
+    return {
+        "groupIds": list(a["group_ids"]),
+        "groupDescription": a["groups_description"],
+        "nonInferiorityType": _enum(a["non_inferiority_type"]),
+        "nonInferiorityComment": a["non_inferiority_description"],
+        "pValue": _p_value(a),
+        "pValueComment": a["p_value_description"],
+        "statisticalMethod": a["method"],
+        "statisticalComment": a["method_description"],
+        "paramType": a["param_type"],
+        "paramValue": _number(a["param_value"]),
+        "ciPctValue": _number(a["ci_percent"]),
+        "ciNumSides": _CI_NUM_SIDES.get(a["ci_n_sides"], _enum(a["ci_n_sides"])),
+        "ciLowerLimit": _number(a["ci_lower_limit"]),
+        "ciUpperLimit": _number(a["ci_upper_limit"]),
+        "ciUpperLimitComment": a["ci_upper_limit_na_comment"],
+        "dispersionType": _DISPERSION_TYPES.get(a["dispersion_type"], _enum(a["dispersion_type"])),
+        "dispersionValue": _number(a["dispersion_value"]),
+        "estimateComment": a["estimate_description"],
+        "otherAnalysisDescription": a["other_analysis_description"],
+    }
+
+
+def _prune(data):
+    """
+    Drops None values and empty containers, like fields ClinicalTrials.gov leaves out of its JSON.
+    """
+    if isinstance(data, dict):
+        pruned = {key: _prune(value) for key, value in data.items()}
+        return {key: value for key, value in pruned.items() if value not in (None, [], {})}
+    if isinstance(data, list):
+        return [_prune(value) for value in data]
+    return data
+
+
+def build_study(nct_id, rows):
+    """
+    Maps the AACT rows of one trial (table name -> list of records) into the subset of the
+    ClinicalTrials.gov v2 study JSON that utils.extract_from_json reads.
+    """
+    study = (rows.get("studies") or [{}])[0]
+    ids = rows.get("id_information", [])
+    sponsor = (rows.get("sponsors") or [{}])[0]
+    design = (rows.get("designs") or [{}])[0]
+    eligibility = (rows.get("eligibilities") or [{}])[0]
+    flow = (rows.get("participant_flows") or [{}])[0]
+    analyses = rows.get("outcome_analyses", [])
+    first_outcome_analyses = [a for a in analyses if a["outcome_id"] == analyses[0]["outcome_id"]] if analyses else []
+
+    who_masked = [
+        role for column, role in (("subject_masked", "PARTICIPANT"), ("caregiver_masked", "CARE_PROVIDER"),
+                                  ("investigator_masked", "INVESTIGATOR"),
+                                  ("outcomes_assessor_masked", "OUTCOMES_ASSESSOR"))
+        if design.get(column)
+    ]
+    std_ages = [
+        age for column, age in (("child", "CHILD"), ("adult", "ADULT"), ("older_adult", "OLDER_ADULT"))
+        if eligibility.get(column)
+    ]
+
+    return _prune({
+        "protocolSection": {
+            "identificationModule": {
+                "nctId": nct_id,
+                "orgStudyIdInfo": {"id": next((i["id_value"] for i in ids if i["id_source"] == "org_study_id"), None)},
+                "secondaryIdInfos": [{"id": i["id_value"]} for i in ids if i["id_source"] == "secondary_id"],
+                "organization": {"fullName": study.get("source"), "class": _enum(study.get("source_class"))},
+                "briefTitle": study.get("brief_title"),
+                "officialTitle": study.get("official_title"),
+            },
+            "statusModule": {
+                "overallStatus": _enum(study.get("overall_status")),
+                "startDateStruct": {"date": study.get("start_month_year")},
+                "primaryCompletionDateStruct": {"date": study.get("primary_completion_month_year")},
+                "completionDateStruct": {"date": study.get("completion_month_year")},
+                "statusVerifiedDate": study.get("verification_month_year"),
+                "studyFirstSubmitDate": _date(study.get("study_first_submitted_date")),
+                "resultsFirstSubmitDate": _date(study.get("results_first_submitted_date")),
+                "lastUpdateSubmitDate": _date(study.get("last_update_submitted_date")),
+                "lastUpdatePostDateStruct": {"date": _date(study.get("last_update_posted_date"))},
+            },
+            "sponsorCollaboratorsModule": {
+                "leadSponsor": {"name": sponsor.get("name"), "class": _enum(sponsor.get("agency_class"))},
+            },
+            "descriptionModule": {
+                "briefSummary": (rows.get("brief_summaries") or [{}])[0].get("description"),
+                "detailedDescription": (rows.get("detailed_descriptions") or [{}])[0].get("description"),
+            },
+            "conditionsModule": {
+                "conditions": [c["name"] for c in rows.get("conditions", [])],
+                "keywords": [k["name"] for k in rows.get("keywords", [])],
+            },
+            "designModule": {
+                "studyType": _enum(study.get("study_type")),
+                "phases": _phases(study.get("phase")),
+                "designInfo": {
+                    "allocation": _enum(design.get("allocation")),
+                    "interventionModel": _INTERVENTION_MODELS.get(design.get("intervention_model"),
+                                                                  _enum(design.get("intervention_model"))),
+                    "primaryPurpose": _enum(design.get("primary_purpose")),
+                    "maskingInfo": {"masking": _enum(design.get("masking")), "whoMasked": who_masked},
+                },
+                "enrollmentInfo": {"count": study.get("enrollment"), "type": _enum(study.get("enrollment_type"))},
+            },
+            "armsInterventionsModule": {
+                "armGroups": [
+                    {"label": g["title"], "type": _enum(g["group_type"]), "description": g["description"],
+                     "interventionNames": list(g["intervention_names"])}
+                    for g in rows.get("design_groups", [])
+                ],
+                "interventions": [
+                    {"type": _enum(i["intervention_type"]), "name": i["name"], "description": i["description"],
+                     "armGroupLabels": list(i["arm_group_labels"])}
+                    for i in rows.get("interventions", [])
+                ],
+            },
+            "outcomesModule": {
+                "primaryOutcomes": [
+                    {"measure": o["measure"], "description": o["description"], "timeFrame": o["time_frame"]}
+                    for o in rows.get("design_outcomes", [])
+                ],
+            },
+            "eligibilityModule": {
+                "eligibilityCriteria": eligibility.get("criteria"),
+                "healthyVolunteers": _healthy_volunteers(eligibility.get("healthy_volunteers")),
+                "sex": _enum(eligibility.get("gender")),
+                "minimumAge": eligibility.get("minimum_age"),
+                "stdAges": std_ages,
+            },
+        },
+        "resultsSection": {
+            "participantFlowModule": {
+                "preAssignmentDetails": flow.get("pre_assignment_details"),
+                "recruitmentDetails": flow.get("recruitment_details"),
+                "groups": [
+                    {"id": g["ctgov_group_code"], "title": g["title"], "description": g["description"]}
+                    for g in rows.get("result_groups", [])
+                ],
+            },
+            "outcomeMeasuresModule": {
+                "outcomeMeasures": [{
+                    "analyses": [_analysis(a) for a in first_outcome_analyses],
+                }] if first_outcome_analyses else [],
+            },
+            "moreInfoModule": {
+                "limitationsAndCaveats": {"description": study.get("limitations_and_caveats")},
+            },
+        },
+        "hasResults": study.get("results_first_submitted_date") is not None,
+    })
+
+
+class AACTTrialSource:
+    """
+    Drop-in replacement for TrialFetcher that builds the study JSON of all requested trials from AACT
+    in a few set-based queries instead of one ClinicalTrials.gov request per trial.
+    get_trials() is called from ingestion worker threads and runs the queries on the event loop owning the pool.
+    """
+
+    def __init__(self, aact_db, loop):
+        self.aact_db = aact_db
+        self.loop = loop
+
+    def iter_trials(self, nct_ids, progress=None, chunk_size=500):
+        """
+        Yields the study JSON for every NCT ID found in AACT, in the same order as nct_ids,
+        querying chunk_size trials at a time.
+        """
+        for chunk in batched(nct_ids, chunk_size):
+            yield from self.get_trials(chunk, progress=progress)
+
+    def get_trials(self, nct_ids, progress=None):
+        """
+        Return: the study JSON for every NCT ID found in AACT, in the same order as nct_ids.
+        progress, if given, is called with 1 for every NCT ID, found or not.
+        """
+        rows_by_trial = asyncio.run_coroutine_threadsafe(
+            self.aact_db.fetch_trial_rows(nct_ids, STUDY_QUERIES), self.loop
+        ).result()
+        trials = []
+        for nct_id in nct_ids:
+            # skipped trials count as fetched too, like the 404s of TrialFetcher
+            if progress is not None:
+                progress(1)
+            if nct_id not in rows_by_trial:
+                logger.warning(f"{nct_id} not found in AACT, skipped")
+                continue
+            trials.append(build_study(nct_id, rows_by_trial[nct_id]))
+        return trials
@@ -0,0 +1,147 @@
+import io
+import json
+import struct
+import time
+
+import numpy as np
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+from sqlalchemy import text
+
+from utils import init_logging
+from vector_store import secondary_indexes
+
+logger = init_logging(__name__)
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_HEADER = COPY_SIGNATURE + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+JSONB_VERSION = b"\x01"
+
+
+class BulkVectorWriter:
+    """
+    Writes embedded nodes into the table of a PGVectorStore with binary COPY, one transaction per batch,
+    instead of one ORM insert per row. Rows are the same as PGVectorStore.add() writes, and Postgres
+    computes the text_search_tsv column of hybrid tables during the COPY.
+
+    With defer_indexes=True (for loads into an empty table), the full-text and HNSW indexes are dropped
+    before the first batch is written and rebuilt once by finish(), instead of being updated row by row.
+    The table is live, so until finish() returns, searches on it fall back to sequential scans: call
+    finish() in a finally, so that the indexes are also rebuilt when the load fails or is cancelled.
+    If the process dies before, the vector store recreates them when it is next initialized.
+    """
+
+    def __init__(self, engine, vector_store, defer_indexes=False):
+        self.engine = engine
+        self.vector_store = vector_store
+        self.defer_indexes = defer_indexes
+        self.table = f"{vector_store.schema_name}.data_{vector_store.table_name}"
+        self.rows_written = 0
+        self.write_seconds = 0.0
+        self._dropped_indexes = {}
+
+    def begin(self):
+        """
+        Creates the table if needed.
+        """
+        self.vector_store._initialize()
+
+    def _drop_deferred_indexes(self):
+        indexes = secondary_indexes(self.vector_store)
+        with self.engine.begin() as conn:
+            for name in indexes:
+                conn.execute(text(f"drop index if exists {self.vector_store.schema_name}.{name}"))
+        self._dropped_indexes = indexes
+        logger.info(f"Deferred indexes {', '.join(indexes)} until the end of the load")
+
+    def _encode_field(self, buf, data):
+        buf.write(struct.pack(">i", len(data)))
+        buf.write(data)
+
+    def _encode_rows(self, nodes):
+        buf = io.BytesIO()
+        buf.write(COPY_HEADER)
+        embed_dim = self.vector_store.embed_dim
+        vector_header = struct.pack(">hh", embed_dim, 0)
+        for node in nodes:
+            embedding = np.asarray(node.get_embedding(), dtype=">f4")
+            if embedding.shape != (embed_dim,):
+                raise ValueError(f"Node {node.node_id} has {embedding.size} dimensions, expected {embed_dim}")
+            metadata = json.dumps(node_to_metadata_dict(
+                node,
+                remove_text=True,
+                flat_metadata=self.vector_store.flat_metadata,
+            )).encode("utf-8")
+            if self.vector_store.use_jsonb:
+                metadata = JSONB_VERSION + metadata
+            buf.write(struct.pack(">h", 4))
+            self._encode_field(buf, node.get_content(metadata_mode=MetadataMode.NONE).encode("utf-8"))
+            self._encode_field(buf, metadata)
+            self._encode_field(buf, node.node_id.encode("utf-8"))
+            self._encode_field(buf, vector_header + embedding.tobytes())
+        buf.write(COPY_TRAILER)
+        buf.seek(0)
+        return buf
+
+    def write(self, nodes):
+        """
+        Copies a batch of embedded nodes into the table and commits it.
+        Return: the number of rows written.
+        """
+        if not nodes:
+            return 0
+        if self.defer_indexes and not self.rows_written:
+            self._drop_deferred_indexes()
+        start = time.perf_counter()
+        buf = self._encode_rows(nodes)
+        raw_conn = self.engine.raw_connection()
+        try:
+            with raw_conn.cursor() as cursor:
+                cursor.copy_expert(
+                    f"copy {self.table} (text, metadata_, node_id, embedding) from stdin with (format binary)", buf
+                )
+            raw_conn.commit()
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+        self.write_seconds += time.perf_counter() - start
+        self.rows_written += len(nodes)
+        return len(nodes)
+
+    def _rebuild_indexes(self):
+        """
+        Rebuilds the deferred indexes, each in its own transaction so that one failing does not roll back
+        the others. The failed ones are kept for another finish() call and the first error is raised.
+        """
+        error = None
+        for name, sql in list(self._dropped_indexes.items()):
+            start = time.perf_counter()
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(text(sql))
+            except Exception as e:
+                logger.error(f"Failed to rebuild index {name}, searches on {self.table} stay degraded: {e}")
+                error = error or e
+                continue
+            del self._dropped_indexes[name]
+            logger.info(f"Rebuilt index {name} in {time.perf_counter() - start:.1f}s")
+        if error is not None:
+            raise error
+
+    def finish(self):
+        """
+        Rebuilds the deferred indexes and logs the write throughput.
+        Return: the write throughput in rows per second.
+        """
+        self._rebuild_indexes()
+        if self.rows_written:
+            # refreshes the row estimate read by the stats endpoint and the planner statistics
+            with self.engine.begin() as conn:
+                conn.execute(text(f"analyze {self.table}"))
+        rows_per_second = self.rows_written / self.write_seconds if self.write_seconds else 0.0
+        logger.info(f"Wrote {self.rows_written} rows to {self.table} in {self.write_seconds:.1f}s "
+                    f"({rows_per_second:.0f} rows/s)")
+        return rows_per_second
@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory.types import BaseMemory
+from llama_index.core.utils import get_tokenizer
+
+from config import config
+from tracing import llm_stage
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+SUMMARY_PROMPT = (
+    "Update the summary of a conversation between a user and a chatbot answering questions about "
+    "clinical trials with the new messages below. Keep the trials (NCT IDs), conditions, interventions and "
+    "user details that later questions may refer to, drop the rest. Answer with the updated summary only, "
+    "in at most {max_words} words.\n\n"
+    "Summary so far:\n{summary}\n\n"
+    "New messages:\n{messages}\n\n"
+    "Updated summary:"
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# summaries are computed here, after the turn that made the history grow has been answered
+_summary_executor = ThreadPoolExecutor(max_workers=config.chat_memory_summary_workers,
+                                       thread_name_prefix="chat-summary")
+
+
+class RollingSummaryMemory(BaseMemory):
+    """
+    Chat memory keeping the last keep_messages messages verbatim and older ones folded into a summary.
+    When an answer takes the history over keep_messages, the oldest whole turns are folded into the
+    summary by the LLM on a background thread; until that is done they stay in the history as they are.
+    Each message is tokenized once, when put, and get returns the summary and the newest messages that
+    fit in token_limit tokens, so the prompt does not grow with the length of the conversation.
+    """
+
+    llm: Optional[Any] = Field(default=None, exclude=True, description="LLM writing the summaries.")
+    keep_messages: int = Field(default=6, description="Newest messages kept verbatim.")
+    token_limit: int = Field(default=3000, description="Maximum tokens of the chat history returned by get.")
+    summary_max_tokens: int = Field(default=400, description="Maximum tokens of the summary.")
+
+    _summary: str = PrivateAttr(default="")
+    _summary_tokens: int = PrivateAttr(default=0)
+    # (message, tokens) of the messages not folded into the summary yet
+    _messages: List[Any] = PrivateAttr(default_factory=list)
+    _summarizing: bool = PrivateAttr(default=False)
+    # incremented by reset, so that a summary of the history from before is dropped
+    _generation: int = PrivateAttr(default=0)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _tokenizer: Any = PrivateAttr(default_factory=get_tokenizer)
+
+    @classmethod
+    def class_name(cls):
+        return "RollingSummaryMemory"
+
+    @classmethod
+    def from_defaults(cls, chat_history=None, llm=None, **kwargs):
+        memory = cls(llm=llm, **kwargs)
+        if chat_history:
+            memory.set(chat_history)
+        return memory
+
+    def _count(self, text):
+        return len(self._tokenizer(str(text or "")))
+
+    def _summary_message(self):
+        return ChatMessage(role=MessageRole.SYSTEM, content=SUMMARY_PREFIX + self._summary)
+
+    @property
+    def token_count(self):
+        with self._lock:
+            return self._summary_tokens + sum(tokens for _, tokens in self._messages)
+
+    def get(self, input=None, **kwargs):
+        with self._lock:
+            budget = self.token_limit - self._summary_tokens
+            start = len(self._messages)
+            while start > 0 and self._messages[start - 1][1] <= budget:
+                start -= 1
+                budget -= self._messages[start][1]
+            # the history should not open with an answer whose question was left out
+            while start < len(self._messages) and self._messages[start][0].role != MessageRole.USER:
+                start += 1
+            messages = [message for message, _ in self._messages[start:]]
+            return [self._summary_message(), *messages] if self._summary else messages
+
+    def get_all(self):
+        with self._lock:
+            messages = [message for message, _ in self._messages]
+            return [self._summary_message(), *messages] if self._summary else messages
+
+    def put(self, message):
+        tokens = self._count(message.content)
+        with self._lock:
+            self._messages.append((message, tokens))
+            # folds whole turns, once their answer is in
+            if (self._summarizing or self.llm is None or message.role != MessageRole.ASSISTANT
+                    or len(self._messages) <= self.keep_messages):
+                return
+            self._summarizing = True
+            fold = [message for message, _ in self._messages[:len(self._messages) - self.keep_messages]]
+            summary, generation = self._summary, self._generation
+        _summary_executor.submit(self._summarize, fold, summary, generation)
+
+    def _summarize(self, fold, summary, generation):
+        prompt = SUMMARY_PROMPT.format(
+            max_words=self.summary_max_tokens * 3 // 4,
+            summary=summary or "(none)",
+            messages="\n".join(f"{message.role.value}: {message.content}" for message in fold),
+        )
+        try:
+            with llm_stage("summarize_memory"):
+                new_summary = self.llm.complete(prompt).text.strip()
+        except Exception as e:
+            # the messages stay verbatim and are folded after the next answer
+            logger.warning(f"Chat history summary failed: {e}")
+            new_summary = None
+        tokens = self._count(new_summary)
+        if new_summary is not None and tokens > self.summary_max_tokens:
+            new_summary = new_summary[:len(new_summary) * self.summary_max_tokens // tokens]
+            tokens = self._count(new_summary)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._summarizing = False
+            if new_summary is not None:
+                self._summary, self._summary_tokens = new_summary, tokens
+                del self._messages[:len(fold)]
+
+    def set(self, messages):
+        counted = [(message, self._count(message.content)) for message in messages]
+        with self._lock:
+            self._reset()
+            self._messages = counted
+
+    def _reset(self):
+        self._summary, self._summary_tokens = "", 0
+        self._messages = []
+        self._summarizing = False
+        self._generation += 1
+
+    def reset(self):
+        with self._lock:
+            self._reset()
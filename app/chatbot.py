@@ -1,11 +1,103 @@
+import contextvars
+import re
+from contextlib import contextmanager
+
 from dotenv import load_dotenv
-from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core import Settings, StorageContext, VectorStoreIndex
+from llama_index.core.chat_engine import CondenseQuestionChatEngine
+from llama_index.core.chat_engine.condense_question import DEFAULT_PROMPT
 from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.vector_stores.postgres import PGVectorStore
-from sqlalchemy import make_url
+from llama_index.core.schema import QueryBundle
+
+from chat_memory import RollingSummaryMemory
+from config import config
+from context_packer import ContextBudgetPacker
+from tracing import CHAT_CONDENSE
+from utils import strip_profile_instruction
+from vector_store import get_vector_store
 
 load_dotenv()
 
+# words that refer back to the conversation, or open a question that continues it
+FOLLOW_UP_WORDS = {
+    "it", "its", "it's", "they", "them", "their", "theirs", "this", "that", "these", "those",
+    "he", "she", "his", "her", "him", "former", "latter", "above", "same", "previous", "previously",
+    "earlier", "aforementioned", "mentioned", "else", "again",
+}
+FOLLOW_UP_STARTS = ("and ", "also ", "but ", "so ", "or ", "what about", "how about", "tell me more", "more ",
+                    "elaborate", "continue", "go on")
+# shorter questions ("and phase 2?", "how many?") are taken as follow-ups
+MIN_STANDALONE_WORDS = 4
+
+_WORD = re.compile(r"[a-z0-9']+")
+
+# (message, embedding) of a message whose query embedding the caller computed already
+_message_embedding = contextvars.ContextVar("message_embedding", default=None)
+
+
+@contextmanager
+def reuse_message_embedding(message, embedding):
+    """
+    Within the block, the message is retrieved with the given embedding (as computed by the embedding model
+    for it, e.g. for the response cache lookup) instead of being embedded again, when it goes to retrieval as is.
+    """
+    token = _message_embedding.set((message, embedding) if embedding is not None else None)
+    try:
+        yield
+    finally:
+        _message_embedding.reset(token)
+
+
+def is_follow_up(message):
+    """
+    Cheap local check of whether a question depends on the chat history: it refers back to it
+    (pronouns, "the same", "mentioned"...), opens like a continuation ("and", "what about") or is very short.
+    Errs on the side of condensing.
+    """
+    question = strip_profile_instruction(message).strip().lower()
+    words = _WORD.findall(question)
+    return (len(words) < MIN_STANDALONE_WORDS
+            or question.startswith(FOLLOW_UP_STARTS)
+            or any(word in FOLLOW_UP_WORDS for word in words))
+
+
+class AdaptiveCondenseQuestionChatEngine(CondenseQuestionChatEngine):
+    """
+    Condense question chat engine that only makes the condense LLM call for follow-ups. Without chat history,
+    or when the question is self-contained (see is_follow_up), it goes to retrieval as is, with the embedding
+    given to reuse_message_embedding if any.
+    """
+
+    def _condense_decision(self, chat_history, last_message):
+        if not chat_history:
+            decision = "no_history"
+        elif is_follow_up(last_message):
+            decision = "condensed"
+        else:
+            decision = "standalone"
+        CHAT_CONDENSE.inc(decision=decision)
+        return decision
+
+    @staticmethod
+    def _as_query(last_message):
+        """
+        Return: the message, with its embedding if the caller computed it (see reuse_message_embedding).
+        """
+        reused = _message_embedding.get()
+        if reused is None or reused[0] != last_message:
+            return last_message
+        return QueryBundle(query_str=last_message, embedding=list(reused[1]))
+
+    def _condense_question(self, chat_history, last_message):
+        if self._condense_decision(chat_history, last_message) != "condensed":
+            return self._as_query(last_message)
+        return super()._condense_question(chat_history, last_message)
+
+    async def _acondense_question(self, chat_history, last_message):
+        if self._condense_decision(chat_history, last_message) != "condensed":
+            return self._as_query(last_message)
+        return await super()._acondense_question(chat_history, last_message)
+
 
 class ChatBot:
 
@@ -15,19 +107,7 @@ class ChatBot:
 
     @classmethod
     def get_index(cls, conn_str, index_table, embed_dim):
-        url = make_url(conn_str)
-
-        hybrid_vector_store = PGVectorStore.from_params(
-            database=url.database,
-            host=url.host,
-            password=url.password,
-            port=url.port,
-            user=url.username,
-            table_name=index_table,
-            embed_dim=embed_dim,
-            hybrid_search=True,
-            text_search_config="english"
-        )
+        hybrid_vector_store = get_vector_store(conn_str, index_table, embed_dim)
 
         index = VectorStoreIndex.from_vector_store(
             vector_store=hybrid_vector_store
@@ -36,16 +116,55 @@ class ChatBot:
         return index
 
     @classmethod
-    def get_chat_engine(cls, index):
-        memory = ChatMemoryBuffer.from_defaults(token_limit=10_000)  # <== adjust
+    def get_memory(cls):
+        """
+        Return: a chat memory keeping the last turns verbatim and a rolling summary of older ones,
+        or a plain buffer of up to 10k tokens when disabled in the config.
+        """
+        if config.chat_memory_summary:
+            return RollingSummaryMemory.from_defaults(
+                llm=Settings.llm,
+                keep_messages=2 * config.chat_memory_keep_turns,
+                token_limit=config.chat_memory_token_limit,
+                summary_max_tokens=config.chat_memory_summary_tokens,
+            )
+        return ChatMemoryBuffer.from_defaults(token_limit=10_000)  # <== adjust
+
+    @classmethod
+    def chat_engine_class(cls):
+        """
+        Return: the condense question chat engine class, adaptive unless disabled in the config.
+        """
+        if config.chat_adaptive_condense:
+            return AdaptiveCondenseQuestionChatEngine
+        return CondenseQuestionChatEngine
+
+    @classmethod
+    def make_chat_engine(cls, query_engine, memory):
+        """
+        Return: a condense question chat engine (see chat_engine_class) on the query engine, with the shared LLM
+        and callback manager. It is built directly rather than with from_defaults, which wraps the LLM in a
+        ServiceContext and so replaces its callback manager with an empty one.
+        """
+        return cls.chat_engine_class()(
+            query_engine=query_engine,
+            condense_question_prompt=DEFAULT_PROMPT,
+            memory=memory,
+            llm=Settings.llm,
+            callback_manager=Settings.callback_manager,
+        )
+
+    @classmethod
+    def get_chat_engine(cls, index, memory=None):
+        memory = memory or cls.get_memory()
         # chat_engine.reset()
 
-        chat_engine = index.as_chat_engine(
-            similarity_top_k=3,  # <== adjust
-            #chat_mode="condense_plus_context",
-            chat_mode="condense_question",
+        engine_kwargs = dict(
+            similarity_top_k=config.chat_similarity_top_k,  # <== adjust
             vector_store_query_mode="hybrid",
-            sparse_top_k=2,
+            sparse_top_k=config.chat_sparse_top_k,
+            # retrieved chunks are packed into the prompt up to a token budget
+            node_postprocessors=[ContextBudgetPacker(token_budget=config.context_token_budget)],
             memory=memory,
             context_prompt=(
                 """
@@ -59,5 +178,19 @@ class ChatBot:
             ),
             verbose=False,
         )
+        # same as index.as_chat_engine(chat_mode="condense_question", ...), with the engine class from the config
+        query_engine = index.as_query_engine(llm=Settings.llm, **engine_kwargs)
+        return cls.make_chat_engine(query_engine, memory)
 
-        return chat_engine
+    @classmethod
+    def source_nct_ids(cls, source_nodes):
+        """
+        Return: the NCT IDs of the trials the retrieved nodes belong to, in retrieval order.
+        """
+        nct_ids = []
+        for source_node in source_nodes:
+            node = source_node.node
+            nct_id = node.metadata.get("National Clinical Identification NCT ID") or node.ref_doc_id
+            if nct_id and nct_id not in nct_ids:
+                nct_ids.append(nct_id)
+        return nct_ids
@@ -0,0 +1,76 @@
+from typing import List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.node_parser import NodeParser, SentenceSplitter
+from llama_index.core.node_parser.node_utils import default_id_func
+from llama_index.core.schema import MetadataMode, NodeRelationship, TextNode
+
+from utils import serialize_flattened, split_sections
+
+SECTION_KEY = "Section"
+
+
+class TrialSectionSplitter(NodeParser):
+    """
+    Splits trial documents along the sections of their fields (identification, design, arms, outcomes,
+    eligibility, results; see utils.SECTION_STARTS) instead of into fixed-size chunks, so that retrieval
+    can return the eligibility criteria of a trial without its whole record.
+
+    The fields are read from the document metadata, which holds the extracted trial, and each section
+    is serialized like the document text. Sections longer than chunk_size tokens (with the metadata
+    header) are split further by sentence, sections without any value are skipped. Nodes carry the
+    name of their section under SECTION_KEY and, when metadata_keys is given, only those metadata keys.
+    """
+
+    chunk_size: int = Field(default=1024, description="Maximum tokens per node, metadata header included.")
+    chunk_overlap: int = Field(default=64, description="Token overlap between the parts of a long section.")
+    metadata_keys: Optional[List[str]] = Field(default=None, description="Document metadata kept on nodes.")
+
+    _splitter: SentenceSplitter = PrivateAttr()
+
+    def __init__(self, **kwargs):
+        # nodes get their metadata here, not copied over from the document afterwards
+        kwargs.setdefault("include_metadata", False)
+        super().__init__(**kwargs)
+        self._splitter = SentenceSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+
+    @classmethod
+    def class_name(cls):
+        return "TrialSectionSplitter"
+
+    def _node_metadata(self, document):
+        if self.metadata_keys is None:
+            return dict(document.metadata)
+        return {key: document.metadata[key] for key in self.metadata_keys if key in document.metadata}
+
+    def _parse_nodes(self, nodes, show_progress=False, **kwargs):
+        id_func = self.id_func or default_id_func
+        all_nodes = []
+        for document in nodes:
+            base_metadata = self._node_metadata(document)
+            # computed once per document, it hashes the whole document
+            relationships = {NodeRelationship.SOURCE: document.as_related_node_info()}
+            for section, fields in split_sections(document.metadata):
+                if not any(value for value in fields.values()):
+                    continue
+                node_kwargs = dict(
+                    metadata={**base_metadata, SECTION_KEY: section},
+                    excluded_embed_metadata_keys=document.excluded_embed_metadata_keys,
+                    excluded_llm_metadata_keys=document.excluded_llm_metadata_keys,
+                    metadata_seperator=document.metadata_seperator,
+                    metadata_template=document.metadata_template,
+                    text_template=document.text_template,
+                )
+                header_node = TextNode(text="", **node_kwargs)
+                metadata_str = max(header_node.get_metadata_str(mode=MetadataMode.EMBED),
+                                   header_node.get_metadata_str(mode=MetadataMode.LLM), key=len)
+                splits = self._splitter.split_text_metadata_aware(serialize_flattened(fields), metadata_str)
+                for split in splits:
+                    node_kwargs["metadata"] = dict(node_kwargs["metadata"])
+                    all_nodes.append(TextNode(
+                        id_=id_func(len(all_nodes), document),
+                        text=split,
+                        relationships=dict(relationships),
+                        **node_kwargs,
+                    ))
+        return all_nodes
@@ -0,0 +1,95 @@
+from sqlalchemy import text
+from sqlalchemy_utils import database_exists, create_database
+
+from utils import escape_like, init_logging
+
+logger = init_logging(__name__)
+
+# joins the brief title and the conditions in search_text; lookups containing it match nothing,
+# so that a lookup cannot match across two of them
+SEARCH_TEXT_SEPARATOR = "\x1f"
+
+
+class ConditionIndex:
+    """
+    Local copy of the Pfizer Phase 3 candidate trials (NCT ID, brief title, conditions) kept in the
+    vector database, so that condition lookups are served by a trigram index instead of scanning AACT.
+    """
+
+    def __init__(self, engine, table_name="pfizer_trial_conditions"):
+        self.engine = engine
+        self.table_name = table_name
+        self._is_initialized = False
+        # once seen populated, the table is not checked again: a refresh replaces its content in one transaction
+        self._is_populated = False
+
+    def _initialize(self):
+        if self._is_initialized:
+            return
+        if not database_exists(self.engine.url):
+            create_database(self.engine.url)
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("create extension if not exists pg_trgm")
+            conn.exec_driver_sql(f"""create table if not exists {self.table_name} (
+                                        nct_id varchar primary key,
+                                        brief_title varchar not null,
+                                        conditions varchar[] not null,
+                                        search_text varchar not null
+                                    )""")
+            conn.exec_driver_sql(f"""create index if not exists {self.table_name}_search_trgm_idx
+                                    on {self.table_name} using gin (search_text gin_trgm_ops)""")
+        self._is_initialized = True
+
+    def refresh(self, trials):
+        """
+        Replaces the table content with the given trials in a single transaction,
+        readers keep seeing the previous content until it commits.
+        trials: dicts with nct_id, brief_title and conditions (lower-case condition names).
+        Return: the number of trials stored.
+        """
+        self._initialize()
+        rows = [
+            {
+                "nct_id": trial["nct_id"],
+                "brief_title": trial["brief_title"],
+                "conditions": list(trial["conditions"]),
+                "search_text": SEARCH_TEXT_SEPARATOR.join([trial["brief_title"].lower(), *trial["conditions"]]),
+            }
+            for trial in trials
+        ]
+        with self.engine.begin() as conn:
+            conn.execute(text(f"delete from {self.table_name}"))
+            if rows:
+                conn.execute(
+                    text(f"""insert into {self.table_name} (nct_id, brief_title, conditions, search_text)
+                             values (:nct_id, :brief_title, :conditions, :search_text)"""),
+                    rows
+                )
+        self._is_populated = len(rows) > 0
+        logger.info(f"Condition index refreshed with {len(rows)} trials")
+        return len(rows)
+
+    def is_empty(self):
+        if self._is_populated:
+            return False
+        self._initialize()
+        with self.engine.connect() as conn:
+            is_empty = conn.execute(text(f"select not exists (select 1 from {self.table_name})")).scalar()
+        self._is_populated = not is_empty
+        return is_empty
+
+    def lookup(self, condition):
+        """
+        Return: the trials whose brief title or one of whose conditions contains the given text, newest NCT ID first.
+        """
+        if SEARCH_TEXT_SEPARATOR in condition:
+            return []
+        self._initialize()
+        with self.engine.connect() as conn:
+            res = conn.execute(
+                text(f"""select nct_id, brief_title from {self.table_name}
+                         where search_text like '%' || :condition || '%' escape '\\'
+                         order by nct_id desc"""),
+                {"condition": escape_like(condition.lower())}
+            )
+            return [{"nct_id": row.nct_id, "brief_title": row.brief_title} for row in res]
@@ -0,0 +1,41 @@
+import functools
+from typing import List, Optional
+
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+
+from tracing import CHAT_CONTEXT_TOKENS
+
+
+@functools.lru_cache(maxsize=10_000)
+def count_tokens(text):
+    return len(get_tokenizer()(text))
+
+
+class ContextBudgetPacker(BaseNodePostprocessor):
+    """
+    Keeps the highest-scoring retrieved nodes whose text, as the LLM sees it (metadata header included),
+    fits in token_budget tokens, in score order. A node that does not fit is skipped and smaller ones
+    further down may still be packed. The best node is always kept, even when larger than the budget.
+    """
+
+    token_budget: int = Field(default=3000, description="Maximum tokens of retrieved context per prompt.")
+
+    @classmethod
+    def class_name(cls):
+        return "ContextBudgetPacker"
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        packed = []
+        used = 0
+        for node in sorted(nodes, key=lambda n: n.score if n.score is not None else 0.0, reverse=True):
+            n_tokens = count_tokens(node.node.get_content(metadata_mode=MetadataMode.LLM))
+            if packed and used + n_tokens > self.token_budget:
+                continue
+            packed.append(node)
+            used += n_tokens
+        CHAT_CONTEXT_TOKENS.observe(used)
+        return packed
@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from llama_index.core.schema import MetadataMode
+from llama_index.core.utils import get_tokenizer
+
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+
+def batch_by_token_budget(texts, token_budget, max_batch_size, tokenizer=None):
+    """
+    Groups texts into consecutive batches whose total token count stays within token_budget
+    and whose length does not exceed max_batch_size. A single text larger than the budget
+    is sent in a batch of its own.
+    Return: a list of batches, each a list of indexes into texts.
+    """
+    tokenizer = tokenizer or get_tokenizer()
+    batches = []
+    cur_batch = []
+    cur_tokens = 0
+    for i, text in enumerate(texts):
+        n_tokens = len(tokenizer(text))
+        if cur_batch and (cur_tokens + n_tokens > token_budget or len(cur_batch) == max_batch_size):
+            batches.append(cur_batch)
+            cur_batch = []
+            cur_tokens = 0
+        cur_batch.append(i)
+        cur_tokens += n_tokens
+    if cur_batch:
+        batches.append(cur_batch)
+    return batches
+
+
+def embed_nodes(nodes, embed_model, token_budget=50_000, max_batch_size=256, max_in_flight=4, cache=None,
+                progress=None):
+    """
+    Embeds nodes in token-budgeted batches, keeping up to max_in_flight batches in flight at once.
+    When an EmbeddingCache is given, nodes whose text was embedded before by the same model
+    are served from it and only the misses are sent to the embedding model.
+    The vectors are written back onto the nodes in order.
+    progress, if given, is called with the number of nodes embedded so far in each step;
+    an exception it raises stops the embedding.
+    Return: the same list of nodes.
+    """
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    embeddings = [None] * len(texts)
+
+    if cache is not None:
+        keys = [cache.make_key(embed_model.model_name, text) for text in texts]
+        cached = cache.get_many(set(keys))
+        for i, key in enumerate(keys):
+            embeddings[i] = cached.get(key)
+        logger.info(f"Embedding cache: {len(texts) - embeddings.count(None)} of {len(texts)} nodes found")
+        if progress is not None:
+            progress(len(texts) - embeddings.count(None))
+
+    pending = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    # get_text_embedding_batch splits its input by embed_batch_size, keep one request per batch
+    max_batch_size = min(max_batch_size, embed_model.embed_batch_size)
+    batches = [[pending[j] for j in batch]
+               for batch in batch_by_token_budget([texts[i] for i in pending], token_budget, max_batch_size)]
+    logger.info(f"Embedding {len(pending)} nodes in {len(batches)} batches...")
+
+    def embed_batch(batch):
+        return embed_model.get_text_embedding_batch([texts[i] for i in batch])
+
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        for batch, batch_embeddings in zip(batches, executor.map(embed_batch, batches)):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+            if progress is not None:
+                progress(len(batch))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    if cache is not None and pending:
+        cache.put_many(embed_model.model_name, {keys[i]: embeddings[i] for i in pending})
+
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    return nodes
@@ -0,0 +1,139 @@
+import hashlib
+import threading
+import time
+from array import array
+
+import sqlalchemy as db
+
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+_CHUNK_SIZE = 500
+# embeddings are stored as float32, like pgvector stores them; part of the key, so that entries stored
+# as float64 before are never decoded as float32 (they are evicted as least recently used instead)
+_ENCODING = "f4"
+# eviction goes down to this fraction of max_entries, so that the following puts do not evict again
+_EVICT_TO = 0.9
+
+
+def _chunks(items, size=_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class EmbeddingCache:
+    """
+    Content-addressed store of embeddings, kept in a side table next to the vector index.
+    Entries are keyed by a hash of the embedding model name and the text that was embedded,
+    and the least recently used entries are evicted once max_entries is exceeded. The number of entries
+    is tracked in memory and only counted in the table to confirm it is exceeded, as other processes
+    may share the table.
+    """
+
+    def __init__(self, engine, table_name, max_entries=50_000):
+        self.engine = engine
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._is_initialized = False
+        self._n_entries = None
+
+        metadata = db.MetaData()
+        self.table = db.Table(
+            table_name,
+            metadata,
+            db.Column("key", db.String(64), primary_key=True),
+            db.Column("model_name", db.String, nullable=False),
+            db.Column("embedding", db.LargeBinary, nullable=False),
+            db.Column("last_used", db.Float, nullable=False, index=True),
+        )
+
+    @staticmethod
+    def make_key(model_name, text):
+        return hashlib.sha256(f"{model_name}\0{_ENCODING}\0{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _encode(embedding):
+        return array("f", embedding).tobytes()
+
+    @staticmethod
+    def _decode(blob):
+        return array("f", blob).tolist()
+
+    def _initialize(self):
+        if not self._is_initialized:
+            self.table.metadata.create_all(self.engine)
+            self._is_initialized = True
+
+    def get_many(self, keys):
+        """
+        Looks up embeddings by key and marks the found entries as recently used.
+        Return: a dict of key -> embedding for the keys found in the cache.
+        """
+        self._initialize()
+        found = {}
+        now = time.time()
+        with self.engine.begin() as conn:
+            for chunk in _chunks(list(keys)):
+                rows = conn.execute(
+                    db.select(self.table.c.key, self.table.c.embedding).where(self.table.c.key.in_(chunk))
+                )
+                found.update({row.key: self._decode(row.embedding) for row in rows})
+            for chunk in _chunks(list(found)):
+                conn.execute(self.table.update().where(self.table.c.key.in_(chunk)).values(last_used=now))
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model_name, entries):
+        """
+        Stores a dict of key -> embedding, then evicts the least recently used entries above max_entries.
+        """
+        if not entries:
+            return
+        self._initialize()
+        now = time.time()
+        keys = list(entries)
+        added = 0
+        with self.engine.begin() as conn:
+            for chunk in _chunks(keys):
+                replaced = conn.execute(self.table.delete().where(self.table.c.key.in_(chunk))).rowcount
+                added += len(chunk) - replaced
+                conn.execute(
+                    self.table.insert(),
+                    [
+                        {"key": key, "model_name": model_name, "embedding": self._encode(entries[key]),
+                         "last_used": now}
+                        for key in chunk
+                    ]
+                )
+            self._evict(conn, added)
+
+    def _count(self, conn):
+        return conn.execute(db.select(db.func.count()).select_from(self.table)).scalar()
+
+    def _evict(self, conn, added):
+        with self._lock:
+            if self._n_entries is not None:
+                self._n_entries += added
+            n_entries = self._n_entries
+        if n_entries is not None and n_entries <= self.max_entries:
+            return
+        n_entries = self._count(conn)
+        n_evict = n_entries - int(self.max_entries * _EVICT_TO) if n_entries > self.max_entries else 0
+        if n_evict > 0:
+            oldest = db.select(self.table.c.key).order_by(self.table.c.last_used.asc()).limit(n_evict)
+            res = conn.execute(self.table.delete().where(self.table.c.key.in_(oldest.scalar_subquery())))
+            n_evict = res.rowcount
+            logger.info(f"Evicted {n_evict} entries from the embedding cache")
+        with self._lock:
+            self._n_entries = n_entries - n_evict
+
+    def stats(self):
+        self._initialize()
+        with self.engine.connect() as conn:
+            n_entries = self._count(conn)
+        return {"hits": self.hits, "misses": self.misses, "entries": n_entries, "max_entries": self.max_entries}
@@ -0,0 +1,65 @@
+import threading
+
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import config
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+_engines = {}
+_async_engines = {}
+_lock = threading.Lock()
+
+
+def _key(conn_str, drivername):
+    # "postgresql://..." and "postgresql+psycopg2://..." share one engine
+    return make_url(conn_str).set(drivername=drivername).render_as_string(hide_password=False)
+
+
+def get_engine(conn_str):
+    """
+    Return: the process-wide pooled SQLAlchemy engine of a database, created on first use.
+    """
+    key = _key(conn_str, "postgresql+psycopg2")
+    with _lock:
+        if key not in _engines:
+            _engines[key] = create_engine(
+                key,
+                pool_size=config.db_pool_size,
+                max_overflow=config.db_max_overflow,
+                pool_recycle=config.db_pool_recycle,
+                pool_pre_ping=True,
+            )
+            logger.info(f"Created connection pool for {make_url(key).database}")
+        return _engines[key]
+
+
+def get_async_engine(conn_str):
+    """
+    Return: the process-wide pooled asyncpg engine of a database, created on first use.
+    """
+    key = _key(conn_str, "postgresql+asyncpg")
+    with _lock:
+        if key not in _async_engines:
+            _async_engines[key] = create_async_engine(
+                key,
+                pool_size=config.db_pool_size,
+                max_overflow=config.db_max_overflow,
+                pool_recycle=config.db_pool_recycle,
+                pool_pre_ping=True,
+            )
+        return _async_engines[key]
+
+
+async def dispose_engines():
+    with _lock:
+        engines = list(_engines.values())
+        async_engines = list(_async_engines.values())
+        _engines.clear()
+        _async_engines.clear()
+    for engine in engines:
+        engine.dispose()
+    for engine in async_engines:
+        await engine.dispose()
@@ -1,18 +1,23 @@
-import os
+import threading
+import time
 
-import psycopg2
-import requests as req
 from dotenv import load_dotenv
 from llama_index.core import Document, Settings, StorageContext, VectorStoreIndex
 from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.schema import MetadataMode
-from llama_index.vector_stores.postgres import PGVectorStore
-from psycopg2.extras import NamedTupleCursor
 from sqlalchemy import make_url, text
-import sqlalchemy as db
 from sqlalchemy_utils import database_exists, create_database, drop_database
 
-from utils import extract_from_json, format_flattened_dict, flatten_dict, init_logging
+from config import config
+from bulk_writer import BulkVectorWriter
+from chunking import TrialSectionSplitter
+from embedding import embed_nodes
+from engines import get_engine
+from jobs import Job, JobCancelled
+from pipeline import StagePipeline, batched
+from tracing import INGEST_ITEMS, INGEST_STAGE_SECONDS, stage_timer, timed_iter
+from trial_fetcher import TrialFetcher
+from utils import STUDY_FIELDS, content_hash, extract_from_json_batch, init_logging, serialize_flattened
+from vector_store import EXACT_FILTER_KEYS, TEXT_MATCH_FILTER_KEYS, get_vector_store
 
 load_dotenv()
 logger = init_logging(__name__)
@@ -39,30 +44,67 @@ embedding_keys_to_include = [
     "Statistical Method",
 ]
 
+CONTENT_HASH_KEY = "content_hash"
+
+# metadata kept on each section node: what the LLM and the embedding see, the /search filters and the content hash
+node_metadata_keys = list(dict.fromkeys(
+    [*llm_keys_to_include, *embedding_keys_to_include, *TEXT_MATCH_FILTER_KEYS, *EXACT_FILTER_KEYS, CONTENT_HASH_KEY]
+))
+
+
+class IngestionStats:
+    """
+    Row count of the index table as maintained by the loads of this process, and the last load.
+    The row count is unknown (None) until a full reload or truncation, the stats endpoint then
+    falls back to the planner's estimate.
+    """
+
+    def __init__(self):
+        self.row_count = None
+        self.last_load = None
+        self.loads = 0
+        self._lock = threading.Lock()
+
+    def record_load(self, rows_written, rows_deleted, full_reload, status):
+        with self._lock:
+            if full_reload:
+                self.row_count = rows_written
+            elif self.row_count is not None:
+                self.row_count = max(self.row_count + rows_written - rows_deleted, 0)
+            self.loads += 1
+            self.last_load = {
+                "finished": time.time(),
+                "status": status,
+                "full_reload": full_reload,
+                "rows_written": rows_written,
+                "rows_deleted": rows_deleted,
+            }
+
+    def record_truncate(self):
+        with self._lock:
+            self.row_count = 0
+
+    def to_dict(self):
+        with self._lock:
+            return {"row_count": self.row_count, "loads": self.loads, "last_load": self.last_load}
+
 
 class IndexManager:
 
-    def __init__(self, conn_str, table_name, embed_dim):
+    def __init__(self, conn_str, table_name, embed_dim, fetcher=None, embedding_cache=None, ingestion_stats=None):
         self.conn_str = conn_str
+        self.engine = get_engine(conn_str)
         self.table_name = table_name
         self.embed_dim = embed_dim
+        self.fetcher = fetcher or TrialFetcher()
+        self.embedding_cache = embedding_cache
+        self.ingestion_stats = ingestion_stats
 
     def _get_trial(self, nct_id):
         """
-        Return: the JSON data for a clinical trial given its NCT ID.
+        Return: the JSON data for a clinical trial given its NCT ID, or None if it is not found.
         """
-        trial = req.get(f"https://clinicaltrials.gov/api/v2/studies/{nct_id}")
-        trial_json = trial.json()
-        return trial_json
-
-    def _max_keys(self, documents_list):
-        """
-        Identifies the document with the maximum number of keys in a list of dictionaries.
-        Return: a list of keys from the document with the maximum number of keys.
-        """
-        max_index, _ = max(enumerate(documents_list), key=lambda x: len(x[1].keys()))
-        all_keys = list(documents_list[max_index].keys())
-        return all_keys
+        return self.fetcher.get_trial(nct_id)
 
     def _adjust_metadata_keys(self, all_keys, keys_to_include):
         """
@@ -83,12 +125,12 @@ class IndexManager:
         llama_documents = []
         for trial in documents_list:
             # apply functions from utils to flatten JSON and create content similar to the example above
-            content_text = format_flattened_dict(flatten_dict(trial))
+            content_text = serialize_flattened(trial)
 
             llama_document = Document(
                 id_=trial["National Clinical Identification NCT ID"],
                 text=content_text,
-                metadata=trial,
+                metadata={**trial, CONTENT_HASH_KEY: content_hash(trial)},
                 excluded_llm_metadata_keys=llm_keys_to_exclude,  # <== adjust?, TBD
                 excluded_embed_metadata_keys=embedding_keys_to_exclude,  # <== adjust?, TBD
                 metadata_template="{key}=>{value}",
@@ -97,172 +139,261 @@ class IndexManager:
             llama_documents.append(llama_document)
         return llama_documents
 
-    def _create_nodes(self, llama_documents, embed_model):
+    def _create_nodes(self, llama_documents):
         """
-        Generates and embeds nodes from Llama documents.
+        Splits Llama documents into nodes: one per section of the trial (CHUNK_STRATEGY=sections),
+        or chunks of up to 8190 tokens (CHUNK_STRATEGY=fixed).
         """
-        parser = SentenceSplitter(chunk_size=8190, chunk_overlap=0)  # <== adjust from default values
-        nodes = parser.get_nodes_from_documents(llama_documents)
-        for node in nodes:
-            node_embedding = embed_model.get_text_embedding(
-                node.get_content(metadata_mode=MetadataMode.EMBED)
-            )
-            node.embedding = node_embedding
-        return nodes
-
-    def pull_pfizer_trials(self):
-        db_username = os.getenv("AACT_USERNAME")
-        db_password = os.getenv("AACT_PASSWORD")
-
-        if not db_username or not db_password:
-            raise ValueError("AACT_USERNAME and AACT_PASSWORD must be set in .env")
-
-        conn = psycopg2.connect(
-            host="aact-db.ctti-clinicaltrials.org",
-            database="aact",
-            user=db_username,
-            password=db_password,
-            port="5432",
-            cursor_factory=NamedTupleCursor
-        )
-
-        query = """select distinct
-                        s.nct_id 
-                    FROM
-                        studies s
-                    LEFT JOIN conditions c ON s.nct_id = c.nct_id
-                    LEFT JOIN outcome_analyses oa ON s.nct_id = oa.nct_id
-                    WHERE
-                        s.study_type IN ('Interventional')
-                        AND s.phase IN ('Phase 3')
-                        AND s.overall_status = 'Completed'
-                        AND oa.p_value IS NOT NULL
-                        AND s.source = 'Pfizer'"""
-
-        with conn:
-            with conn.cursor() as curs:
-                curs.execute(query)
-                nct_ids = [rec.nct_id for rec in curs.fetchall()]
-
-        return nct_ids
-
-    def load_trials(self, nct_ids: list):
+        if config.chunk_strategy == "sections":
+            parser = TrialSectionSplitter(chunk_size=config.chunk_size, metadata_keys=node_metadata_keys)
+        else:
+            parser = SentenceSplitter(chunk_size=8190, chunk_overlap=0)  # <== adjust from default values
+        return parser.get_nodes_from_documents(llama_documents)
 
-        documents_list = []
+    def _embed_nodes(self, nodes, embed_model, job):
+        """
+        Embeds nodes in place.
+        """
+        return embed_nodes(
+            nodes,
+            embed_model,
+            token_budget=config.embed_batch_token_budget,
+            max_batch_size=config.embed_batch_max_items,
+            max_in_flight=config.embed_max_in_flight,
+            cache=self.embedding_cache,
+            progress=lambda n: job.advance("nodes_embedded", n)
+        )
 
-        for nct_id in nct_ids:
-            trial_json = self._get_trial(nct_id)
-            extracted_json = extract_from_json(trial_json)
-            documents_list.append(extracted_json)
+    def _stored_trials(self):
+        """
+        Return: a dict of NCT ID -> (content hash, list of row ids) for the trials already in the index.
+        """
+        stored = {}
+        with self.engine.connect() as conn:
+            if conn.execute(text("select to_regclass(:table)"), {"table": f"data_{self.table_name}"}).scalar() is None:
+                return {}
+            res = conn.execute(text(
+                f"select id, metadata_->>'doc_id' as doc_id, metadata_->>'{CONTENT_HASH_KEY}' as content_hash "
+                f"from data_{self.table_name}"
+            ))
+            for row in res:
+                content_hash_, row_ids = stored.setdefault(row.doc_id, (row.content_hash, []))
+                if content_hash_ != row.content_hash:
+                    # rows of an interrupted load, have the trial reloaded
+                    stored[row.doc_id] = (None, row_ids)
+                row_ids.append(row.id)
+        return stored
+
+    def _delete_rows(self, row_ids):
+        """
+        Return: the number of rows deleted.
+        """
+        with self.engine.begin() as conn:
+            res = conn.execute(text(f"delete from data_{self.table_name} where id = any(:ids)"), {"ids": row_ids})
+            return res.rowcount
 
-        all_keys = self._max_keys(documents_list)
+    def load_trials(self, nct_ids: list, incremental=False, job=None):
+        """
+        Downloads the given trials and stores them in the index.
+        Trials stream through fetch -> extract -> document -> chunk -> embed -> write stages running
+        concurrently, with bounded queues in between, so memory use does not grow with the number of
+        trials and each batch is queryable as soon as it is written.
+        By default the index is truncated (before the first batch is written) and rebuilt. With
+        incremental=True, only new and changed trials are embedded and written; the rows of changed
+        trials are replaced once their new version is written, trials missing from nct_ids are deleted
+        and the rest are left untouched. If none of nct_ids is found, the load fails and the index is left unchanged.
+        Progress is reported on job, which also stops the load once cancelled.
+        """
+        job = job or Job("load_trials")
+        all_keys = [label for label, _ in STUDY_FIELDS] + [CONTENT_HASH_KEY]
         llm_keys_to_exclude = self._adjust_metadata_keys(all_keys, llm_keys_to_include)
         embedding_keys_to_exclude = self._adjust_metadata_keys(all_keys, llm_keys_to_include)
 
-        llama_documents = self._create_llama_docs(documents_list, llm_keys_to_exclude, embedding_keys_to_exclude)
-        nodes = self._create_nodes(llama_documents, Settings.embed_model)
+        self.ensure_database(self.conn_str)
 
-        url = make_url(self.conn_str)
+        stored = {}
+        if incremental:
+            job.set_stage("diff")
+            stored = self._stored_trials()
 
-        if not database_exists(url):
-            create_database(url)
-
-        self.delete_index(self.conn_str, self.table_name)
-
-        hybrid_vector_store = PGVectorStore.from_params(
-            database=url.database,
-            host=url.host,
-            password=url.password,
-            port=url.port,
-            user=url.username,
-            table_name=self.table_name,
-            embed_dim=self.embed_dim,  # openai embedding dimension
-            hybrid_search=True,
-            text_search_config="english"
-        )
+        hybrid_vector_store = get_vector_store(self.conn_str, self.table_name, self.embed_dim)
 
         hybrid_storage_context = StorageContext.from_defaults(
             vector_store=hybrid_vector_store
         )
 
         hybrid_index = VectorStoreIndex(
-            nodes=nodes,
+            nodes=[],
             storage_context=hybrid_storage_context
         )
 
+        incoming_ids = set()
+        stale_row_ids = []
+        counts = {"new": 0, "changed": 0, "unchanged": 0}
+        truncated = incremental
+        # a full reload writes into an empty table, its indexes are rebuilt once at the end
+        writer = BulkVectorWriter(self.engine, hybrid_vector_store, defer_indexes=not incremental)
+        writer.begin()
+
+        def extract(trials_json):
+            for batch in batched(timed_iter(trials_json, INGEST_STAGE_SECONDS, "fetch"), config.ingest_batch_size):
+                INGEST_ITEMS.inc(len(batch), stage="fetch")
+                with stage_timer(INGEST_STAGE_SECONDS, "extract"):
+                    trials = extract_from_json_batch(batch)
+                documents_list = []
+                for trial in trials:
+                    nct_id = trial["National Clinical Identification NCT ID"]
+                    incoming_ids.add(nct_id)
+                    if nct_id not in stored:
+                        counts["new"] += 1
+                    elif stored[nct_id][0] != content_hash(trial):
+                        counts["changed"] += 1
+                        stale_row_ids.extend(stored[nct_id][1])
+                    else:
+                        counts["unchanged"] += 1
+                        continue
+                    documents_list.append(trial)
+                if documents_list:
+                    yield documents_list
+
+        def create_documents(batches):
+            for documents_list in batches:
+                with stage_timer(INGEST_STAGE_SECONDS, "document"):
+                    llama_documents = self._create_llama_docs(
+                        documents_list, llm_keys_to_exclude, embedding_keys_to_exclude
+                    )
+                INGEST_ITEMS.inc(len(llama_documents), stage="document")
+                yield llama_documents
+
+        def create_nodes(batches):
+            for llama_documents in batches:
+                with stage_timer(INGEST_STAGE_SECONDS, "chunk"):
+                    nodes = self._create_nodes(llama_documents)
+                INGEST_ITEMS.inc(len(nodes), stage="chunk")
+                yield nodes
+
+        def embed(batches):
+            for nodes in batches:
+                with stage_timer(INGEST_STAGE_SECONDS, "embed"):
+                    nodes = self._embed_nodes(nodes, Settings.embed_model, job)
+                INGEST_ITEMS.inc(len(nodes), stage="embed")
+                yield nodes
+
+        def write(batches):
+            nonlocal truncated
+            for nodes in batches:
+                if not truncated:
+                    self.delete_index(self.conn_str, self.table_name)
+                    truncated = True
+                rows_written = 0
+                # each batch is committed on its own and holds whole trials: the rows of a trial all carry its
+                # content hash, so a trial left partly written by a failed load would pass for complete
+                for batch in batched(nodes, config.write_batch_size, key=lambda node: node.ref_doc_id):
+                    with stage_timer(INGEST_STAGE_SECONDS, "write"):
+                        rows_written += writer.write(batch)
+                INGEST_ITEMS.inc(rows_written, stage="write")
+                # cancellation is checked here, once all the nodes of these trials are written: rows of a
+                # partly written trial carry its content hash too, and would pass for the whole trial
+                job.advance("rows_written", rows_written)
+                yield
+
+        job.set_stage("ingest")
+        job.set_total("trials_fetched", len(nct_ids))
+        trials_json = self.fetcher.iter_trials(nct_ids, progress=lambda n: job.advance("trials_fetched", n))
+        status = "failed"
+        rows_deleted = 0
+        try:
+            try:
+                StagePipeline(
+                    trials_json,
+                    [extract, create_documents, create_nodes, embed, write],
+                    queue_size=config.ingest_queue_size,
+                    name=f"ingest-{self.table_name}"
+                ).run()
+                if nct_ids and not incoming_ids:
+                    # every NCT ID unknown to the source: truncating (or deleting them as removed) would replace
+                    # the index with an empty one
+                    raise RuntimeError(f"None of the {len(nct_ids)} trials was found, the index was left unchanged")
+                if not truncated:
+                    self.delete_index(self.conn_str, self.table_name)
+                    truncated = True
+            finally:
+                writer.finish()
+
+            job.set_stage("cleanup")
+            removed = [nct_id for nct_id in stored if nct_id not in incoming_ids]
+            for nct_id in removed:
+                stale_row_ids.extend(stored[nct_id][1])
+            if stale_row_ids:
+                rows_deleted = self._delete_rows(stale_row_ids)
+            if incremental:
+                logger.info(f"Incremental load: {counts['new']} new, {counts['changed']} changed, "
+                            f"{len(removed)} removed, {counts['unchanged']} unchanged trials")
+            status = "completed"
+        except JobCancelled:
+            status = "cancelled"
+            raise
+        finally:
+            if self.ingestion_stats is not None:
+                self.ingestion_stats.record_load(writer.rows_written, rows_deleted,
+                                                 full_reload=truncated and not incremental, status=status)
+
         return hybrid_index
 
+    @classmethod
+    def ensure_database(cls, conn_str):
+        url = make_url(conn_str)
+        if not database_exists(url):
+            create_database(url)
+
     @classmethod
     def delete_index(cls, conn_str, index_table):
-        engine = db.create_engine(conn_str)
-        with engine.connect() as conn:
+        with get_engine(conn_str).begin() as conn:
             conn.exec_driver_sql(f"truncate table data_{index_table}")
-            conn.commit()
         return True
 
     @classmethod
     def get_index_length(cls, conn_str, index_table):
-        url = make_url(conn_str)
-        if not database_exists(url):
-            return 0
-        engine = db.create_engine(conn_str)
-        insp = db.inspect(engine)
-        has_table = insp.has_table(index_table)
-        if not has_table:
-            return 0
-        with engine.connect() as conn:
-            res = conn.execute(text(f"select count(*) from {index_table}"))
-            index_len = res.fetchone()
-
-        return index_len[0]
-
-    def get_most_recent_trial(self, condition):
-        db_username = os.getenv("AACT_USERNAME")
-        db_password = os.getenv("AACT_PASSWORD")
-
-        if not db_username or not db_password:
-            raise ValueError("AACT_USERNAME and AACT_PASSWORD must be set in .env")
-
-        conn = psycopg2.connect(
-            host="aact-db.ctti-clinicaltrials.org",
-            database="aact",
-            user=db_username,
-            password=db_password,
-            port="5432",
-            cursor_factory=NamedTupleCursor
-        )
+        """
+        Return: the exact number of rows of the given table, 0 if it does not exist.
+        """
+        with get_engine(conn_str).connect() as conn:
+            if conn.execute(text("select to_regclass(:table)"), {"table": index_table}).scalar() is None:
+                return 0
+            return conn.execute(text(f"select count(*) from {index_table}")).scalar()
 
-        query = f"""select distinct
-                        s.nct_id,
-                        s.brief_title
-                    FROM
-                        studies s
-                    LEFT JOIN conditions c ON s.nct_id = c.nct_id
-                    LEFT JOIN outcome_analyses oa ON s.nct_id = oa.nct_id
-                    WHERE
-                        s.study_type IN ('Interventional')
-                        AND s.phase IN ('Phase 3')
-                        AND s.overall_status = 'Completed'
-                        AND oa.p_value IS NOT NULL
-                        AND s.source = 'Pfizer'
-                        AND (
-                            c.downcase_name like '%{condition.lower()}%'
-                            OR lower(s.brief_title) like '%{condition.lower()}%'     
-                            )
-                        ORDER BY s.nct_id DESC
-                        --LIMIT 1
-                        """
-
-        with conn:
-            with conn.cursor() as curs:
-                curs.execute(query)
-                res = curs.fetchall()
-
-        res_list = []
-        for el in res:
-            res_list.append({"nct_id": el.nct_id, "brief_title": el.brief_title})
-
-        return res_list
+    @classmethod
+    def get_index_stats(cls, conn_str, index_table):
+        """
+        Return: the planner's row estimate and the table and index sizes (in bytes) of the given table,
+        read from the catalog without scanning the table.
+        """
+        with get_engine(conn_str).connect() as conn:
+            table = conn.execute(text(
+                """select c.reltuples::bigint as estimated_rows,
+                          pg_table_size(c.oid) as table_bytes,
+                          pg_indexes_size(c.oid) as indexes_bytes,
+                          pg_total_relation_size(c.oid) as total_bytes
+                   from pg_class c
+                   where c.oid = to_regclass(:table)"""
+            ), {"table": index_table}).one_or_none()
+            if table is None:
+                return {"exists": False, "estimated_rows": 0, "table_bytes": 0, "indexes_bytes": 0,
+                        "total_bytes": 0, "indexes": {}}
+            indexes = conn.execute(text(
+                """select i.indexrelid::regclass::text as name, pg_relation_size(i.indexrelid) as bytes
+                   from pg_index i
+                   where i.indrelid = to_regclass(:table)"""
+            ), {"table": index_table})
+            return {
+                "exists": True,
+                # -1 until the table is first vacuumed or analyzed
+                "estimated_rows": table.estimated_rows if table.estimated_rows >= 0 else None,
+                "table_bytes": table.table_bytes,
+                "indexes_bytes": table.indexes_bytes,
+                "total_bytes": table.total_bytes,
+                "indexes": {row.name: row.bytes for row in indexes},
+            }
 
     def set_chatbot_context(self, nct_id):
         pass
@@ -0,0 +1,163 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    State of one background job: status, per-counter progress and throughput, result or error.
+    The job's function reports progress through advance(), which also raises JobCancelled
+    once cancellation was requested.
+    """
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._counters = {}
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def _counter(self, name):
+        return self._counters.setdefault(name, {"done": 0, "total": None, "started": time.monotonic()})
+
+    def set_stage(self, stage):
+        self.check_cancelled()
+        self.stage = stage
+
+    def set_total(self, name, total):
+        with self._lock:
+            self._counter(name)["total"] = total
+
+    def advance(self, name, n=1):
+        with self._lock:
+            self._counter(name)["done"] += n
+        self.check_cancelled()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled(f"Job {self.id} cancelled")
+
+    def to_dict(self):
+        with self._lock:
+            progress = {}
+            for name, counter in self._counters.items():
+                elapsed = time.monotonic() - counter["started"]
+                progress[name] = {
+                    "done": counter["done"],
+                    "total": counter["total"],
+                    "per_second": round(counter["done"] / elapsed, 2) if elapsed > 0 else None,
+                }
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": progress,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded thread pool. Jobs sharing a lock_key (e.g. the index table they write to)
+    never run at the same time; the most recent max_history jobs are kept for status queries.
+    """
+
+    def __init__(self, max_workers=2, max_history=100):
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, lock_key):
+        with self._lock:
+            return self._key_locks.setdefault(lock_key, threading.Lock())
+
+    def _run(self, job, fn, lock_key):
+        with self._key_lock(lock_key):
+            if job.cancel_requested:
+                job.status = "cancelled"
+                job.finished = time.time()
+                return
+            job.status = "running"
+            job.started = time.time()
+            logger.info(f"Job {job.id} ({job.kind}) started")
+            try:
+                job.result = fn(job)
+                job.status = "completed"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                logger.error(f"Job {job.id} ({job.kind}) failed: {str(e)}")
+                job.error = str(e)
+                job.status = "failed"
+            job.finished = time.time()
+            logger.info(f"Job {job.id} ({job.kind}) {job.status}")
+
+    def submit(self, kind, fn, lock_key=None):
+        """
+        Queues fn(job) for execution.
+        Return: the Job.
+        """
+        job = Job(kind)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_history:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest.status in ("queued", "running"):
+                    break
+                del self._jobs[oldest_id]
+        self._executor.submit(self._run, job, fn, lock_key or kind)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation; a running job stops at its next progress report.
+        Return: the Job, or None if unknown.
+        """
+        job = self.get(job_id)
+        if job is not None and job.status in ("queued", "running"):
+            job.cancel()
+        return job
+
+    def shutdown(self):
+        for job in self.list():
+            job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,3 +1,5 @@
+import asyncio
+import time
 from contextlib import asynccontextmanager
 
 from llama_index.core import Settings
@@ -5,14 +7,28 @@ from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
 from starlette.responses import FileResponse
 
-from chatbot import ChatBot
+from aact import AACTDatabase
+from aact_documents import AACTTrialSource
+from chatbot import ChatBot, reuse_message_embedding
+from condition_index import ConditionIndex
 from config import config
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, Body, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 
-from index_management import IndexManager
-from utils import init_logging, build_query
+from embedding_cache import EmbeddingCache
+from engines import dispose_engines, get_engine
+from index_management import IndexManager, IngestionStats
+from jobs import JobManager
+from metrics import REGISTRY
+from response_cache import CachedResponse, ResponseCache, normalize_query
+from search import TrialSearch, build_filters
+from session_pool import ChatSessionPool, DEFAULT_SESSION_ID
+from single_flight import AsyncSingleFlight, SingleFlight, SingleFlightFull
+from tracing import CHAT_STAGE_SECONDS, HTTP_REQUEST_SECONDS, get_callback_manager, stage_timer, start_request_trace
+from trial_fetcher import TrialFetcher
+from utils import init_logging, build_query, sse_event
 
 load_dotenv()
 
@@ -21,21 +37,111 @@ logger = init_logging(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Initializing models, index and chatbot...")
-    embed_model = OpenAIEmbedding(model="text-embedding-3-large")
-    llm = OpenAI(temperature=0.001, model="gpt-3.5-turbo-0125", max_tokens=512)
+    # set before the index and the chat engines are built, they take the callback manager from Settings
+    callback_manager = get_callback_manager()
+    Settings.callback_manager = callback_manager
+    embed_model = OpenAIEmbedding(model="text-embedding-3-large", callback_manager=callback_manager)
+    llm = OpenAI(temperature=0.001, model="gpt-3.5-turbo-0125", max_tokens=512, callback_manager=callback_manager)
     Settings.llm = llm
     Settings.embed_model = embed_model
+    try:
+        IndexManager.ensure_database(config.connection_str)
+    except Exception as e:
+        logger.warning(f"Could not check or create the vector database: {str(e)}")
     index = ChatBot.get_index(config.connection_str, config.index_table, config.embed_dim)
-    chat_engine = ChatBot.get_chat_engine(index)
-    chat_engine.reset()
-    app.state.chat_engine = chat_engine
+    app.state.chat_sessions = ChatSessionPool(
+        index,
+        max_sessions=config.max_chat_sessions,
+        idle_ttl=config.chat_session_ttl,
+        max_total_tokens=config.chat_sessions_max_tokens
+    )
+    app.state.chat_semaphore = asyncio.Semaphore(config.chat_max_concurrency)
+    # identical concurrent requests share one computation
+    flight_kwargs = dict(max_waiters=config.single_flight_max_waiters, enabled=config.single_flight_enabled)
+    app.state.chat_flight = AsyncSingleFlight("get_response", **flight_kwargs)
+    app.state.condition_flight = AsyncSingleFlight("get_trials_for_condition", **flight_kwargs)
+    app.state.index_flight = SingleFlight("index_stats", **flight_kwargs)
+    app.state.search = TrialSearch(
+        index.vector_store,
+        embed_model,
+        dense_top_k=config.search_dense_top_k,
+        sparse_top_k=config.search_sparse_top_k
+    )
+    app.state.trial_fetcher = TrialFetcher(
+        base_url=config.ctgov_api_url,
+        max_workers=config.fetch_max_workers,
+        rate_limit=config.fetch_rate_limit,
+        max_retries=config.fetch_max_retries
+    )
+    app.state.db_engine = get_engine(config.connection_str)
+    app.state.ingestion_stats = IngestionStats()
+    app.state.condition_index = ConditionIndex(app.state.db_engine, config.condition_index_table)
+    app.state.embedding_cache = None
+    if config.embed_cache_enabled:
+        app.state.embedding_cache = EmbeddingCache(
+            app.state.db_engine,
+            f"embed_cache_{config.index_table}",
+            max_entries=config.embed_cache_max_entries
+        )
+    app.state.response_cache = None
+    if config.response_cache_enabled:
+        # the semantic lookup embeds first-turn questions, which only the adaptive chat engine
+        # retrieves as they are, reusing that embedding; otherwise it would cost a second embedding call
+        semantic = config.chat_adaptive_condense
+        if config.response_cache_similarity_threshold is not None and not semantic:
+            logger.warning("response_cache_similarity_threshold is ignored without chat_adaptive_condense")
+        app.state.response_cache = ResponseCache(
+            max_entries=config.response_cache_max_entries,
+            ttl=config.response_cache_ttl,
+            embed_model=embed_model if semantic else None,
+            similarity_threshold=config.response_cache_similarity_threshold
+        )
+    app.state.aact = AACTDatabase(
+        host=config.aact_host,
+        port=config.aact_port,
+        database=config.aact_db,
+        min_size=config.aact_pool_min_size,
+        max_size=config.aact_pool_max_size,
+        statement_timeout_ms=config.aact_statement_timeout_ms
+    )
+    await app.state.aact.connect()
+    app.state.jobs = JobManager(max_workers=config.ingest_max_workers)
     yield
-    pass
+    app.state.jobs.shutdown()
+    app.state.trial_fetcher.close()
+    await app.state.aact.close()
+    await dispose_engines()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+async def trace_request(request: Request, call_next):
+    """
+    Times the request, labelled with its route template, and adds the Server-Timing header with the
+    stages timed while handling it when enabled. For streaming responses, this covers the time until
+    the headers are sent.
+    """
+    trace = start_request_trace()
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        elapsed,
+        method=request.method,
+        path=route.path if route is not None else "unmatched",
+        status=response.status_code
+    )
+    if config.server_timing_enabled:
+        response.headers["Server-Timing"] = trace.server_timing(elapsed)
+    return response
+
+
+if config.tracing_enabled:
+    app.middleware("http")(trace_request)
+
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to the UMSI Clinical Trials RAG!"}
@@ -46,98 +152,349 @@ async def hello(name: str):
     return JSONResponse(content={"message": f"Hello {name}!"})
 
 
+async def lookup_response_cache(session_id, query, profile):
+    """
+    Only standalone questions, i.e. the first turn of a session, are answered from the response cache.
+    Return: the cache to store the answer in (None if not cacheable), the cached answer and the query embedding.
+    """
+    cache = app.state.response_cache
+    if cache is None or app.state.chat_sessions.has_history(session_id):
+        return None, None, None
+    with stage_timer(CHAT_STAGE_SECONDS, "cache_lookup"):
+        cached, query_embedding = await cache.aget(query, profile)
+    return cache, cached, query_embedding
+
+
 @app.post("/get_response/")
 async def get_response(payload_req: Request):
     payload = await payload_req.json()
     print(payload)
     logger.info(f"Received a POST request, query: {payload['query']}, profile: {payload['profile']}")
+    session_id = payload.get("session_id") or DEFAULT_SESSION_ID
     query = build_query(payload)
-    response = app.state.chat_engine.chat(query)
+    chat_engine = app.state.chat_sessions.get(session_id)
+    cache, cached, query_embedding = await lookup_response_cache(session_id, query, payload["profile"])
+    if cached is not None:
+        app.state.chat_sessions.record_turn(session_id, query, cached.response)
+        return JSONResponse(content={"response": cached.response})
+    index_version = cache.version if cache else None
+
+    async def answer():
+        async with app.state.chat_semaphore:
+            return chat_engine, await asyncio.wait_for(chat_engine.achat(query), timeout=config.chat_timeout)
+
+    try:
+        with reuse_message_embedding(query, query_embedding):
+            if app.state.chat_sessions.has_history(session_id):
+                (_, response), shared = await answer(), False
+            else:
+                # identical standalone questions in flight get the answer of the first one
+                (answering_engine, response), shared = await app.state.chat_flight.do(normalize_query(query),
+                                                                                      answer)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"No response within {config.chat_timeout} seconds")
+    except SingleFlightFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if shared:
+        # requests without a session ID share the default session, whose engine may have answered already
+        if answering_engine is not chat_engine:
+            app.state.chat_sessions.record_turn(session_id, query, response.response)
+        return JSONResponse(content={"response": response.response})
+    app.state.chat_sessions.account(session_id)
+    if cache:
+        cache.put(query, payload["profile"],
+                  CachedResponse(response.response, ChatBot.source_nct_ids(response.source_nodes)),
+                  index_version, query_embedding)
     return JSONResponse(content={"response": response.response})
 
 
+async def run_chat_thread(fn, *args):
+    """
+    Runs a blocking chat engine call in a worker thread, within the chat concurrency limit. The limit is held
+    until the thread is done, also when it outlives the timeout, as it keeps using the LLM until then.
+    Raise: asyncio.TimeoutError after config.chat_timeout seconds.
+    """
+    semaphore = app.state.chat_semaphore
+    await semaphore.acquire()
+    task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+
+    def done(task):
+        semaphore.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Chat engine call failed: {task.exception()}")
+
+    task.add_done_callback(done)
+    return await asyncio.wait_for(asyncio.shield(task), timeout=config.chat_timeout)
+
+
+@app.post("/get_response_stream/")
+async def get_response_stream(payload_req: Request):
+    payload = await payload_req.json()
+    logger.info(f"Received a streaming POST request, query: {payload['query']}, profile: {payload['profile']}")
+    session_id = payload.get("session_id") or DEFAULT_SESSION_ID
+    query = build_query(payload)
+    chat_engine = app.state.chat_sessions.get(session_id)
+    cache, cached, query_embedding = await lookup_response_cache(session_id, query, payload["profile"])
+    if cached is not None:
+        app.state.chat_sessions.record_turn(session_id, query, cached.response)
+
+        async def cached_frames():
+            yield sse_event({"token": cached.response})
+            yield sse_event({"nct_ids": cached.nct_ids}, event="end")
+
+        return StreamingResponse(cached_frames(), media_type="text/event-stream")
+    index_version = cache.version if cache else None
+    # astream_chat of the condense_question engine rejects the async synthesizer's stream,
+    # so stream_chat runs in a worker thread. The concurrency limit covers question condensing,
+    # retrieval and the start of generation, the tokens are then produced by the engine's writer thread.
+    try:
+        with reuse_message_embedding(query, query_embedding):
+            response = await run_chat_thread(chat_engine.stream_chat, query)
+    except asyncio.TimeoutError:
+        # the thread cannot be stopped and would still write the turn to the session's chat history,
+        # the session is dropped so that it writes to an engine no longer in use
+        app.state.chat_sessions.reset(session_id)
+        raise HTTPException(status_code=504, detail=f"No response within {config.chat_timeout} seconds, "
+                                                    f"chat session {session_id} was reset")
+
+    async def frames():
+        try:
+            async for token in iterate_in_threadpool(response.response_gen):
+                yield sse_event({"token": token})
+            nct_ids = ChatBot.source_nct_ids(response.source_nodes)
+            yield sse_event({"nct_ids": nct_ids}, event="end")
+            if cache:
+                cache.put(query, payload["profile"], CachedResponse(response.response, nct_ids),
+                          index_version, query_embedding)
+        except Exception as e:
+            logger.error(f"Error while streaming response: {str(e)}")
+            yield sse_event({"detail": str(e)}, event="error")
+        app.state.chat_sessions.account(session_id)
+
+    return StreamingResponse(frames(), media_type="text/event-stream")
+
+
+@app.post("/search/")
+async def search(payload_req: Request):
+    payload = await payload_req.json()
+    query = (payload.get("query") or "").strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="query is required")
+    top_k = payload.get("top_k", 10)
+    if not isinstance(top_k, int) or not 0 < top_k <= config.search_max_top_k:
+        raise HTTPException(status_code=400, detail=f"top_k must be between 1 and {config.search_max_top_k}")
+    try:
+        filters = build_filters(payload.get("filters") or {})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(f"Received a search request, query: {query}, filters: {payload.get('filters')}")
+    try:
+        results = await app.state.search.search(query, filters=filters, top_k=top_k)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching trials: {str(e)}")
+    return JSONResponse(content={"results": results})
+
+
 @app.get("/reset_chat")
-async def reset_chat():
-    logger.info("Resetting chat bot...")
-    app.state.chat_engine.reset()
+async def reset_chat(session_id: str = DEFAULT_SESSION_ID):
+    logger.info(f"Resetting chat bot for session {session_id}...")
+    app.state.chat_sessions.reset(session_id)
     logger.info("Chat bot reset.")
     return JSONResponse(content={"detail": "chat engine reset"})
 
 
+def invalidate_response_cache():
+    if app.state.response_cache is not None:
+        app.state.response_cache.invalidate()
+
+
+@app.get("/get_response_cache_stats")
+async def get_response_cache_stats():
+    if app.state.response_cache is None:
+        return JSONResponse(content={"detail": "response cache disabled"})
+    return JSONResponse(content=app.state.response_cache.stats())
+
+
+@app.get("/get_chat_sessions_stats")
+async def get_chat_sessions_stats():
+    return JSONResponse(content=app.state.chat_sessions.stats())
+
+
 @app.get("/delete_index")
 async def delete_index():
     try:
         logger.info("Deleting index...")
         IndexManager.delete_index(config.connection_str, f"{config.index_table}")
+        app.state.ingestion_stats.record_truncate()
         logger.info("Index deleted.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting index: {str(e)}")
+    finally:
+        invalidate_response_cache()
     return JSONResponse(content={"detail": "Index deleted"})
 
 
+def index_table_call(name, fn):
+    """
+    Calls fn (an IndexManager class method) on the index table, sharing the result between concurrent callers.
+    """
+    table = f"data_{config.index_table}"
+    result, _ = app.state.index_flight.do((name, table), lambda: fn(config.connection_str, table))
+    return result
+
+
 @app.get("/get_index_length")
 async def get_index_length():
     try:
         logger.info("Getting index length...")
-        idx_len = IndexManager.get_index_length(config.connection_str, f"data_{config.index_table}")
+        idx_len = await asyncio.to_thread(index_table_call, "index_length", IndexManager.get_index_length)
         logger.info(f"Index length: {idx_len}")
+    except SingleFlightFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting index length: {str(e)}")
     return JSONResponse(content={"index_length": f"{idx_len}"})
 
 
-@app.post("/load_trials/")
-async def get_trials(nct_ids: str = Body()):
-    nct_id_list = [nct_id.strip() for nct_id in nct_ids.split(",")]
-    logger.info(f"Getting trials for the given nct_ids list of length: {len(nct_id_list)}...")
+def index_row_count(table_stats=None):
+    """
+    Return: the row count of the index table kept by the loads of this process, or else the planner's estimate,
+    and which of the two it is.
+    """
+    row_count = app.state.ingestion_stats.row_count
+    if row_count is not None:
+        return row_count, "ingestion"
+    table_stats = table_stats or index_table_call("index_stats", IndexManager.get_index_stats)
+    return table_stats["estimated_rows"], "estimate"
+
 
+@app.get("/get_index_stats")
+async def get_index_stats():
     try:
-        index_manager = IndexManager(
-            conn_str=config.connection_str,
-            table_name=config.index_table,
-            embed_dim=config.embed_dim)
-        index_manager.load_trials(nct_id_list)
+        table_stats = await asyncio.to_thread(index_table_call, "index_stats", IndexManager.get_index_stats)
+    except SingleFlightFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error loading trials: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error getting index stats: {str(e)}")
+    row_count, row_count_source = index_row_count(table_stats)
+    ingestion = app.state.ingestion_stats.to_dict()
+    return JSONResponse(content={
+        "table": f"data_{config.index_table}",
+        "row_count": row_count,
+        "row_count_source": row_count_source,
+        **table_stats,
+        "loads": ingestion["loads"],
+        "last_load": ingestion["last_load"],
+    })
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/get_embedding_cache_stats")
+async def get_embedding_cache_stats():
+    if app.state.embedding_cache is None:
+        return JSONResponse(content={"detail": "embedding cache disabled"})
     try:
-        idx_len = IndexManager.get_index_length(config.connection_str, f"data_{config.index_table}")
+        stats = app.state.embedding_cache.stats()
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting index length: {str(e)}")
-    return JSONResponse(content={"index_length": f"{idx_len}"})
+        raise HTTPException(status_code=500, detail=f"Error getting embedding cache stats: {str(e)}")
+    return JSONResponse(content=stats)
+
+
+def get_trial_source(source):
+    """
+    Return: where load jobs read trials from, "ctgov" (ClinicalTrials.gov API, one call per trial)
+    or "aact" (bulk queries on the AACT database).
+    """
+    if source == "ctgov":
+        return app.state.trial_fetcher
+    if source == "aact":
+        return AACTTrialSource(app.state.aact, asyncio.get_running_loop())
+    raise HTTPException(status_code=400, detail=f"Unknown trial source: {source}")
+
+
+def submit_load_job(kind, nct_id_list, incremental, source):
+    """
+    Queues a load of the given trials into the index.
+    Return: the JSON response with the job ID, to poll on /get_job/{job_id}.
+    """
+    index_manager = IndexManager(
+        conn_str=config.connection_str,
+        table_name=config.index_table,
+        embed_dim=config.embed_dim,
+        fetcher=get_trial_source(source),
+        embedding_cache=app.state.embedding_cache,
+        ingestion_stats=app.state.ingestion_stats)
+
+    def load(job):
+        try:
+            index_manager.load_trials(nct_id_list, incremental=incremental, job=job)
+        finally:
+            invalidate_response_cache()
+        row_count, _ = index_row_count()
+        return {"index_length": f"{row_count}"}
+
+    job = app.state.jobs.submit(kind, load, lock_key=config.index_table)
+    logger.info(f"Job {job.id} submitted to load {len(nct_id_list)} trials")
+    return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+
+
+@app.post("/load_trials/")
+async def get_trials(nct_ids: str = Body(), incremental: bool = False, source: str = "ctgov"):
+    nct_id_list = [nct_id.strip() for nct_id in nct_ids.split(",")]
+    logger.info(f"Getting trials for the given nct_ids list of length: {len(nct_id_list)}...")
+    return submit_load_job("load_trials", nct_id_list, incremental, source)
+
 
 @app.get("/load_pfizer_trials/")
-async def get_pfizer_trials():
+async def get_pfizer_trials(incremental: bool = False, source: str = "ctgov"):
     try:
-        index_manager = IndexManager(
-            conn_str=config.connection_str,
-            table_name=config.index_table,
-            embed_dim=config.embed_dim
-        )
         logger.info("Pulling NCT IDs of Pfizer trials from AACT...")
-        pfizer_ncts = index_manager.pull_pfizer_trials()
+        pfizer_ncts = await app.state.aact.pull_pfizer_trials()
         logger.info(f"{len(pfizer_ncts)} trials pulled")
-        logger.info("Storing Pfizer trials into index...")
-        index_manager.load_trials(pfizer_ncts)
-        logger.info("Done")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading trials: {str(e)}")
-    try:
-        idx_len = IndexManager.get_index_length(config.connection_str, f"data_{config.index_table}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting index length: {str(e)}")
-    return JSONResponse(content={"index_length": f"{idx_len}"})
+    logger.info("Storing Pfizer trials into index...")
+    return submit_load_job("load_pfizer_trials", pfizer_ncts, incremental, source)
+
+
+@app.get("/get_jobs")
+async def get_jobs():
+    return JSONResponse(content={"jobs": [job.to_dict() for job in app.state.jobs.list()]})
+
+
+@app.get("/get_job/{job_id}")
+async def get_job(job_id: str):
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return JSONResponse(content=job.to_dict())
+
+
+@app.get("/cancel_job/{job_id}")
+async def cancel_job(job_id: str):
+    job = app.state.jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    logger.info(f"Cancellation of job {job_id} requested")
+    return JSONResponse(content=job.to_dict())
 
 
 @app.get("/get_trials_for_condition/{condition}")
 async def get_trials_for_condition(condition: str):
+    async def lookup():
+        if await asyncio.to_thread(app.state.condition_index.is_empty):
+            logger.info("Condition index is empty, querying AACT...")
+            return await app.state.aact.get_most_recent_trial(condition)
+        return await asyncio.to_thread(app.state.condition_index.lookup, condition)
+
     try:
-        index_manager = IndexManager(
-            conn_str=config.connection_str,
-            table_name=config.index_table,
-            embed_dim=config.embed_dim
-        )
         logger.info(f"Getting most recent Pfizer trial for {condition}...")
-        res = index_manager.get_most_recent_trial(condition)
+        # both lookups are case-insensitive, identical ones in flight share one query
+        res, _ = await app.state.condition_flight.do(condition.lower(), lookup)
         if len(res) == 0:
             logger.info(f"No clinical trials found for {condition}.")
             return JSONResponse(
@@ -148,5 +505,23 @@ async def get_trials_for_condition(condition: str):
         return JSONResponse(
             content={"detail": {"results_found": True, "trials": res}}
         )
+    except SingleFlightFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting most recent trial: {str(e)}")
+
+
+@app.get("/refresh_condition_index")
+async def refresh_condition_index():
+    try:
+        logger.info("Pulling Pfizer trial conditions from AACT...")
+        trials = await app.state.aact.pull_pfizer_trial_conditions()
+        n_trials = await asyncio.to_thread(app.state.condition_index.refresh, trials)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error refreshing condition index: {str(e)}")
+    return JSONResponse(content={"trials": n_trials})
+
+
+@app.get("/get_aact_health")
+async def get_aact_health():
+    return JSONResponse(content={"aact_available": await app.state.aact.ping()})
@@ -0,0 +1,104 @@
+import itertools
+import queue
+import threading
+
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+_END = object()
+_POLL_INTERVAL = 0.1
+
+
+def batched(items, size, key=None):
+    """
+    Yields lists of up to size consecutive items. With a key function, consecutive items with the same key
+    are never split between two lists: more than size of them make a list of their own.
+    """
+    groups = ([item] for item in items) if key is None else (list(group) for _, group in itertools.groupby(items, key))
+    batch = []
+    for group in groups:
+        if batch and len(batch) + len(group) > size:
+            yield batch
+            batch = []
+        batch.extend(group)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class StagePipeline:
+    """
+    Runs a source iterable and a chain of stages, each in its own thread, connected by bounded queues.
+    A stage is a function taking the iterator of its input items and yielding its output items.
+    A full queue blocks the stage feeding it, so at most queue_size items wait between two stages,
+    however long the source is. The first exception raised by a stage stops the whole pipeline and
+    is re-raised by run().
+    """
+
+    def __init__(self, source, stages, queue_size=2, name="pipeline"):
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self.name = name
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, out_queue, item):
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _iter_queue(self, in_queue):
+        while not self._stop.is_set():
+            try:
+                item = in_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def _pump(self, items, out_queue):
+        try:
+            for item in items:
+                if not self._put(out_queue, item):
+                    return
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._put(out_queue, _END)
+
+    def run(self):
+        """
+        Runs the pipeline to completion, the last stage in the calling thread.
+        """
+        threads = []
+        in_queue = queue.Queue(maxsize=self.queue_size)
+        threads.append(threading.Thread(target=self._pump, args=(iter(self.source), in_queue),
+                                        name=f"{self.name}-source", daemon=True))
+        for i, stage in enumerate(self.stages[:-1]):
+            out_queue = queue.Queue(maxsize=self.queue_size)
+            threads.append(threading.Thread(target=self._pump, args=(stage(self._iter_queue(in_queue)), out_queue),
+                                            name=f"{self.name}-stage-{i}", daemon=True))
+            in_queue = out_queue
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in self.stages[-1](self._iter_queue(in_queue)):
+                pass
+        except BaseException as e:
+            self._errors.append(e)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        if self._errors:
+            raise self._errors[0]
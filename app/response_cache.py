@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+
+class CachedResponse:
+
+    def __init__(self, response, nct_ids):
+        self.response = response
+        self.nct_ids = nct_ids
+
+
+class _Entry:
+
+    def __init__(self, profile, value, embedding):
+        self.profile = profile
+        self.value = value
+        self.embedding = embedding
+        self.created = time.monotonic()
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+class ResponseCache:
+    """
+    Caches chatbot answers to standalone questions, keyed on the normalized query, the profile
+    and the index version. Entries expire after ttl seconds, the least recently used ones are dropped
+    above max_entries, and invalidate() drops everything whenever the index changes.
+
+    With an embed_model and a similarity_threshold, a miss on the exact key falls back to the cached
+    answer whose query embedding is the most similar one, if it reaches the threshold. The query is embedded
+    as retrieval embeds it, so that answering a miss can reuse the embedding instead of computing it again.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600, embed_model=None, similarity_threshold=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed_model = embed_model
+        self.similarity_threshold = similarity_threshold
+        self.version = 0
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def semantic(self):
+        return self.embed_model is not None and self.similarity_threshold is not None
+
+    def _key(self, query, profile):
+        return normalize_query(query), profile or "", self.version
+
+    def _expired(self, entry):
+        return time.monotonic() - entry.created > self.ttl
+
+    def _get_exact(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry.value
+
+    @staticmethod
+    def _unit(embedding):
+        embedding = np.array(embedding, dtype=float)
+        return embedding / np.linalg.norm(embedding)
+
+    def _get_similar(self, profile, embedding):
+        best_key, best_score = None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if entry.profile != profile or entry.embedding is None or self._expired(entry):
+                continue
+            score = float(np.dot(entry.embedding, embedding))
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key].value
+
+    async def aget(self, query, profile):
+        """
+        Return: the cached response (or None) and the query embedding computed for the semantic lookup
+        (or None), to be passed back to put() and to retrieval.
+        """
+        profile = profile or ""
+        with self._lock:
+            value = self._get_exact(self._key(query, profile))
+            if value is not None:
+                self.hits += 1
+                return value, None
+        embedding = None
+        if self.semantic:
+            embedding = await self.embed_model.aget_query_embedding(query)
+            with self._lock:
+                value = self._get_similar(profile, self._unit(embedding))
+                if value is not None:
+                    self.semantic_hits += 1
+                    return value, embedding
+        with self._lock:
+            self.misses += 1
+        return None, embedding
+
+    def put(self, query, profile, value, version, embedding=None):
+        """
+        Stores a response computed against the given index version; responses for an older version are dropped.
+        """
+        profile = profile or ""
+        with self._lock:
+            if version != self.version:
+                return
+            key = self._key(query, profile)
+            self._entries[key] = _Entry(profile, value, self._unit(embedding) if embedding is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+        logger.info(f"Response cache invalidated, index version {self.version}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "index_version": self.version,
+            }
@@ -0,0 +1,133 @@
+import asyncio
+import re
+
+from llama_index.core.vector_stores.types import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+)
+
+from utils import init_logging
+from vector_store import TEXT_MATCH_FILTER_KEYS
+
+logger = init_logging(__name__)
+
+NCT_ID_KEY = "National Clinical Identification NCT ID"
+
+# /search filter names -> metadata keys stored by IndexManager._create_llama_docs
+FILTER_KEYS = {
+    "condition": "Condition",
+    "phase": "Phases",
+    "lead_sponsor": "Lead sponsor",
+    "overall_status": "Overall status",
+}
+
+
+def build_filters(filters):
+    """
+    Converts /search filters (name -> value or list of values, any of which matches) into MetadataFilters,
+    all of which must match. Condition and phase match a case-insensitive substring, e.g. "asthma" or
+    "phase3"; lead sponsor and overall status match exact values, e.g. "Pfizer" or "COMPLETED".
+    Return: the MetadataFilters, or None without filters.
+    """
+    metadata_filters = []
+    for name, value in filters.items():
+        if name not in FILTER_KEYS:
+            raise ValueError(f"Unknown filter: {name}, expected one of {', '.join(FILTER_KEYS)}")
+        values = value if isinstance(value, list) else [value]
+        if not values or not all(isinstance(v, str) and v.strip() for v in values):
+            raise ValueError(f"Filter {name} must be a non-empty string or list of strings")
+        values = [v.strip() for v in values]
+        key = FILTER_KEYS[name]
+        if key in TEXT_MATCH_FILTER_KEYS:
+            operator = FilterOperator.TEXT_MATCH
+        else:
+            operator = FilterOperator.IN if len(values) > 1 else FilterOperator.EQ
+        metadata_filters.append(MetadataFilter(key=key, value=values if len(values) > 1 else values[0],
+                                               operator=operator))
+    return MetadataFilters(filters=metadata_filters) if metadata_filters else None
+
+
+def make_snippet(text, query, max_chars=300):
+    """
+    Return: up to max_chars of text around the first occurrence of a query word (of 3 letters or more),
+    or the start of the text if none occurs.
+    """
+    text = " ".join(text.split())
+    lower_text = text.lower()
+    positions = [lower_text.find(word) for word in re.findall(r"\w{3,}", query.lower())]
+    positions = [pos for pos in positions if pos >= 0]
+    start = max(min(positions) - max_chars // 4, 0) if positions else 0
+    snippet = text[start:start + max_chars]
+    return ("..." if start > 0 else "") + snippet + ("..." if start + max_chars < len(text) else "")
+
+
+class TrialSearch:
+    """
+    Retrieval without answer generation: dense and full-text queries run concurrently on the vector store,
+    with metadata filters applied in SQL, and their rankings are merged with reciprocal rank fusion.
+    Chunks are grouped by trial, each trial is scored by its best chunk.
+    """
+
+    def __init__(self, vector_store, embed_model, dense_top_k=20, sparse_top_k=20, rrf_k=60, snippet_chars=300):
+        self.vector_store = vector_store
+        self.embed_model = embed_model
+        self.dense_top_k = dense_top_k
+        self.sparse_top_k = sparse_top_k
+        self.rrf_k = rrf_k
+        self.snippet_chars = snippet_chars
+
+    async def _dense(self, query, filters, top_k):
+        query_embedding = await self.embed_model.aget_query_embedding(query)
+        return await self.vector_store.aquery(VectorStoreQuery(
+            query_embedding=query_embedding,
+            similarity_top_k=top_k,
+            filters=filters,
+            mode=VectorStoreQueryMode.DEFAULT,
+        ))
+
+    async def _sparse(self, query, filters, top_k):
+        return await self.vector_store.aquery(VectorStoreQuery(
+            query_str=query,
+            sparse_top_k=top_k,
+            filters=filters,
+            mode=VectorStoreQueryMode.SPARSE,
+        ))
+
+    async def search(self, query, filters=None, top_k=10):
+        """
+        Return: up to top_k trials as dicts with the NCT ID, the fused score, the dense and full-text scores
+        of its best chunk (None when it was not retrieved that way), its brief title and a snippet.
+        """
+        dense_top_k = max(self.dense_top_k, top_k)
+        sparse_top_k = max(self.sparse_top_k, top_k)
+        dense, sparse = await asyncio.gather(
+            self._dense(query, filters, dense_top_k),
+            self._sparse(query, filters, sparse_top_k),
+        )
+        chunks = {}
+        for kind, result in (("dense", dense), ("sparse", sparse)):
+            for rank, (node, similarity) in enumerate(zip(result.nodes, result.similarities)):
+                chunk = chunks.setdefault(node.node_id, {"node": node, "score": 0.0, "dense": None, "sparse": None})
+                chunk["score"] += 1.0 / (self.rrf_k + rank + 1)
+                chunk[kind] = float(similarity)
+
+        trials = {}
+        for chunk in sorted(chunks.values(), key=lambda c: c["score"], reverse=True):
+            node = chunk["node"]
+            nct_id = node.metadata.get(NCT_ID_KEY) or node.ref_doc_id
+            if nct_id in trials:
+                continue
+            trials[nct_id] = {
+                "nct_id": nct_id,
+                "score": round(chunk["score"], 6),
+                "dense_score": chunk["dense"],
+                "sparse_score": chunk["sparse"],
+                "brief_title": node.metadata.get("Brief title", ""),
+                "snippet": make_snippet(node.get_content(), query, self.snippet_chars),
+            }
+            if len(trials) == top_k:
+                break
+        return list(trials.values())
@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.utils import get_tokenizer
+
+from chatbot import ChatBot
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+DEFAULT_SESSION_ID = "default"
+
+
+class ChatSession:
+
+    def __init__(self, engine, memory):
+        self.engine = engine
+        self.memory = memory
+        self.last_used = time.monotonic()
+        self.tokens = 0
+
+
+class ChatSessionPool:
+    """
+    Keeps one chat engine (and so one chat memory) per session on top of a shared index.
+    Sessions are evicted least recently used first when there are more than max_sessions of them
+    or their chat histories hold more than max_total_tokens in total, and after idle_ttl seconds without use.
+    """
+
+    def __init__(self, index, max_sessions=200, idle_ttl=1800, max_total_tokens=2_000_000,
+                 engine_factory=ChatBot.get_chat_engine):
+        self.index = index
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_total_tokens = max_total_tokens
+        self.engine_factory = engine_factory
+        self._sessions = OrderedDict()
+        self._total_tokens = 0
+        self._lock = threading.Lock()
+        self._tokenizer = get_tokenizer()
+
+    def _drop(self, session_id):
+        session = self._sessions.pop(session_id)
+        self._total_tokens -= session.tokens
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if (len(self._sessions) > self.max_sessions
+                    or self._total_tokens > self.max_total_tokens
+                    or now - session.last_used > self.idle_ttl):
+                self._drop(session_id)
+                logger.info(f"Evicted chat session {session_id}")
+            else:
+                break
+
+    def get(self, session_id=DEFAULT_SESSION_ID):
+        """
+        Return: the chat engine of the session, creating it if needed.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                memory = ChatBot.get_memory()
+                session = ChatSession(self.engine_factory(self.index, memory=memory), memory)
+                self._sessions[session_id] = session
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            self._evict()
+            return session.engine
+
+    def account(self, session_id=DEFAULT_SESSION_ID):
+        """
+        Updates the token count of the session's chat history after a turn, evicting sessions if over budget.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return
+            # RollingSummaryMemory keeps the token counts of its messages
+            tokens = getattr(session.memory, "token_count", None)
+            if tokens is None:
+                tokens = sum(len(self._tokenizer(str(message.content or ""))) for message in session.memory.get_all())
+            self._total_tokens += tokens - session.tokens
+            session.tokens = tokens
+            self._evict()
+
+    def has_history(self, session_id=DEFAULT_SESSION_ID):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session is not None and len(session.memory.get_all()) > 0
+
+    def record_turn(self, session_id, query, response):
+        """
+        Appends a question and its answer to the session's chat history, for answers not produced by its engine.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            session.memory.put(ChatMessage(role=MessageRole.USER, content=query))
+            session.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=response))
+        self.account(session_id)
+
+    def reset(self, session_id=DEFAULT_SESSION_ID):
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "history_tokens": self._total_tokens,
+                "max_history_tokens": self.max_total_tokens,
+            }
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+
+from tracing import SINGLE_FLIGHT
+
+
+class SingleFlightFull(Exception):
+    """
+    Raised when a call would join an in-flight call that already has max_waiters callers.
+    """
+
+
+class _ThreadCall:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 1
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, for blocking calls made from threads: the first caller
+    runs the function, the others wait for it and get its result, or its exception raised again.
+    At most max_waiters callers share one call, SingleFlightFull is raised beyond. With enabled=False,
+    every caller runs the function itself.
+    """
+
+    def __init__(self, name, max_waiters=100, enabled=True):
+        self.name = name
+        self.max_waiters = max_waiters
+        self.enabled = enabled
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Return: the result of fn(), and whether it was shared with (computed by) another caller.
+        """
+        if not self.enabled:
+            return fn(), False
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _ThreadCall()
+                leader = True
+            elif call.waiters >= self.max_waiters:
+                SINGLE_FLIGHT.inc(name=self.name, outcome="rejected")
+                raise SingleFlightFull(f"{call.waiters} identical {self.name} calls already in flight")
+            else:
+                call.waiters += 1
+                leader = False
+        SINGLE_FLIGHT.inc(name=self.name, outcome="leader" if leader else "shared")
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class _AsyncCall:
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop. The shared call runs as its own task, so that it is
+    not cancelled with the caller that started it (e.g. on a timeout of that caller) while others still
+    wait for it; it is cancelled when all its callers are.
+    """
+
+    def __init__(self, name, max_waiters=100, enabled=True):
+        self.name = name
+        self.max_waiters = max_waiters
+        self.enabled = enabled
+        self._calls = {}
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, fn):
+        """
+        Return: the result of await fn(), and whether it was shared with (computed by) another caller.
+        """
+        if not self.enabled:
+            return await fn(), False
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        elif call.waiters >= self.max_waiters:
+            SINGLE_FLIGHT.inc(name=self.name, outcome="rejected")
+            raise SingleFlightFull(f"{call.waiters} identical {self.name} calls already in flight")
+        SINGLE_FLIGHT.inc(name=self.name, outcome="shared" if shared else "leader")
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        except asyncio.CancelledError:
+            if call.waiters == 1:
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
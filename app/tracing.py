@@ -0,0 +1,216 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.utils import get_tokenizer
+
+from config import config
+from metrics import REGISTRY, TOKEN_BUCKETS, Counter, Histogram
+
+CHAT_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "chat_stage_seconds", "Latency of the stages of a chat turn", ["stage"]
+))
+CHAT_LLM_TOKENS = REGISTRY.register(Histogram(
+    "chat_llm_tokens", "Tokens per LLM call of a chat turn", ["stage", "kind"], buckets=TOKEN_BUCKETS
+))
+INGEST_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ingest_stage_seconds", "Latency of the stages of a trial load, per trial (fetch) or per batch", ["stage"]
+))
+INGEST_ITEMS = REGISTRY.register(Counter(
+    "ingest_items_total", "Items processed by the stages of trial loads", ["stage"]
+))
+CHAT_CONTEXT_TOKENS = REGISTRY.register(Histogram(
+    "chat_context_tokens", "Tokens of retrieved context packed into the prompt of a chat turn", buckets=TOKEN_BUCKETS
+))
+CHAT_CONDENSE = REGISTRY.register(Counter(
+    "chat_condense_total", "Chat turns by whether the question was condensed with the chat history "
+    "(condensed) or sent to retrieval as is (no_history, standalone)", ["decision"]
+))
+SINGLE_FLIGHT = REGISTRY.register(Counter(
+    "single_flight_total", "Coalesced calls by whether they ran (leader), got the result of an identical call "
+    "in flight (shared) or were turned away because too many callers waited on it (rejected)", ["name", "outcome"]
+))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_seconds", "Latency of HTTP requests until the response headers", ["method", "path", "status"]
+))
+
+# chat engine events -> stage names; LLM calls are named after where they happen, see StageTimingHandler
+EVENT_STAGES = {
+    CBEventType.QUERY: "query",
+    CBEventType.RETRIEVE: "retrieve",
+    CBEventType.EMBEDDING: "embed_query",
+    CBEventType.SYNTHESIZE: "synthesize",
+    CBEventType.RERANKING: "rerank",
+}
+
+# events that never end (an LLM call that raised) are dropped beyond this many open events
+MAX_OPEN_EVENTS = 10_000
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+# stage of the LLM calls made in the current context outside the chat engine, see llm_stage
+_llm_stage = contextvars.ContextVar("llm_stage", default=None)
+
+
+class RequestTrace:
+    """
+    Stage latencies of one HTTP request, summed per stage, for its Server-Timing header.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self, total_seconds):
+        with self._lock:
+            stages = list(self.stages.items())
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages]
+        entries.append(f"total;dur={total_seconds * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def start_request_trace():
+    """
+    Return: a new trace collecting the stages timed in the current context (and the tasks and threads
+    started from it).
+    """
+    trace = RequestTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+def observe_stage(histogram, stage, seconds):
+    histogram.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def stage_timer(histogram, stage):
+    """
+    Times the enclosed block as the given stage, when tracing is enabled.
+    """
+    if not config.tracing_enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(histogram, stage, time.perf_counter() - start)
+
+
+def timed_iter(items, histogram, stage):
+    """
+    Yields the items, timing how long each one takes to produce as the given stage, when tracing is enabled.
+    """
+    if not config.tracing_enabled:
+        yield from items
+        return
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        observe_stage(histogram, stage, time.perf_counter() - start)
+        yield item
+
+
+@contextmanager
+def llm_stage(stage):
+    """
+    Names the stage of the LLM calls made in the enclosed block, for calls made outside the chat engine
+    (which would otherwise count as the condense stage).
+    """
+    token = _llm_stage.set(stage)
+    try:
+        yield
+    finally:
+        _llm_stage.reset(token)
+
+
+def _token_counts(payload):
+    """
+    Return: (prompt tokens, completion tokens) of an LLM event, from the provider's usage report
+    when there is one, else counted with the default tokenizer.
+    """
+    response = payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION)
+    if response is None:
+        return None
+    usage = getattr(getattr(response, "raw", None), "usage", None)
+    if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+        return usage.prompt_tokens, usage.completion_tokens
+    tokenizer = get_tokenizer()
+    messages = payload.get(EventPayload.MESSAGES)
+    prompt = "\n".join(str(m) for m in messages) if messages else str(payload.get(EventPayload.PROMPT, ""))
+    completion = getattr(getattr(response, "message", None), "content", None) or getattr(response, "text", "")
+    return len(tokenizer(prompt)), len(tokenizer(completion or ""))
+
+
+class StageTimingHandler(BaseCallbackHandler):
+    """
+    LlamaIndex callback handler timing the stages of the chat engine: the condense-question LLM call,
+    retrieval (with the query embedding), synthesis and its LLM calls. LLM calls made outside a query
+    are the condense step.
+    """
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def _stage(self, event_type, parent_id):
+        if event_type != CBEventType.LLM:
+            return EVENT_STAGES.get(event_type)
+        if _llm_stage.get() is not None:
+            return _llm_stage.get()
+        while parent_id in self._events:
+            parent_stage, parent_id, _ = self._events[parent_id]
+            if parent_stage in ("query", "synthesize"):
+                return "synthesize_llm"
+        return "condense"
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        with self._lock:
+            stage = self._stage(event_type, parent_id)
+            if stage is not None:
+                self._events[event_id] = (stage, parent_id, time.perf_counter())
+                while len(self._events) > MAX_OPEN_EVENTS:
+                    del self._events[next(iter(self._events))]
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        with self._lock:
+            event = self._events.pop(event_id, None)
+        if event is None:
+            return
+        stage, _, start = event
+        observe_stage(CHAT_STAGE_SECONDS, stage, time.perf_counter() - start)
+        if event_type == CBEventType.LLM and payload:
+            counts = _token_counts(payload)
+            if counts is not None:
+                CHAT_LLM_TOKENS.observe(counts[0], stage=stage, kind="prompt")
+                CHAT_LLM_TOKENS.observe(counts[1], stage=stage, kind="completion")
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+
+def get_callback_manager():
+    """
+    Return: the callback manager for the LLM, the embedding model and the index, with stage timing
+    when tracing is enabled.
+    """
+    return CallbackManager([StageTimingHandler()] if config.tracing_enabled else [])
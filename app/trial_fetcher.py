@@ -0,0 +1,149 @@
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests as req
+from requests.adapters import HTTPAdapter
+
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """
+    Spaces out calls so that at most `rate` requests per second are started against one host.
+    A rate of 0 (or less) disables limiting.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TrialFetcher:
+    """
+    Downloads clinical trials from the ClinicalTrials.gov v2 API using a shared keep-alive
+    connection pool and a bounded number of worker threads.
+    """
+
+    def __init__(self,
+                 base_url="https://clinicaltrials.gov/api/v2",
+                 max_workers=8,
+                 rate_limit=10.0,
+                 max_retries=5,
+                 backoff_factor=0.5,
+                 timeout=30.0):
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+
+        self.session = req.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def _limiter(self, url):
+        host = urlparse(url).netloc
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = RateLimiter(self.rate_limit)
+            return self._limiters[host]
+
+    def _backoff(self, attempt, response=None):
+        """
+        Return: seconds to wait before the next attempt, honouring a numeric Retry-After header.
+        """
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff_factor * (2 ** attempt)
+
+    def get_trial(self, nct_id):
+        """
+        Return: the JSON data for a clinical trial given its NCT ID, or None if the API does not know it
+        (404, e.g. a withdrawn or mistyped NCT ID).
+        Retries on 429/5xx responses and connection errors with exponential backoff.
+        """
+        url = f"{self.base_url}/studies/{nct_id}"
+        limiter = self._limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (req.ConnectionError, req.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Fetching {nct_id} failed ({e}), retrying in {delay:.2f}s...")
+            else:
+                if response.status_code == 404:
+                    logger.warning(f"{nct_id} not found on ClinicalTrials.gov, skipped")
+                    return None
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response.json()
+                delay = self._backoff(attempt, response)
+                logger.warning(f"Fetching {nct_id} returned {response.status_code}, retrying in {delay:.2f}s...")
+            time.sleep(delay)
+            attempt += 1
+
+    def iter_trials(self, nct_ids, progress=None):
+        """
+        Yields the JSON data for every NCT ID found, in the same order as nct_ids.
+        At most 2 * max_workers downloads are started ahead of the consumer, so a slow consumer
+        holds back the downloads instead of letting results pile up in memory.
+        progress, if given, is called with 1 after each NCT ID, found or not; an exception it raises stops the download.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        window = 2 * self.max_workers
+        try:
+            pending = deque()
+            nct_ids = iter(nct_ids)
+            for nct_id in itertools.islice(nct_ids, window):
+                pending.append(executor.submit(self.get_trial, nct_id))
+            while pending:
+                trial_json = pending.popleft().result()
+                for nct_id in itertools.islice(nct_ids, 1):
+                    pending.append(executor.submit(self.get_trial, nct_id))
+                if progress is not None:
+                    progress(1)
+                if trial_json is not None:
+                    yield trial_json
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def get_trials(self, nct_ids, progress=None):
+        """
+        Return: the JSON data for every NCT ID found, in the same order as nct_ids.
+        progress, if given, is called with 1 after each trial; an exception it raises stops the download.
+        """
+        return list(self.iter_trials(nct_ids, progress=progress))
+
+    def close(self):
+        self.session.close()
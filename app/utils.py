@@ -1,3 +1,6 @@
+import functools
+import hashlib
+import json
 import logging
 import re
 
@@ -20,155 +23,218 @@ def safe_get(d, keys, default=""):
     return d if isinstance(d, str) else str(d)
 
 
-def extract_from_json(clinical_study):
-    # 0. Subset JSON
-    extracted_json = {}
+# Fields extracted from a ClinicalTrials.gov v2 study: (label, path from the study root), in output order.
+# Integer path items index into lists.
+PROTOCOL = "protocolSection"
+RESULTS = "resultsSection"
+IDENTIFICATION = (PROTOCOL, "identificationModule")
+STATUS = (PROTOCOL, "statusModule")
+SPONSOR = (PROTOCOL, "sponsorCollaboratorsModule")
+DESCRIPTION = (PROTOCOL, "descriptionModule")
+CONDITIONS = (PROTOCOL, "conditionsModule")
+DESIGN = (PROTOCOL, "designModule", "designInfo")
+ENROLLMENT = (PROTOCOL, "designModule", "enrollmentInfo")
+ARMS = (PROTOCOL, "armsInterventionsModule", "armGroups")
+INTERVENTIONS = (PROTOCOL, "armsInterventionsModule", "interventions")
+PRIMARY_OUTCOME = (PROTOCOL, "outcomesModule", "primaryOutcomes", 0)
+ELIGIBILITY = (PROTOCOL, "eligibilityModule")
+PARTICIPANT_FLOW = (RESULTS, "participantFlowModule")
+ANALYSES = (RESULTS, "outcomeMeasuresModule", "outcomeMeasures", 0, "analyses")
+
+STUDY_FIELDS = [
+    # 1.1. IDENTIFICATION MODULE
+    ("National Clinical Identification NCT ID", (*IDENTIFICATION, "nctId")),
+    ("Organization study identification", (*IDENTIFICATION, "orgStudyIdInfo", "id")),
+    ("EudraCT number", (*IDENTIFICATION, "secondaryIdInfos", 0, "id")),
+    ("Organization", (*IDENTIFICATION, "organization", "fullName")),
+    ("Organization class", (*IDENTIFICATION, "organization", "class")),
+    ("Brief title", (*IDENTIFICATION, "briefTitle")),
+    ("Official title", (*IDENTIFICATION, "officialTitle")),
+    # 1.2. STATUS MODULE
+    ("Overall status", (*STATUS, "overallStatus")),
+    ("Start date", (*STATUS, "startDateStruct", "date")),
+    ("Primary completion date", (*STATUS, "primaryCompletionDateStruct", "date")),
+    ("Completion date", (*STATUS, "completionDateStruct", "date")),
+    ("Verification date", (*STATUS, "statusVerifiedDate")),
+    ("Study first submitted date", (*STATUS, "studyFirstSubmitDate")),
+    ("Results first submitted date", (*STATUS, "resultsFirstSubmitDate")),
+    ("Last update submitted date", (*STATUS, "lastUpdateSubmitDate")),
+    ("Last update posted date", (*STATUS, "lastUpdatePostDateStruct", "date")),
+    # 1.3. SPONSOR/COLLABORATORS MODULE
+    ("Lead sponsor", (*SPONSOR, "leadSponsor", "name")),
+    ("Lead sponsor class", (*SPONSOR, "leadSponsor", "class")),
+    # 1.4. DESCRIPTION MODULE
+    ("Brief summary", (*DESCRIPTION, "briefSummary")),
+    ("Detailed description", (*DESCRIPTION, "detailedDescription")),
+    # 1.5. CONDITIONS MODULE
+    ("Condition", (*CONDITIONS, "conditions")),
+    ("Conditions keywords", (*CONDITIONS, "keywords")),
+    # 1.6. DESIGN MODULE
+    ("Study type", (PROTOCOL, "designModule", "studyType")),
+    ("Phases", (PROTOCOL, "designModule", "phases")),
+    ("Allocation", (*DESIGN, "allocation")),
+    ("Intervention model", (*DESIGN, "interventionModel")),
+    ("Primary purpose", (*DESIGN, "primaryPurpose")),
+    ("Masking", (*DESIGN, "maskingInfo", "masking")),
+    ("Who is masked", (*DESIGN, "maskingInfo", "whoMasked")),
+    ("Enrollment count", (*ENROLLMENT, "count")),
+    ("Enrollment type", (*ENROLLMENT, "type")),
+    # 1.7. ARMS INTERVENTIONS MODULE
+    ("Arms group 0 label", (*ARMS, 0, "label")),
+    ("Arms group 0 type", (*ARMS, 0, "type")),
+    ("Arms group 0 description", (*ARMS, 0, "description")),
+    ("Arms group 0 intervention names", (*ARMS, 0, "interventionNames")),
+    ("Arms group 1 label", (*ARMS, 1, "label")),
+    ("Arms group 1 type", (*ARMS, 1, "type")),
+    ("Arms group 1 description", (*ARMS, 1, "description")),
+    ("Arms group 1 intervention names", (*ARMS, 1, "interventionNames")),
+    ("Arms group 0 intervention type", (*INTERVENTIONS, 0, "type")),
+    ("Arms group 0 intervention name", (*INTERVENTIONS, 0, "name")),
+    ("Arms group 0 intervention description", (*INTERVENTIONS, 0, "description")),
+    ("Arms group 0 intervention labels", (*INTERVENTIONS, 0, "armGroupLabels")),
+    ("Arms group 1 intervention type", (*INTERVENTIONS, 1, "type")),
+    ("Arms group 1 intervention name", (*INTERVENTIONS, 1, "name")),
+    ("Arms group 1 intervention description", (*INTERVENTIONS, 1, "description")),
+    ("Arms group 1 intervention labels", (*INTERVENTIONS, 1, "armGroupLabels")),
+    # 1.8. OUTCOMES MODULE
+    ("Primary outcome", (*PRIMARY_OUTCOME, "measure")),
+    ("Primary outcome description", (*PRIMARY_OUTCOME, "description")),
+    ("Primary outcome time frame", (*PRIMARY_OUTCOME, "timeFrame")),
+    # 1.9. ELIGIBILITY MODULE
+    ("Eligibility criteria", (*ELIGIBILITY, "eligibilityCriteria")),
+    ("Eligibility of healthy volunteer", (*ELIGIBILITY, "healthyVolunteers")),
+    ("Eligibility sex", (*ELIGIBILITY, "sex")),
+    ("Eligibility minimum age", (*ELIGIBILITY, "minimumAge")),
+    ("Eligibility standard age", (*ELIGIBILITY, "stdAges")),
+    # 2. RESULTS SECTION
+    ("Pre-assignment details", (*PARTICIPANT_FLOW, "preAssignmentDetails")),
+    ("Recruitment details", (*PARTICIPANT_FLOW, "recruitmentDetails")),
+    ("Recruitment group 0 id", (*PARTICIPANT_FLOW, "groups", 0, "id")),
+    ("Recruitment group 0 title", (*PARTICIPANT_FLOW, "groups", 0, "title")),
+    ("Recruitment group 0 description", (*PARTICIPANT_FLOW, "groups", 0, "description")),
+    ("Recruitment group 1 id", (*PARTICIPANT_FLOW, "groups", 1, "id")),
+    ("Recruitment group 1 title", (*PARTICIPANT_FLOW, "groups", 1, "title")),
+    ("Recruitment group 1 description", (*PARTICIPANT_FLOW, "groups", 1, "description")),
+    # 2.1. OUTCOMES MEASURES MODULE
+    ("Group IDs", ANALYSES),
+    ("p-value", (*ANALYSES, 0, "pValue")),
+    ("Statistical Method", (*ANALYSES, 0, "statisticalMethod")),
+    # 2.2. MORE INFO MODULE
+    ("Limitations and caveats", (RESULTS, "moreInfoModule", "limitationsAndCaveats", "description")),
+    # 3 HAS RESULTS SECTION
+    ("Has results", ("hasResults",)),
+]
 
-    # 1. PROTOCOL SECTION
-    protocol_section = clinical_study.get("protocolSection", {})
 
-    # 1.1. IDENTIFICATION MODULE
-    identification_module = protocol_section.get("identificationModule", {})
-    extracted_json.update({
-        "National Clinical Identification NCT ID": safe_get(identification_module, ["nctId"]),
-        "Organization study identification": safe_get(identification_module, ["orgStudyIdInfo", "id"]),
-        "EudraCT number": safe_get(identification_module, ["secondaryIdInfos", 0, "id"], ""),
-        "Organization": safe_get(identification_module, ["organization", "fullName"]),
-        "Organization class": safe_get(identification_module, ["organization", "class"]),
-        "Brief title": safe_get(identification_module, ["briefTitle"]),
-        "Official title": safe_get(identification_module, ["officialTitle"]),
-    })
+# Sections of STUDY_FIELDS, each starting at the given field and running until the next one
+SECTION_STARTS = {
+    "National Clinical Identification NCT ID": "identification",
+    "Study type": "design",
+    "Arms group 0 label": "arms",
+    "Primary outcome": "outcomes",
+    "Eligibility criteria": "eligibility",
+    "Pre-assignment details": "results",
+}
 
-    # 1.2. STATUS MODULE
-    status_module = protocol_section.get("statusModule", {})
-    extracted_json.update({
-        "Overall status": safe_get(status_module, ["overallStatus"]),
-        "Start date": safe_get(status_module, ["startDateStruct", "date"]),
-        "Primary completion date": safe_get(status_module, ["primaryCompletionDateStruct", "date"]),
-        "Completion date": safe_get(status_module, ["completionDateStruct", "date"]),
-        "Verification date": safe_get(status_module, ["statusVerifiedDate"]),
-        "Study first submitted date": safe_get(status_module, ["studyFirstSubmitDate"]),
-        "Results first submitted date": safe_get(status_module, ["resultsFirstSubmitDate"]),
-        "Last update submitted date": safe_get(status_module, ["lastUpdateSubmitDate"]),
-        "Last update posted date": safe_get(status_module, ["lastUpdatePostDateStruct", "date"]),
-    })
 
-    # 1.3. SPONSOR/COLLABORATORS MODULE
-    sponsor_collaborators_module = protocol_section.get("sponsorCollaboratorsModule", {})
-    extracted_json.update({
-        "Lead sponsor": safe_get(sponsor_collaborators_module, ["leadSponsor", "name"]),
-        "Lead sponsor class": safe_get(sponsor_collaborators_module, ["leadSponsor", "class"]),
-    })
+def _field_sections(fields):
+    sections = {}
+    section = None
+    for label, _ in fields:
+        section = SECTION_STARTS.get(label, section)
+        sections[label] = section
+    return sections
 
-    # 1.4. DESCRIPTION MODULE
-    description_module = protocol_section.get("descriptionModule", {})
-    extracted_json.update({
-        "Brief summary": safe_get(description_module, ["briefSummary"]),
-        "Detailed description": safe_get(description_module, ["detailedDescription"]),
-    })
 
-    # 1.5. CONDITIONS MODULE
-    conditions_module = protocol_section.get("conditionsModule", {})
-    extracted_json.update({
-        "Condition": safe_get(conditions_module, ["conditions"]),
-        "Conditions keywords": safe_get(conditions_module, ["keywords"]),
-    })
+FIELD_SECTIONS = _field_sections(STUDY_FIELDS)
 
-    # 1.6. DESIGN MODULE
-    design_module = protocol_section.get("designModule", {})
-    extracted_json.update({
-        "Study type": safe_get(design_module, ["studyType"]),
-        "Phases": safe_get(design_module, ["phases"]),
-        "Allocation": safe_get(design_module, ["designInfo", "allocation"]),
-        "Intervention model": safe_get(design_module, ["designInfo", "interventionModel"]),
-        "Primary purpose": safe_get(design_module, ["designInfo", "primaryPurpose"]),
-        "Masking": safe_get(design_module, ["designInfo", "maskingInfo", "masking"]),
-        "Who is masked": safe_get(design_module, ["designInfo", "maskingInfo", "whoMasked"]),
-        "Enrollment count": safe_get(design_module, ["enrollmentInfo", "count"]),
-        "Enrollment type": safe_get(design_module, ["enrollmentInfo", "type"]),
-    })
 
-    # 1.7. ARMS INTERVENTIONS MODULE
-    arms_interventions_module = protocol_section.get("armsInterventionsModule", {})
-    extracted_json.update({
-        "Arms group 0 label": safe_get(arms_interventions_module, ["armGroups", 0, "label"], ""),
-        "Arms group 0 type": safe_get(arms_interventions_module, ["armGroups", 0, "type"], ""),
-        "Arms group 0 description": safe_get(arms_interventions_module, ["armGroups", 0, "description"], ""),
-        "Arms group 0 intervention names": safe_get(arms_interventions_module, ["armGroups", 0, "interventionNames"],
-                                                    ""),
-        "Arms group 1 label": safe_get(arms_interventions_module, ["armGroups", 1, "label"], ""),
-        "Arms group 1 type": safe_get(arms_interventions_module, ["armGroups", 1, "type"], ""),
-        "Arms group 1 description": safe_get(arms_interventions_module, ["armGroups", 1, "description"], ""),
-        "Arms group 1 intervention names": safe_get(arms_interventions_module, ["armGroups", 1, "interventionNames"],
-                                                    ""),
-        "Arms group 0 intervention type": safe_get(arms_interventions_module, ["interventions", 0, "type"], ""),
-        "Arms group 0 intervention name": safe_get(arms_interventions_module, ["interventions", 0, "name"], ""),
-        "Arms group 0 intervention description": safe_get(arms_interventions_module,
-                                                          ["interventions", 0, "description"], ""),
-        "Arms group 0 intervention labels": safe_get(arms_interventions_module, ["interventions", 0, "armGroupLabels"],
-                                                     ""),
-        "Arms group 1 intervention type": safe_get(arms_interventions_module, ["interventions", 1, "type"], ""),
-        "Arms group 1 intervention name": safe_get(arms_interventions_module, ["interventions", 1, "name"], ""),
-        "Arms group 1 intervention description": safe_get(arms_interventions_module,
-                                                          ["interventions", 1, "description"], ""),
-        "Arms group 1 intervention labels": safe_get(arms_interventions_module, ["interventions", 1, "armGroupLabels"],
-                                                     ""),
-    })
+def split_sections(trial):
+    """
+    Return: a list of (section name, dict of label -> value) of an extracted trial, in STUDY_FIELDS order.
+    Labels that are not STUDY_FIELDS are left out.
+    """
+    sections = {}
+    for label, value in trial.items():
+        section = FIELD_SECTIONS.get(label)
+        if section is not None:
+            sections.setdefault(section, {})[label] = value
+    return list(sections.items())
 
-    # 1.8. OUTCOMES MODULE
-    outcomes_module = clinical_study.get("protocolSection", {}).get("outcomesModule", {})
-    extracted_json.update({
-        "Primary outcome": safe_get(outcomes_module, ["primaryOutcomes", 0, "measure"]),
-        "Primary outcome description": safe_get(outcomes_module, ["primaryOutcomes", 0, "description"]),
-        "Primary outcome time frame": safe_get(outcomes_module, ["primaryOutcomes", 0, "timeFrame"]),
-    })
 
-    # 1.9. ELIGIBILITY MODULE
-    eligibility_module = protocol_section.get("eligibilityModule", {})
-    extracted_json.update({
-        "Eligibility criteria": safe_get(eligibility_module, ["eligibilityCriteria"]),
-        "Eligibility of healthy volunteer": safe_get(eligibility_module, ["healthyVolunteers"]),
-        "Eligibility sex": safe_get(eligibility_module, ["sex"]),
-        "Eligibility minimum age": safe_get(eligibility_module, ["minimumAge"]),
-        "Eligibility standard age": safe_get(eligibility_module, ["stdAges"]),
-    })
+class FieldTrie:
+    """
+    A field table compiled into a trie of path items, so that fields sharing a path prefix
+    (all fields of a module, of an arm group...) walk that prefix once per study.
+    The trie is turned into the source of one straight-line extraction function, compiled once.
+    Extraction gives the same values as calling safe_get for each field: missing values
+    are an empty string and non-string values are converted with str().
+    """
 
-    # 2. RESULTS SECTION
-    results_section = clinical_study.get("resultsSection", {})
-    extracted_json.update({
-        "Pre-assignment details": safe_get(results_section, ["participantFlowModule", "preAssignmentDetails"]),
-        "Recruitment details": safe_get(results_section, ["participantFlowModule", "recruitmentDetails"]),
-        "Recruitment group 0 id": safe_get(results_section, ["participantFlowModule", "groups", 0, "id"], ""),
-        "Recruitment group 0 title": safe_get(results_section, ["participantFlowModule", "groups", 0, "title"], ""),
-        "Recruitment group 0 description": safe_get(results_section,
-                                                    ["participantFlowModule", "groups", 0, "description"], ""),
-        "Recruitment group 1 id": safe_get(results_section, ["participantFlowModule", "groups", 1, "id"], ""),
-        "Recruitment group 1 title": safe_get(results_section, ["participantFlowModule", "groups", 1, "title"], ""),
-        "Recruitment group 1 description": safe_get(results_section,
-                                                    ["participantFlowModule", "groups", 1, "description"], ""),
-    })
+    def __init__(self):
+        self.labels = []
+        self.children = {}
+
+    @classmethod
+    def build(cls, fields):
+        root = cls()
+        for label, path in fields:
+            node = root
+            for key in path:
+                node = node.children.setdefault(key, cls())
+            node.labels.append(label)
+        return root
+
+    def _source(self, var, depth, lines, indent):
+        pad = "    " * indent
+        if self.labels:
+            lines.append(f"{pad}value = {var} if isinstance({var}, str) else str({var})")
+            lines.extend(f"{pad}extracted[{label!r}] = value" for label in self.labels)
+        if not self.children:
+            return
+        child_var = f"v{depth + 1}"
+        lines.append(f"{pad}if isinstance({var}, dict):")
+        for key, child in self.children.items():
+            lines.append(f"{pad}    if {key!r} in {var}:")
+            lines.append(f"{pad}        {child_var} = {var}[{key!r}]")
+            child._source(child_var, depth + 1, lines, indent + 2)
+        positions = [(key, child) for key, child in self.children.items() if isinstance(key, int)]
+        if positions:
+            lines.append(f"{pad}elif isinstance({var}, list):")
+            for key, child in positions:
+                lines.append(f"{pad}    if len({var}) > {key}:")
+                lines.append(f"{pad}        {child_var} = {var}[{key}]")
+                child._source(child_var, depth + 1, lines, indent + 2)
+
+    @classmethod
+    def compile(cls, fields):
+        """
+        Return: a function data -> dict of label -> string, with the labels in the order of fields.
+        """
+        lines = ["def extract(v0):", "    extracted = template.copy()"]
+        cls.build(fields)._source("v0", 0, lines, 1)
+        lines.append("    return extracted")
+        namespace = {"template": dict.fromkeys([label for label, _ in fields], "")}
+        exec(compile("\n".join(lines), "<field trie>", "exec"), namespace)
+        return namespace["extract"]
+
+
+_extract_study_fields = FieldTrie.compile(STUDY_FIELDS)
 
-    # 2.1. OUTCOMES MEASURES MODULE
-    extracted_json.update({
-        "Group IDs": safe_get(results_section, ["outcomeMeasuresModule", "outcomeMeasures", 0, "analyses"]),
-        "p-value": safe_get(results_section, ["outcomeMeasuresModule", "outcomeMeasures", 0, "analyses", 0, "pValue"]),
-        "Statistical Method": safe_get(results_section, ["outcomeMeasuresModule", "outcomeMeasures", 0, "analyses", 0,
-                                                         "statisticalMethod"]),
-    })
 
-    # 2.2. MORE INFO MODULE
-    more_info_module = results_section.get("moreInfoModule", {})
-    extracted_json.update({
-        "Limitations and caveats": safe_get(more_info_module, ["limitationsAndCaveats", "description"], ""),
-    })
+def extract_from_json(clinical_study):
+    """
+    Return: the STUDY_FIELDS subset of a ClinicalTrials.gov v2 study, as a dict of label -> string.
+    """
+    return _extract_study_fields(clinical_study)
 
-    # 3 HAS RESULTS SECTION
-    has_results_section = clinical_study.get("hasResults", {})
-    extracted_json.update({
-        "Has results": safe_get(clinical_study, ["hasResults"], ""),
-    })
 
-    return extracted_json
+def extract_from_json_batch(clinical_studies):
+    """
+    Return: extract_from_json for each study, in order.
+    """
+    extract = _extract_study_fields
+    return [extract(clinical_study) for clinical_study in clinical_studies]
 
 
 def flatten_dict(data, parent_key='', sep=' '):
@@ -231,6 +297,73 @@ def format_flattened_dict(flat_dict):
     return ",\n".join(lines)
 
 
+def _clean_text(text):
+    """
+    Same as replace_double_newline. Runs of newlines are collapsed with repeated str.replace,
+    each pass at least halves every run, which is faster than the regex on long criteria text.
+    """
+    while "\n\n" in text:
+        text = text.replace("\n\n", "\n")
+    if ";" in text:
+        text = text.replace(";", "&")
+    return text
+
+
+@functools.lru_cache(maxsize=4096)
+def _key_prefix(key):
+    # For list elements, remove the numerical index from the key
+    formatted_key = key.rsplit(' ', 1)[0] if key[-1].isdigit() else key
+    return f'"{_clean_text(formatted_key)}": '
+
+
+def _iter_flattened(data, parent_key='', sep=' '):
+    """
+    Yields the (key, value) pairs of flatten_dict(data) in order, without building intermediate dicts.
+    """
+    if isinstance(data, dict):
+        for key, value in data.items():
+            new_key = f"{parent_key}{sep}{key}" if parent_key else key
+            if isinstance(value, (dict, list)):
+                yield from _iter_flattened(value, new_key, sep)
+            else:
+                yield new_key, value
+    elif isinstance(data, list):
+        for i, element in enumerate(data):
+            yield from _iter_flattened(element, f"{parent_key}{sep if parent_key else ''}{i}", sep)
+    else:
+        yield parent_key, data
+
+
+def serialize_flattened(data):
+    """
+    Single-pass equivalent of format_flattened_dict(flatten_dict(data)): walks data once and writes
+    the lines into one buffer. Assumes flattened keys are unique, which holds for trial documents
+    (flatten_dict would keep only the last value of a repeated key).
+
+    Return: the formatted text of data.
+    """
+    parts = []
+    append = parts.append
+    for key, value in _iter_flattened(data):
+        if parts:
+            append(",\n")
+        append(_key_prefix(key))
+        if isinstance(value, str):
+            append('"')
+            append(_clean_text(value))
+            append('"')
+        else:
+            append(_clean_text(str(value)))
+    return "".join(parts)
+
+
+def content_hash(extracted_json):
+    """
+    Return: a stable hash of an extracted trial, used to detect changed trials between loads.
+    """
+    return hashlib.sha256(json.dumps(extracted_json, sort_keys=True).encode("utf-8")).hexdigest()
+
+
 def init_logging(name):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
@@ -252,3 +385,28 @@ def build_query(request):
     if profile == "General":
         return f"{request['query']}. Explain that in a simple language."
     return f"{request['query']}. Explain that to a {profile}"
+
+
+_PROFILE_INSTRUCTION = re.compile(r"\. Explain that (?:in a simple language\.|to a .*)$", re.DOTALL)
+
+
+def strip_profile_instruction(query):
+    """
+    Return: the user's question of a query built by build_query, without the instruction added for the profile.
+    """
+    return _PROFILE_INSTRUCTION.sub("", query)
+
+
+def escape_like(value):
+    """
+    Return: value with the LIKE wildcards (% and _) and the backslash escaped, for patterns with escape '\\'.
+    """
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def sse_event(data, event=None):
+    """
+    Formats a JSON-serializable payload as a server-sent event.
+    """
+    frame = f"event: {event}\n" if event else ""
+    return f"{frame}data: {json.dumps(data)}\n\n"
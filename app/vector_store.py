@@ -0,0 +1,266 @@
+from llama_index.core.vector_stores.types import FilterCondition, FilterOperator, MetadataFilter
+from llama_index.vector_stores.postgres import PGVectorStore
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Float, and_, cast, func, literal, literal_column, or_, select, text
+from sqlalchemy import make_url
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from config import config
+from engines import get_async_engine, get_engine
+from utils import init_logging
+
+logger = init_logging(__name__)
+
+# pgvector limits on the dimension of an indexed halfvec and on hnsw.ef_search
+HALFVEC_MAX_INDEXED_DIM = 4000
+HNSW_MAX_EF_SEARCH = 1000
+
+# Metadata fields filtered inside SQL, with the operator they support. List fields are stored as the text
+# of a Python list (e.g. "['PHASE2', 'PHASE3']") and match a case-insensitive substring through a trigram
+# index; the others match exact values through a GIN index on the metadata as jsonb.
+TEXT_MATCH_FILTER_KEYS = ("Condition", "Phases")
+EXACT_FILTER_KEYS = ("Lead sponsor", "Overall status")
+
+
+class HalfVector(Vector):
+    """
+    pgvector halfvec column type (half-precision floats, pgvector 0.7+).
+    """
+
+    def get_col_spec(self, **kw):
+        if self.dim is None:
+            return "HALFVEC"
+        return "HALFVEC(%d)" % self.dim
+
+
+class PooledPGVectorStore(PGVectorStore):
+    """
+    PGVectorStore using the process-wide connection pools of engines.py instead of creating its own.
+
+    Metadata filters on TEXT_MATCH_FILTER_KEYS (TEXT_MATCH) and EXACT_FILTER_KEYS (EQ, IN) are compiled
+    into clauses served by the metadata indexes of the table, with bound values. Any other filter falls
+    back to PGVectorStore's filtering.
+    """
+
+    @classmethod
+    def class_name(cls):
+        return "PooledPGVectorStore"
+
+    def _connect(self):
+        self._engine = get_engine(self.connection_string)
+        self._session = sessionmaker(self._engine)
+        self._async_engine = get_async_engine(self.async_connection_string)
+        self._async_session = sessionmaker(self._async_engine, class_=AsyncSession)
+
+    def text_search_indexes(self):
+        """
+        Return: a dict of index name -> create statement for the full-text index of hybrid stores,
+        named and defined as PGVectorStore creates it with the table.
+        """
+        if not self.hybrid_search:
+            return {}
+        return {f"{self.table_name}_idx": (f"create index if not exists {self.table_name}_idx "
+                                           f"on {self.schema_name}.data_{self.table_name} using gin (text_search_tsv)")}
+
+    def metadata_indexes(self):
+        """
+        Return: a dict of index name -> create statement for the indexes serving metadata filters.
+        """
+        table = f"{self.schema_name}.data_{self.table_name}"
+        indexes = {
+            f"data_{self.table_name}_metadata_idx": (f"create index if not exists data_{self.table_name}_metadata_idx "
+                                                     f"on {table} using gin ((metadata_::jsonb) jsonb_path_ops)")
+        }
+        for key in TEXT_MATCH_FILTER_KEYS:
+            name = f"data_{self.table_name}_{key.lower().replace(' ', '_')}_trgm_idx"
+            indexes[name] = (f"create index if not exists {name} on {table} "
+                             f"using gin (lower(metadata_->>'{key}') gin_trgm_ops)")
+        return indexes
+
+    def _create_extension(self):
+        super()._create_extension()
+        with self._session() as session, session.begin():
+            session.execute(text("create extension if not exists pg_trgm"))
+
+    def _create_tables_if_not_exists(self):
+        super()._create_tables_if_not_exists()
+        # PGVectorStore only creates the full-text index with the table: it is created here too, in case
+        # a full reload dropped it (see BulkVectorWriter) and the process died before rebuilding it
+        with self._session() as session, session.begin():
+            for sql in {**self.text_search_indexes(), **self.metadata_indexes()}.values():
+                session.execute(text(sql))
+
+    @staticmethod
+    def _is_indexed_filter(filter_):
+        if not isinstance(filter_, MetadataFilter):
+            return False
+        if filter_.key in TEXT_MATCH_FILTER_KEYS:
+            return filter_.operator == FilterOperator.TEXT_MATCH
+        return filter_.key in EXACT_FILTER_KEYS and filter_.operator in (FilterOperator.EQ, FilterOperator.IN)
+
+    def _filter_clause(self, filter_):
+        # keys are literals (not bound) so that the expressions match the indexed ones
+        metadata = self._table_class.metadata_
+        values = filter_.value if isinstance(filter_.value, list) else [filter_.value]
+        if filter_.key in TEXT_MATCH_FILTER_KEYS:
+            field = func.lower(metadata.op("->>")(literal_column(f"'{filter_.key}'")))
+            return or_(*(field.contains(str(value).lower(), autoescape=True) for value in values))
+        return or_(*(cast(metadata, JSONB).op("@>")(literal({filter_.key: value}, JSONB)) for value in values))
+
+    def _apply_filters_and_limit(self, stmt, limit, metadata_filters=None):
+        if not metadata_filters or not all(self._is_indexed_filter(f) for f in metadata_filters.filters):
+            return super()._apply_filters_and_limit(stmt, limit, metadata_filters)
+        combine = or_ if metadata_filters.condition == FilterCondition.OR else and_
+        return stmt.where(combine(*(self._filter_clause(f) for f in metadata_filters.filters))).limit(limit)
+
+    async def close(self):
+        # the pools are shared, engines.dispose_engines() closes them at shutdown
+        pass
+
+
+class ANNVectorStore(PooledPGVectorStore):
+    """
+    PGVectorStore whose dense retrieval goes through an HNSW index instead of an exact scan.
+
+    The table keeps the full-precision embeddings. The HNSW index is built on an expression:
+    the first ann_dim dimensions cast to halfvec. For text-embedding-3 models this is a Matryoshka
+    truncation, and ann_dim equal to embed_dim is a plain halfvec index. With rerank_factor > 1,
+    the index returns rerank_factor * top_k candidates, which are re-ranked by their exact
+    full-precision cosine distance.
+    """
+
+    ann_dim: int = 1024
+    rerank_factor: int = 4
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 64
+    hnsw_ef_search: int = 100
+
+    @classmethod
+    def class_name(cls):
+        return "ANNVectorStore"
+
+    @classmethod
+    def from_params(cls, ann_dim=1024, rerank_factor=4, hnsw_m=16, hnsw_ef_construction=64, hnsw_ef_search=100,
+                    **kwargs):
+        store = super().from_params(**kwargs)
+        if not 0 < ann_dim <= min(store.embed_dim, HALFVEC_MAX_INDEXED_DIM):
+            raise ValueError(f"ann_dim must be between 1 and {min(store.embed_dim, HALFVEC_MAX_INDEXED_DIM)}")
+        store.ann_dim = ann_dim
+        store.rerank_factor = rerank_factor
+        store.hnsw_m = hnsw_m
+        store.hnsw_ef_construction = hnsw_ef_construction
+        store.hnsw_ef_search = hnsw_ef_search
+        return store
+
+    @property
+    def ann_index_name(self):
+        return f"data_{self.table_name}_hnsw_{self.ann_dim}_idx"
+
+    def _ann_column(self):
+        # must stay identical to the indexed expression for the planner to use the index
+        return cast(
+            func.subvector(self._table_class.embedding, literal_column("1"), literal_column(str(self.ann_dim))),
+            HalfVector(self.ann_dim)
+        )
+
+    def ann_index_sql(self):
+        return (f"create index if not exists {self.ann_index_name} on {self.schema_name}.data_{self.table_name} "
+                f"using hnsw ((subvector(embedding, 1, {self.ann_dim})::halfvec({self.ann_dim})) halfvec_cosine_ops) "
+                f"with (m = {self.hnsw_m}, ef_construction = {self.hnsw_ef_construction})")
+
+    def _create_tables_if_not_exists(self):
+        super()._create_tables_if_not_exists()
+        with self._session() as session, session.begin():
+            session.execute(text(self.ann_index_sql()))
+        logger.info(f"HNSW index {self.ann_index_name} ready")
+
+    def _build_query(self, embedding, limit=10, metadata_filters=None):
+        if embedding is None:
+            return super()._build_query(embedding, limit, metadata_filters)
+        table = self._table_class
+        ann_distance = self._ann_column().op("<=>", return_type=Float)(
+            cast(literal(embedding[:self.ann_dim], HalfVector(self.ann_dim)), HalfVector(self.ann_dim))
+        )
+        if self.rerank_factor <= 1:
+            stmt = select(
+                table.id,
+                table.node_id,
+                table.text,
+                table.metadata_,
+                ann_distance.label("distance"),
+            ).order_by(text("distance asc"))
+            return self._apply_filters_and_limit(stmt, limit, metadata_filters)
+
+        candidates = select(
+            table.id,
+            table.node_id,
+            table.text,
+            table.metadata_,
+            table.embedding,
+        ).order_by(ann_distance)
+        candidates = self._apply_filters_and_limit(candidates, limit * self.rerank_factor, metadata_filters).subquery()
+        return select(
+            candidates.c.id,
+            candidates.c.node_id,
+            candidates.c.text,
+            candidates.c.metadata_,
+            candidates.c.embedding.cosine_distance(embedding).label("distance"),
+        ).order_by(text("distance asc")).limit(limit)
+
+    def _ef_search(self, limit):
+        # the index returns at most ef_search candidates, keep it above the number requested
+        return min(max(self.hnsw_ef_search, limit * max(self.rerank_factor, 1)), HNSW_MAX_EF_SEARCH)
+
+    def _query_with_score(self, embedding, limit=10, metadata_filters=None, **kwargs):
+        kwargs.setdefault("hnsw_ef_search", self._ef_search(limit))
+        return super()._query_with_score(embedding, limit, metadata_filters, **kwargs)
+
+    async def _aquery_with_score(self, embedding, limit=10, metadata_filters=None, **kwargs):
+        kwargs.setdefault("hnsw_ef_search", self._ef_search(limit))
+        return await super()._aquery_with_score(embedding, limit, metadata_filters, **kwargs)
+
+
+def secondary_indexes(store):
+    """
+    Return: a dict of index name -> create statement for the indexes of a vector store table
+    other than its primary key: the full-text GIN index of hybrid stores, the metadata filter indexes
+    and the HNSW index of ANN stores.
+    """
+    indexes = {}
+    if isinstance(store, PooledPGVectorStore):
+        indexes.update(store.text_search_indexes())
+        indexes.update(store.metadata_indexes())
+    if isinstance(store, ANNVectorStore):
+        indexes[store.ann_index_name] = store.ann_index_sql()
+    return indexes
+
+
+def get_vector_store(conn_str, table_name, embed_dim, ann=None):
+    """
+    Return: the hybrid (dense + full-text) vector store of an index table, with HNSW-indexed
+    dense retrieval when ann (default config.vector_ann_enabled) is set.
+    """
+    url = make_url(conn_str)
+    params = dict(
+        database=url.database,
+        host=url.host,
+        password=url.password,
+        port=url.port,
+        user=url.username,
+        table_name=table_name,
+        embed_dim=embed_dim,  # openai embedding dimension
+        hybrid_search=True,
+        text_search_config="english"
+    )
+    if config.vector_ann_enabled if ann is None else ann:
+        return ANNVectorStore.from_params(
+            ann_dim=config.vector_ann_dim,
+            rerank_factor=config.vector_ann_rerank_factor,
+            hnsw_m=config.vector_hnsw_m,
+            hnsw_ef_construction=config.vector_hnsw_ef_construction,
+            hnsw_ef_search=config.vector_hnsw_ef_search,
+            **params
+        )
+    return PooledPGVectorStore.from_params(**params)
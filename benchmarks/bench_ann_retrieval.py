@@ -0,0 +1,149 @@
+"""
+Recall and latency benchmark of HNSW-indexed retrieval (vector_store.ANNVectorStore) against the
+exact sequential scan of PGVectorStore.
+
+Needs a Postgres database with pgvector 0.7+ (e.g. the pgvector/pgvector:pg16 image from the README).
+The corpus is written to a scratch table, either synthetic embeddings whose variance decays over the
+dimensions (like Matryoshka-trained embeddings) or a copy of the embeddings of an existing index
+table (--source-table). Queries are corpus embeddings with added noise.
+
+Run from the repo root:
+    python benchmarks/bench_ann_retrieval.py --rows 10000 --ann-dims 256,512,1024,3072 --rerank-factors 1,4
+    python benchmarks/bench_ann_retrieval.py --source-table clinical_rag_hybrid_search
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import sqlalchemy as db  # noqa: E402
+from llama_index.core.schema import TextNode  # noqa: E402
+from llama_index.core.vector_stores.types import VectorStoreQuery  # noqa: E402
+from llama_index.vector_stores.postgres import PGVectorStore  # noqa: E402
+from pgvector.sqlalchemy import from_db  # noqa: E402
+from sqlalchemy import make_url  # noqa: E402
+
+from config import config  # noqa: E402
+from vector_store import ANNVectorStore  # noqa: E402
+
+
+def store_params(conn_str, table_name, embed_dim):
+    url = make_url(conn_str)
+    return dict(database=url.database, host=url.host, password=url.password, port=url.port, user=url.username,
+                table_name=table_name, embed_dim=embed_dim)
+
+
+def synthetic_corpus(n_rows, dim, rng):
+    scale = 1.0 / np.sqrt(1.0 + np.arange(dim) / 64.0)
+    vectors = rng.standard_normal((n_rows, dim)) * scale
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def source_corpus(conn_str, source_table, n_rows):
+    engine = db.create_engine(conn_str)
+    with engine.connect() as conn:
+        res = conn.execute(db.text(f"select embedding from data_{source_table} limit :n"), {"n": n_rows})
+        vectors = np.array([from_db(row.embedding) for row in res])
+    engine.dispose()
+    return vectors
+
+
+def make_queries(corpus, n_queries, noise, rng):
+    picked = corpus[rng.choice(len(corpus), size=n_queries, replace=False)]
+    queries = picked + rng.standard_normal(picked.shape) * noise / np.sqrt(corpus.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def write_corpus(store, corpus, batch_size=500):
+    nodes = [TextNode(id_=f"node-{i}", text=f"node {i}", embedding=vector.tolist()) for i, vector in enumerate(corpus)]
+    for i in range(0, len(nodes), batch_size):
+        store.add(nodes[i:i + batch_size])
+
+
+def run_queries(store, queries, top_k):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        res = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k))
+        latencies.append(time.perf_counter() - start)
+        results.append(res.ids)
+    return results, latencies
+
+
+def summarize(name, results, latencies, exact, top_k, extra=None):
+    recall = np.mean([len(set(res) & set(ref)) / top_k for res, ref in zip(results, exact)])
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "mode": name,
+        f"recall@{top_k}": round(float(recall), 4),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 2),
+        **(extra or {}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connection-str", default=config.connection_str)
+    parser.add_argument("--table", default="bench_ann")
+    parser.add_argument("--source-table", help="copy the embeddings of this index table instead of synthetic ones")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--dim", type=int, default=config.embed_dim)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--ann-dims", default="256,512,1024,3072")
+    parser.add_argument("--rerank-factors", default="1,4")
+    parser.add_argument("--ef-search", type=int, default=config.vector_hnsw_ef_search)
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch table")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.source_table:
+        corpus = source_corpus(args.connection_str, args.source_table, args.rows)
+    else:
+        corpus = synthetic_corpus(args.rows, args.dim, rng)
+    dim = corpus.shape[1]
+    queries = make_queries(corpus, args.queries, args.noise, rng)
+
+    params = store_params(args.connection_str, args.table, dim)
+    exact_store = PGVectorStore.from_params(**params)
+    exact_store._initialize()
+    with exact_store._session() as session, session.begin():
+        session.execute(db.text(f"truncate table data_{args.table}"))
+    start = time.perf_counter()
+    write_corpus(exact_store, corpus)
+    print(f"wrote {len(corpus)} x {dim} embeddings in {time.perf_counter() - start:.1f}s")
+
+    exact, latencies = run_queries(exact_store, queries, args.top_k)
+    rows = [summarize("exact scan", exact, latencies, exact, args.top_k)]
+    for ann_dim in [int(d) for d in args.ann_dims.split(",") if int(d) <= dim]:
+        for rerank_factor in [int(f) for f in args.rerank_factors.split(",")]:
+            store = ANNVectorStore.from_params(ann_dim=ann_dim, rerank_factor=rerank_factor,
+                                               hnsw_ef_search=args.ef_search, **params)
+            start = time.perf_counter()
+            store._initialize()  # builds the HNSW index for this ann_dim the first time
+            build_s = round(time.perf_counter() - start, 2)
+            results, latencies = run_queries(store, queries, args.top_k)
+            rows.append(summarize(f"hnsw halfvec({ann_dim}) rerank x{rerank_factor}", results, latencies, exact,
+                                  args.top_k, {"index_build_s": build_s}))
+
+    for row in rows:
+        print("  ".join(f"{key}={value}" for key, value in row.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"rows": len(corpus), "dim": dim, "queries": args.queries, "results": rows}, f, indent=2)
+
+    if not args.keep:
+        with exact_store._session() as session, session.begin():
+            session.execute(db.text(f"drop table data_{args.table}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Write throughput of the vector table: PGVectorStore.add() (one ORM insert per row) against
+bulk_writer.BulkVectorWriter (binary COPY, with and without deferred index maintenance).
+
+Needs a Postgres database with pgvector (see the README). Rows are written to a scratch hybrid table
+that is dropped at the end.
+
+Run from the repo root:
+    python benchmarks/bench_bulk_write.py --rows 5000 --batch-size 256
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import sqlalchemy as db  # noqa: E402
+from llama_index.core.schema import TextNode  # noqa: E402
+
+from bulk_writer import BulkVectorWriter  # noqa: E402
+from config import config  # noqa: E402
+from pipeline import batched  # noqa: E402
+from vector_store import get_vector_store  # noqa: E402
+
+
+def make_nodes(n_rows, dim, words, rng):
+    embeddings = rng.standard_normal((n_rows, dim)).astype(np.float32)
+    return [
+        TextNode(
+            id_=f"node-{i}",
+            text=" ".join(f"word{j}" for j in rng.integers(0, 5000, size=words)),
+            metadata={"National Clinical Identification NCT ID": f"NCT{i:08d}"},
+            embedding=embeddings[i].tolist(),
+        )
+        for i in range(n_rows)
+    ]
+
+
+def truncate(engine, table):
+    with engine.begin() as conn:
+        conn.execute(db.text(f"truncate table data_{table}"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connection-str", default=config.connection_str)
+    parser.add_argument("--table", default="bench_bulk_write")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=config.embed_dim)
+    parser.add_argument("--words", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=config.write_batch_size)
+    args = parser.parse_args()
+
+    nodes = make_nodes(args.rows, args.dim, args.words, np.random.default_rng(0))
+    engine = db.create_engine(args.connection_str)
+    store = get_vector_store(args.connection_str, args.table, args.dim, ann=config.vector_ann_enabled)
+    store._initialize()
+    try:
+        results = {}
+
+        truncate(engine, args.table)
+        start = time.perf_counter()
+        for batch in batched(nodes, args.batch_size):
+            store.add(batch)
+        results["PGVectorStore.add"] = args.rows / (time.perf_counter() - start)
+
+        for defer_indexes in (False, True):
+            truncate(engine, args.table)
+            start = time.perf_counter()
+            writer = BulkVectorWriter(engine, store, defer_indexes=defer_indexes)
+            writer.begin()
+            for batch in batched(nodes, args.batch_size):
+                writer.write(batch)
+            writer.finish()
+            name = "COPY, deferred indexes" if defer_indexes else "COPY"
+            results[name] = args.rows / (time.perf_counter() - start)
+
+        with engine.connect() as conn:
+            n_rows = conn.execute(db.text(f"select count(*) from data_{args.table}")).scalar()
+        assert n_rows == args.rows, f"expected {args.rows} rows, found {n_rows}"
+
+        baseline = results["PGVectorStore.add"]
+        for name, rows_per_second in results.items():
+            print(f"{name:<24} {rows_per_second:8.0f} rows/s  ({rows_per_second / baseline:.1f}x)")
+    finally:
+        with engine.begin() as conn:
+            conn.execute(db.text(f"drop table if exists data_{args.table}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Offline benchmark of the retrieved context put into chat prompts.
+
+Builds an in-memory index of synthetic trials with FakeEmbedding, once with fixed 8190-token chunks
+(CHUNK_STRATEGY=fixed, retrieved at top 3 as before) and once with section chunks
+(CHUNK_STRATEGY=sections, retrieved at --top-k and packed by ContextBudgetPacker into --budget tokens),
+and reports the context tokens per question as the LLM sees them, metadata headers included.
+
+Run from the repo root:
+    python benchmarks/bench_context_packing.py --trials 200 --questions 50 --budget 3000
+"""
+import argparse
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "offline")
+
+from llama_index.core import Settings, VectorStoreIndex  # noqa: E402
+from llama_index.core.schema import MetadataMode  # noqa: E402
+
+from bench_extraction import synthetic_study  # noqa: E402
+from config import config  # noqa: E402
+from context_packer import ContextBudgetPacker, count_tokens  # noqa: E402
+from fake_models import FakeEmbedding  # noqa: E402
+from index_management import CONTENT_HASH_KEY, IndexManager, llm_keys_to_include  # noqa: E402
+from utils import STUDY_FIELDS, extract_from_json_batch  # noqa: E402
+
+QUESTIONS = [
+    "What are the eligibility criteria of the trials on {}?",
+    "What were the primary outcomes of the trials on {}?",
+    "Which interventions are tested for {}?",
+    "Are there phase 3 trials on {} still recruiting?",
+]
+
+
+def make_nodes(index_manager, docs, strategy):
+    config.chunk_strategy = strategy
+    return index_manager._create_nodes(docs)
+
+
+def context_tokens(nodes, questions, top_k, postprocessors):
+    retriever = VectorStoreIndex(nodes=nodes).as_retriever(similarity_top_k=top_k)
+    tokens = []
+    for question in questions:
+        retrieved = retriever.retrieve(question)
+        for postprocessor in postprocessors:
+            retrieved = postprocessor.postprocess_nodes(retrieved)
+        tokens.append(sum(count_tokens(n.node.get_content(metadata_mode=MetadataMode.LLM)) for n in retrieved))
+    return np.array(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=config.chat_similarity_top_k)
+    parser.add_argument("--budget", type=int, default=config.context_token_budget)
+    parser.add_argument("--embed-dim", type=int, default=64)
+    args = parser.parse_args()
+
+    Settings.embed_model = FakeEmbedding(embed_dim=args.embed_dim)
+    rng = random.Random(0)
+    trials = extract_from_json_batch([synthetic_study(i, rng) for i in range(args.trials)])
+    index_manager = IndexManager(config.connection_str, "bench_context_packing", args.embed_dim)
+    excluded_keys = index_manager._adjust_metadata_keys(
+        [label for label, _ in STUDY_FIELDS] + [CONTENT_HASH_KEY], llm_keys_to_include
+    )
+    docs = index_manager._create_llama_docs(trials, excluded_keys, excluded_keys)
+    questions = [rng.choice(QUESTIONS).format(f"word{rng.randrange(1000)}") for _ in range(args.questions)]
+
+    runs = {
+        "fixed, top 3": ("fixed", 3, []),
+        f"sections, top {args.top_k}, budget {args.budget}":
+            ("sections", args.top_k, [ContextBudgetPacker(token_budget=args.budget)]),
+    }
+    for name, (strategy, top_k, postprocessors) in runs.items():
+        nodes = make_nodes(index_manager, docs, strategy)
+        tokens = context_tokens(nodes, questions, top_k, postprocessors)
+        print(f"{name}: {len(nodes)} nodes, context tokens per question "
+              f"mean={tokens.mean():.0f} p50={np.percentile(tokens, 50):.0f} max={tokens.max()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Offline benchmark of trial field extraction.
+
+Compares the old per-field extraction (one safe_get walk from the study root for every field of
+utils.STUDY_FIELDS) with the compiled field trie behind utils.extract_from_json_batch, and checks
+that both give identical output.
+
+The corpus is a directory of recorded ClinicalTrials.gov v2 study JSON files (one study per file),
+e.g. saved from https://clinicaltrials.gov/api/v2/studies/<NCT ID>. Without --corpus, synthetic
+studies with the same structure are used.
+
+Run from the repo root:
+    python benchmarks/bench_extraction.py --corpus path/to/studies --repeat 5
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from utils import STUDY_FIELDS, extract_from_json_batch, safe_get  # noqa: E402
+
+
+def load_corpus(directory):
+    studies = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            studies.append(json.load(f))
+    return studies
+
+
+def synthetic_study(i, rng):
+    def text(n_words):
+        return " ".join(f"word{rng.randrange(1000)}" for _ in range(n_words))
+
+    n_arms = rng.randrange(1, 4)
+    return {
+        "protocolSection": {
+            "identificationModule": {
+                "nctId": f"NCT{i:08d}",
+                "orgStudyIdInfo": {"id": f"B{i:07d}"},
+                "secondaryIdInfos": [{"id": f"2020-{i:06d}-00", "type": "EUDRACT_NUMBER"}],
+                "organization": {"fullName": "Pfizer", "class": "INDUSTRY"},
+                "briefTitle": text(10),
+                "officialTitle": text(25),
+            },
+            "statusModule": {
+                "statusVerifiedDate": "2023-05",
+                "overallStatus": "COMPLETED",
+                "startDateStruct": {"date": "2019-01-15", "type": "ACTUAL"},
+                "primaryCompletionDateStruct": {"date": "2021-03-01", "type": "ACTUAL"},
+                "completionDateStruct": {"date": "2021-06-01", "type": "ACTUAL"},
+                "studyFirstSubmitDate": "2018-11-02",
+                "resultsFirstSubmitDate": "2022-02-10",
+                "lastUpdateSubmitDate": "2023-05-12",
+                "lastUpdatePostDateStruct": {"date": "2023-05-16", "type": "ACTUAL"},
+            },
+            "sponsorCollaboratorsModule": {"leadSponsor": {"name": "Pfizer", "class": "INDUSTRY"}},
+            "descriptionModule": {"briefSummary": text(80), "detailedDescription": text(300)},
+            "conditionsModule": {"conditions": [text(2) for _ in range(3)], "keywords": [text(1) for _ in range(4)]},
+            "designModule": {
+                "studyType": "INTERVENTIONAL",
+                "phases": ["PHASE3"],
+                "designInfo": {
+                    "allocation": "RANDOMIZED",
+                    "interventionModel": "PARALLEL",
+                    "primaryPurpose": "TREATMENT",
+                    "maskingInfo": {"masking": "DOUBLE", "whoMasked": ["PARTICIPANT", "INVESTIGATOR"]},
+                },
+                "enrollmentInfo": {"count": rng.randrange(50, 3000), "type": "ACTUAL"},
+            },
+            "armsInterventionsModule": {
+                "armGroups": [
+                    {"label": text(3), "type": "EXPERIMENTAL", "description": text(30), "interventionNames": [text(2)]}
+                    for _ in range(n_arms)
+                ],
+                "interventions": [
+                    {"type": "DRUG", "name": text(2), "description": text(20), "armGroupLabels": [text(3)]}
+                    for _ in range(n_arms)
+                ],
+            },
+            "outcomesModule": {
+                "primaryOutcomes": [{"measure": text(12), "description": text(40), "timeFrame": "Week 12"}],
+            },
+            "eligibilityModule": {
+                "eligibilityCriteria": text(400),
+                "healthyVolunteers": False,
+                "sex": "ALL",
+                "minimumAge": "18 Years",
+                "stdAges": ["ADULT", "OLDER_ADULT"],
+            },
+        },
+        "resultsSection": {
+            "participantFlowModule": {
+                "preAssignmentDetails": text(30),
+                "recruitmentDetails": text(30),
+                "groups": [{"id": f"FG{g:03d}", "title": text(3), "description": text(20)} for g in range(n_arms)],
+            },
+            "outcomeMeasuresModule": {
+                "outcomeMeasures": [{
+                    "analyses": [{"groupIds": ["OG000", "OG001"], "pValue": "<0.001",
+                                  "statisticalMethod": "ANCOVA"}],
+                }],
+            },
+            "moreInfoModule": {"limitationsAndCaveats": {"description": text(20)}},
+        },
+        "hasResults": True,
+    }
+
+
+def per_field_extraction(studies):
+    return [{label: safe_get(study, path) for label, path in STUDY_FIELDS} for study in studies]
+
+
+def best_of(fn, studies, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(studies)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="directory of recorded study JSON files")
+    parser.add_argument("--studies", type=int, default=2000, help="number of synthetic studies without --corpus")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.corpus:
+        studies = load_corpus(args.corpus)
+    else:
+        rng = random.Random(0)
+        studies = [synthetic_study(i, rng) for i in range(args.studies)]
+
+    per_field_time, expected = best_of(per_field_extraction, studies, args.repeat)
+    trie_time, extracted = best_of(extract_from_json_batch, studies, args.repeat)
+    assert extracted == expected, "compiled extraction differs from per-field extraction"
+    assert all(list(e) == list(x) for e, x in zip(expected, extracted)), "field order differs"
+
+    print(f"studies:           {len(studies)}, fields: {len(STUDY_FIELDS)}")
+    print(f"per-field walks:   {per_field_time * 1000:.1f}ms ({per_field_time / len(studies) * 1e6:.1f}us/study)")
+    print(f"compiled trie:     {trie_time * 1000:.1f}ms ({trie_time / len(studies) * 1e6:.1f}us/study)")
+    print(f"speed-up:          {per_field_time / trie_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
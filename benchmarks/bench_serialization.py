@@ -0,0 +1,85 @@
+"""
+Offline benchmark of trial document text serialization.
+
+Compares format_flattened_dict(flatten_dict(trial)) with the single-pass utils.serialize_flattened
+on large extracted trials (long eligibility criteria and descriptions with blank lines and
+semicolons), and checks that both give identical text. Nested documents are checked too.
+
+Run from the repo root:
+    python benchmarks/bench_serialization.py --trials 500 --criteria-words 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from utils import STUDY_FIELDS, flatten_dict, format_flattened_dict, serialize_flattened  # noqa: E402
+
+
+def long_text(n_words, rng):
+    words = []
+    for i in range(n_words):
+        words.append(f"word{rng.randrange(1000)}")
+        if i % 40 == 39:
+            words.append(rng.choice([";", "\n\n", "\n\n\n", "\n"]))
+    return " ".join(words)
+
+
+def make_trial(i, criteria_words, rng):
+    trial = {label: f"value {i} {label}" for label, _ in STUDY_FIELDS}
+    trial["National Clinical Identification NCT ID"] = f"NCT{i:08d}"
+    trial["Eligibility criteria"] = long_text(criteria_words, rng)
+    trial["Detailed description"] = long_text(criteria_words // 4, rng)
+    trial["Brief summary"] = long_text(criteria_words // 10, rng)
+    return trial
+
+
+def make_nested(i, rng):
+    return {
+        "nct id": f"NCT{i:08d}",
+        "phase 3": True,
+        "count": rng.randrange(1000),
+        "arms": [{"label": long_text(20, rng), "names": ["a; b", "c\n\nd"]} for _ in range(3)],
+        "scores": [1.5, None, [2, 3]],
+        "design": {"info": {"masking": "DOUBLE", "who": []}, "empty": {}},
+    }
+
+
+def best_of(fn, trials, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = [fn(trial) for trial in trials]
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=500)
+    parser.add_argument("--criteria-words", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    nested = [make_nested(i, rng) for i in range(100)]
+    assert [serialize_flattened(d) for d in nested] == [format_flattened_dict(flatten_dict(d)) for d in nested], \
+        "single-pass serialization differs on nested documents"
+
+    trials = [make_trial(i, args.criteria_words, rng) for i in range(args.trials)]
+    two_pass_time, expected = best_of(lambda trial: format_flattened_dict(flatten_dict(trial)), trials, args.repeat)
+    single_pass_time, texts = best_of(serialize_flattened, trials, args.repeat)
+    assert texts == expected, "single-pass serialization differs from flatten_dict + format_flattened_dict"
+
+    size_mb = sum(len(text) for text in texts) / 1e6
+    print(f"trials:        {len(trials)} ({size_mb:.1f}M characters of output)")
+    print(f"two-pass:      {two_pass_time * 1000:.1f}ms")
+    print(f"single-pass:   {single_pass_time * 1000:.1f}ms")
+    print(f"speed-up:      {two_pass_time / single_pass_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
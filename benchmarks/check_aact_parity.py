@@ -0,0 +1,205 @@
+"""
+Checks that a trial loaded from AACT (aact_documents.build_study) yields the same document text, and so the
+same content hash, as the same trial fetched from the ClinicalTrials.gov v2 API. Otherwise switching the
+load source of incremental loads between ctgov and aact would re-embed every unchanged trial.
+
+The fixture is one trial as the API returns it (fields in API order) and as rows of the AACT tables
+queried by aact_documents.STUDY_QUERIES. Exits with status 1 and prints the differing fields on mismatch.
+
+Run from the repo root:
+    python benchmarks/check_aact_parity.py
+"""
+import datetime
+import os
+import sys
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from aact_documents import build_study  # noqa: E402
+from utils import content_hash, extract_from_json, serialize_flattened  # noqa: E402
+
+NCT_ID = "NCT01234567"
+
+CTGOV_STUDY = {
+    "protocolSection": {
+        "identificationModule": {
+            "nctId": NCT_ID,
+            "orgStudyIdInfo": {"id": "B1234001"},
+            "secondaryIdInfos": [{"id": "2011-001234-56"}],
+            "organization": {"fullName": "Pfizer", "class": "INDUSTRY"},
+            "briefTitle": "A Study of Drug X in Adults With Asthma",
+            "officialTitle": "A Phase 3, Randomized, Double-Blind Study of Drug X in Adults With Asthma",
+        },
+        "statusModule": {
+            "statusVerifiedDate": "2015-06",
+            "overallStatus": "COMPLETED",
+            "startDateStruct": {"date": "2012-01"},
+            "primaryCompletionDateStruct": {"date": "2013-11"},
+            "completionDateStruct": {"date": "2014-02"},
+            "studyFirstSubmitDate": "2011-11-02",
+            "resultsFirstSubmitDate": "2015-01-20",
+            "lastUpdateSubmitDate": "2015-06-10",
+            "lastUpdatePostDateStruct": {"date": "2015-06-12"},
+        },
+        "sponsorCollaboratorsModule": {"leadSponsor": {"name": "Pfizer", "class": "INDUSTRY"}},
+        "descriptionModule": {
+            "briefSummary": "The purpose of this study is to evaluate drug X; in adults.",
+            "detailedDescription": "Participants are randomized 1:1.\n\nTreatment lasts 12 weeks.",
+        },
+        "conditionsModule": {"conditions": ["Asthma"], "keywords": ["asthma", "inhaler"]},
+        "designModule": {
+            "studyType": "INTERVENTIONAL",
+            "phases": ["PHASE3"],
+            "designInfo": {
+                "allocation": "RANDOMIZED",
+                "interventionModel": "PARALLEL",
+                "primaryPurpose": "TREATMENT",
+                "maskingInfo": {"masking": "DOUBLE", "whoMasked": ["PARTICIPANT", "INVESTIGATOR"]},
+            },
+            "enrollmentInfo": {"count": 412, "type": "ACTUAL"},
+        },
+        "armsInterventionsModule": {
+            "armGroups": [
+                {"label": "Drug X", "type": "EXPERIMENTAL", "description": "Drug X 10 mg daily",
+                 "interventionNames": ["Drug: Drug X"]},
+                {"label": "Placebo", "type": "PLACEBO_COMPARATOR", "description": "Matching placebo",
+                 "interventionNames": ["Drug: Placebo"]},
+            ],
+            "interventions": [
+                {"type": "DRUG", "name": "Drug X", "description": "10 mg tablet", "armGroupLabels": ["Drug X"]},
+                {"type": "DRUG", "name": "Placebo", "description": "Matching tablet", "armGroupLabels": ["Placebo"]},
+            ],
+        },
+        "outcomesModule": {
+            "primaryOutcomes": [{"measure": "Change From Baseline in FEV1",
+                                 "description": "Forced expiratory volume in 1 second", "timeFrame": "Week 12"}],
+        },
+        "eligibilityModule": {
+            "eligibilityCriteria": "Inclusion Criteria:\n\n* Age 18 or older\n\nExclusion Criteria:\n\n* Smokers",
+            "healthyVolunteers": False,
+            "sex": "ALL",
+            "minimumAge": "18 Years",
+            "stdAges": ["ADULT", "OLDER_ADULT"],
+        },
+    },
+    "resultsSection": {
+        "participantFlowModule": {
+            "preAssignmentDetails": "Run-in period of 2 weeks.",
+            "recruitmentDetails": "Recruited at 40 sites.",
+            "groups": [
+                {"id": "FG000", "title": "Drug X", "description": "Drug X 10 mg daily"},
+                {"id": "FG001", "title": "Placebo", "description": "Matching placebo"},
+            ],
+        },
+        "outcomeMeasuresModule": {
+            "outcomeMeasures": [{
+                "analyses": [{
+                    "groupIds": ["OG000", "OG001"],
+                    "groupDescription": "Superiority of drug X over placebo",
+                    "nonInferiorityType": "SUPERIORITY",
+                    "pValue": "<0.00001",
+                    "pValueComment": "Two-sided",
+                    "statisticalMethod": "ANCOVA",
+                    "statisticalComment": "Adjusted for baseline FEV1",
+                    "paramType": "Mean Difference (Final Values)",
+                    "paramValue": "0.12",
+                    "ciPctValue": "95",
+                    "ciNumSides": "TWO_SIDED",
+                    "ciLowerLimit": "0.05",
+                    "ciUpperLimit": "0.19",
+                    "dispersionType": "STANDARD_ERROR_OF_MEAN",
+                    "dispersionValue": "0.035",
+                    "estimateComment": "Drug X minus placebo",
+                }],
+            }],
+        },
+        "moreInfoModule": {"limitationsAndCaveats": {"description": "Early termination of one site."}},
+    },
+    "hasResults": True,
+}
+
+AACT_ROWS = {
+    "studies": [{
+        "nct_id": NCT_ID, "brief_title": "A Study of Drug X in Adults With Asthma",
+        "official_title": "A Phase 3, Randomized, Double-Blind Study of Drug X in Adults With Asthma",
+        "overall_status": "Completed", "start_month_year": "2012-01", "primary_completion_month_year": "2013-11",
+        "completion_month_year": "2014-02", "verification_month_year": "2015-06",
+        "study_first_submitted_date": datetime.date(2011, 11, 2),
+        "results_first_submitted_date": datetime.date(2015, 1, 20),
+        "last_update_submitted_date": datetime.date(2015, 6, 10),
+        "last_update_posted_date": datetime.date(2015, 6, 12),
+        "study_type": "Interventional", "phase": "Phase 3", "enrollment": 412, "enrollment_type": "Actual",
+        "source": "Pfizer", "source_class": "Industry", "limitations_and_caveats": "Early termination of one site.",
+    }],
+    "id_information": [
+        {"nct_id": NCT_ID, "id_source": "org_study_id", "id_value": "B1234001"},
+        {"nct_id": NCT_ID, "id_source": "secondary_id", "id_value": "2011-001234-56"},
+    ],
+    "sponsors": [{"nct_id": NCT_ID, "name": "Pfizer", "agency_class": "Industry"}],
+    "brief_summaries": [{"nct_id": NCT_ID,
+                         "description": "The purpose of this study is to evaluate drug X; in adults."}],
+    "detailed_descriptions": [{"nct_id": NCT_ID,
+                               "description": "Participants are randomized 1:1.\n\nTreatment lasts 12 weeks."}],
+    "conditions": [{"nct_id": NCT_ID, "name": "Asthma"}],
+    "keywords": [{"nct_id": NCT_ID, "name": "asthma"}, {"nct_id": NCT_ID, "name": "inhaler"}],
+    "designs": [{
+        "nct_id": NCT_ID, "allocation": "Randomized", "intervention_model": "Parallel Assignment",
+        "primary_purpose": "Treatment", "masking": "Double", "subject_masked": True, "caregiver_masked": None,
+        "investigator_masked": True, "outcomes_assessor_masked": None,
+    }],
+    "design_groups": [
+        {"nct_id": NCT_ID, "title": "Drug X", "group_type": "Experimental", "description": "Drug X 10 mg daily",
+         "intervention_names": ["Drug: Drug X"]},
+        {"nct_id": NCT_ID, "title": "Placebo", "group_type": "Placebo Comparator", "description": "Matching placebo",
+         "intervention_names": ["Drug: Placebo"]},
+    ],
+    "interventions": [
+        {"nct_id": NCT_ID, "intervention_type": "Drug", "name": "Drug X", "description": "10 mg tablet",
+         "arm_group_labels": ["Drug X"]},
+        {"nct_id": NCT_ID, "intervention_type": "Drug", "name": "Placebo", "description": "Matching tablet",
+         "arm_group_labels": ["Placebo"]},
+    ],
+    "design_outcomes": [{"nct_id": NCT_ID, "measure": "Change From Baseline in FEV1",
+                         "description": "Forced expiratory volume in 1 second", "time_frame": "Week 12"}],
+    "eligibilities": [{
+        "nct_id": NCT_ID,
+        "criteria": "Inclusion Criteria:\n\n* Age 18 or older\n\nExclusion Criteria:\n\n* Smokers",
+        "healthy_volunteers": "No", "gender": "All", "minimum_age": "18 Years", "adult": True, "child": False,
+        "older_adult": True,
+    }],
+    "participant_flows": [{"nct_id": NCT_ID, "recruitment_details": "Recruited at 40 sites.",
+                           "pre_assignment_details": "Run-in period of 2 weeks."}],
+    "result_groups": [
+        {"nct_id": NCT_ID, "ctgov_group_code": "FG000", "title": "Drug X", "description": "Drug X 10 mg daily"},
+        {"nct_id": NCT_ID, "ctgov_group_code": "FG001", "title": "Placebo", "description": "Matching placebo"},
+    ],
+    "outcome_analyses": [{
+        "nct_id": NCT_ID, "outcome_id": 1, "groups_description": "Superiority of drug X over placebo",
+        "non_inferiority_type": "Superiority", "non_inferiority_description": None, "p_value_modifier": "<",
+        "p_value": Decimal("0.00001"), "p_value_description": "Two-sided", "method": "ANCOVA",
+        "method_description": "Adjusted for baseline FEV1", "param_type": "Mean Difference (Final Values)",
+        "param_value": Decimal("0.12"), "ci_percent": Decimal("95"), "ci_n_sides": "2-Sided",
+        "ci_lower_limit": Decimal("0.05"), "ci_upper_limit": Decimal("0.19"), "ci_upper_limit_na_comment": None,
+        "dispersion_type": "Standard Error of the Mean", "dispersion_value": Decimal("0.035"),
+        "estimate_description": "Drug X minus placebo", "other_analysis_description": None,
+        "group_ids": ["OG000", "OG001"],
+    }],
+}
+
+
+def main():
+    ctgov = extract_from_json(CTGOV_STUDY)
+    aact = extract_from_json(build_study(NCT_ID, AACT_ROWS))
+    differences = [label for label in ctgov if ctgov[label] != aact.get(label)]
+    for label in differences:
+        print(f"{label}:\n  ctgov: {ctgov[label]!r}\n  aact:  {aact.get(label)!r}")
+    same_text = serialize_flattened(ctgov) == serialize_flattened(aact)
+    same_hash = content_hash(ctgov) == content_hash(aact)
+    print(f"document text identical: {same_text}, content hash identical: {same_hash}")
+    if differences or not same_text or not same_hash:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import time
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.llms.generic_utils import completion_response_to_chat_response
+from llama_index.core.base.llms.types import CompletionResponse, LLMMetadata
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+
+
+class FakeEmbedding(BaseEmbedding):
+    """
+    Deterministic, offline stand-in for OpenAIEmbedding.
+    Every call sleeps for `latency` seconds plus `per_item_latency` seconds per text,
+    mimicking one HTTP round trip to the embedding provider.
+    """
+
+    embed_dim: int = Field(default=3072, description="Dimension of the returned vectors.")
+    latency: float = Field(default=0.0, description="Seconds spent per request.")
+    per_item_latency: float = Field(default=0.0, description="Seconds spent per embedded text.")
+    calls: int = Field(default=0, description="Number of requests made so far.")
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("model_name", "fake-embedding")
+        kwargs.setdefault("embed_batch_size", 100)
+        super().__init__(**kwargs)
+
+    @classmethod
+    def class_name(cls):
+        return "FakeEmbedding"
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.embed_dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _embed(self, texts):
+        self.calls += 1
+        time.sleep(self.latency + self.per_item_latency * len(texts))
+        return [self._vector(text) for text in texts]
+
+    async def _aembed(self, texts):
+        self.calls += 1
+        await asyncio.sleep(self.latency + self.per_item_latency * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def _get_query_embedding(self, query):
+        return self._embed([query])[0]
+
+    async def _aget_query_embedding(self, query):
+        return (await self._aembed([query]))[0]
+
+    def _get_text_embedding(self, text):
+        return self._embed([text])[0]
+
+    async def _aget_text_embedding(self, text):
+        return (await self._aembed([text]))[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._embed(texts)
+
+    async def _aget_text_embeddings(self, texts):
+        return await self._aembed(texts)
+
+
+class FakeLLM(CustomLLM):
+    """
+    Deterministic, offline stand-in for the OpenAI LLM.
+    Every completion waits `latency` seconds before the first token and `token_latency`
+    seconds between streamed tokens; the async methods wait without blocking the event loop.
+    """
+
+    response: str = Field(default="This is a fake answer about the clinical trial.",
+                          description="Text returned by every completion.")
+    latency: float = Field(default=0.0, description="Seconds before the first token.")
+    token_latency: float = Field(default=0.0, description="Seconds between streamed tokens.")
+    calls: int = Field(default=0, description="Number of completions made so far.")
+
+    @classmethod
+    def class_name(cls):
+        return "FakeLLM"
+
+    @property
+    def metadata(self):
+        return LLMMetadata(context_window=16385, num_output=512, model_name="fake-llm")
+
+    def _tokens(self):
+        words = self.response.split(" ")
+        return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+    @llm_completion_callback()
+    def complete(self, prompt, formatted=False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency + self.token_latency * len(self._tokens()))
+        return CompletionResponse(text=self.response)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt, formatted=False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+
+        def gen():
+            text = ""
+            for token in self._tokens():
+                time.sleep(self.token_latency)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    @llm_chat_callback()
+    async def achat(self, messages, **kwargs):
+        completion_response = await self.acomplete(self.messages_to_prompt(messages), formatted=True, **kwargs)
+        return completion_response_to_chat_response(completion_response)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt, formatted=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency + self.token_latency * len(self._tokens()))
+        return CompletionResponse(text=self.response)
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt, formatted=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+        async def gen():
+            text = ""
+            for token in self._tokens():
+                await asyncio.sleep(self.token_latency)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
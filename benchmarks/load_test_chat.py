@@ -0,0 +1,99 @@
+"""
+Offline load test of /get_response/ with a fake LLM and fake embeddings.
+
+Sends N concurrent requests to the FastAPI app in-process and compares them with the
+old handler, which called the synchronous chat_engine.chat() inside the event loop.
+
+Run from the repo root:
+    python benchmarks/load_test_chat.py --users 16 --latency 0.2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "offline")
+
+import httpx  # noqa: E402
+from llama_index.core import Settings, VectorStoreIndex  # noqa: E402
+from llama_index.core.schema import TextNode  # noqa: E402
+
+import main  # noqa: E402
+from chatbot import ChatBot  # noqa: E402
+from fake_models import FakeEmbedding, FakeLLM  # noqa: E402
+from session_pool import ChatSessionPool  # noqa: E402
+from single_flight import AsyncSingleFlight  # noqa: E402
+
+
+def make_index(n_trials):
+    nodes = [
+        TextNode(id_=f"NCT{i:08d}", text=f"Trial NCT{i:08d} studies condition {i % 17} with drug {i % 5}.")
+        for i in range(n_trials)
+    ]
+    return VectorStoreIndex(nodes=nodes)
+
+
+def engine_factory(index, memory=None):
+    # the in-memory vector store does not support hybrid queries
+    query_engine = index.as_query_engine(similarity_top_k=3)
+    return ChatBot.make_chat_engine(query_engine, memory or ChatBot.get_memory())
+
+
+async def blocking_handler(pool, session_id, query):
+    return pool.get(session_id).chat(query)
+
+
+async def run_blocking(pool, users):
+    start = time.perf_counter()
+    await asyncio.gather(*(blocking_handler(pool, f"user{i}", "What are the outcomes?") for i in range(users)))
+    return time.perf_counter() - start
+
+
+async def run_endpoint(users):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(
+            client.post("/get_response/", json={"query": "What are the outcomes?", "profile": "",
+                                                "session_id": f"user{i}"}, timeout=None)
+            for i in range(users)
+        ))
+        elapsed = time.perf_counter() - start
+    assert all(r.status_code == 200 for r in responses), [r.text for r in responses if r.status_code != 200]
+    return elapsed
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per LLM completion")
+    parser.add_argument("--trials", type=int, default=50)
+    args = parser.parse_args()
+
+    Settings.embed_model = FakeEmbedding(embed_dim=64)
+    Settings.llm = FakeLLM(latency=args.latency)
+    index = make_index(args.trials)
+
+    pool = ChatSessionPool(index, engine_factory=engine_factory)
+    blocking_time = asyncio.run(run_blocking(pool, args.users))
+
+    main.app.state.chat_sessions = ChatSessionPool(index, engine_factory=engine_factory)
+    # every user asks the same question, keep the response cache and request coalescing out of the measurement
+    main.app.state.response_cache = None
+    main.app.state.chat_flight = AsyncSingleFlight("get_response", enabled=False)
+
+    async def endpoint():
+        main.app.state.chat_semaphore = asyncio.Semaphore(main.config.chat_max_concurrency)
+        return await run_endpoint(args.users)
+
+    endpoint_time = asyncio.run(endpoint())
+
+    print(f"{args.users} concurrent users, {args.latency}s per LLM call")
+    print(f"blocking chat() in event loop: {blocking_time:.2f}s")
+    print(f"/get_response/ with achat():   {endpoint_time:.2f}s")
+
+
+if __name__ == "__main__":
+    run()
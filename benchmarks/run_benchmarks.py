@@ -0,0 +1,231 @@
+"""
+Offline benchmark suite: no OpenAI, clinicaltrials.gov or AACT calls.
+
+Scenarios:
+- extraction: extract_from_json_batch throughput on recorded (--corpus) or synthetic studies.
+- load_trials: IndexManager.load_trials throughput, with trials served by a local stub of the
+  ClinicalTrials.gov API (stub_ctgov.py) and FakeEmbedding. Needs a Postgres database with pgvector
+  (see the README), rows are written to a scratch table that is dropped at the end.
+- chat: /get_response/ latency percentiles with --users concurrent clients, each sending --requests
+  questions in new sessions, on an in-memory index with FakeLLM and FakeEmbedding. The response
+  cache is disabled; identical questions in flight are coalesced unless SINGLE_FLIGHT_ENABLED=false
+  (--questions sets how many distinct questions are asked).
+
+Results are written as JSON (--output). With --baseline, the results of an earlier run are compared
+with this one, so that regressions show up between commits.
+
+Run from the repo root:
+    python benchmarks/run_benchmarks.py --scenarios extraction,chat --output bench.json
+    python benchmarks/run_benchmarks.py --output new.json --baseline bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("OPENAI_API_KEY", "offline")
+
+from llama_index.core import Settings  # noqa: E402
+
+from config import config  # noqa: E402
+from fake_models import FakeEmbedding, FakeLLM  # noqa: E402
+from stub_ctgov import StubCTGovServer, load_studies  # noqa: E402
+from utils import extract_from_json_batch  # noqa: E402
+
+SCENARIOS = ("extraction", "load_trials", "chat")
+
+# metrics where a higher value is better, the others are latencies
+THROUGHPUT_METRICS = ("studies_per_second", "trials_per_second", "rows_per_second", "requests_per_second")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_summary(latencies):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 2),
+        "p90_ms": round(float(np.percentile(latencies_ms, 90)), 2),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 2),
+        "mean_ms": round(float(latencies_ms.mean()), 2),
+        "max_ms": round(float(latencies_ms.max()), 2),
+    }
+
+
+def bench_extraction(studies, args):
+    studies = list(studies.values())
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        extract_from_json_batch(studies)
+        best = min(best, time.perf_counter() - start)
+    return {
+        "studies": len(studies),
+        "best_seconds": round(best, 4),
+        "studies_per_second": round(len(studies) / best, 1),
+    }
+
+
+def bench_load_trials(studies, args):
+    from engines import get_engine
+    from index_management import IndexManager, IngestionStats
+    from trial_fetcher import TrialFetcher
+
+    nct_ids = list(studies)[:args.load_trials]
+    with StubCTGovServer(studies, latency=args.ctgov_latency) as stub:
+        fetcher = TrialFetcher(base_url=stub.base_url, max_workers=config.fetch_max_workers, rate_limit=0)
+        ingestion_stats = IngestionStats()
+        index_manager = IndexManager(config.connection_str, args.table, args.embed_dim, fetcher=fetcher,
+                                     ingestion_stats=ingestion_stats)
+        Settings.embed_model.calls = 0
+        try:
+            start = time.perf_counter()
+            index_manager.load_trials(nct_ids)
+            elapsed = time.perf_counter() - start
+        finally:
+            fetcher.close()
+            with get_engine(config.connection_str).begin() as conn:
+                conn.exec_driver_sql(f"drop table if exists data_{args.table}")
+        requests = stub.requests
+    rows_written = ingestion_stats.last_load["rows_written"]
+    return {
+        "trials": len(nct_ids),
+        "rows_written": rows_written,
+        "ctgov_requests": requests,
+        "embedding_requests": Settings.embed_model.calls,
+        "seconds": round(elapsed, 3),
+        "trials_per_second": round(len(nct_ids) / elapsed, 1),
+        "rows_per_second": round(rows_written / elapsed, 1),
+    }
+
+
+async def run_chat_clients(app, users, requests_per_user, questions):
+    import httpx
+
+    latencies = []
+
+    async def client_loop(client, user):
+        for i in range(requests_per_user):
+            start = time.perf_counter()
+            response = await client.post("/get_response/", json={
+                "query": f"What are the outcomes of the trials on condition {(user + i) % questions}?",
+                "profile": "",
+                "session_id": f"bench-{user}-{i}",
+            }, timeout=None)
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.text
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, user) for user in range(users)))
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def bench_chat(studies, args):
+    import main
+    from load_test_chat import engine_factory, make_index
+    from session_pool import ChatSessionPool
+    from single_flight import AsyncSingleFlight
+
+    index = make_index(args.chat_trials)
+    n_requests = args.users * args.requests
+    main.app.state.chat_sessions = ChatSessionPool(index, max_sessions=n_requests, engine_factory=engine_factory)
+    main.app.state.response_cache = None
+    main.app.state.chat_flight = AsyncSingleFlight("get_response", max_waiters=config.single_flight_max_waiters,
+                                                   enabled=config.single_flight_enabled)
+    Settings.llm.calls = 0
+
+    async def run():
+        main.app.state.chat_semaphore = asyncio.Semaphore(config.chat_max_concurrency)
+        return await run_chat_clients(main.app, args.users, args.requests, args.questions)
+
+    latencies, elapsed = asyncio.run(run())
+    return {
+        "users": args.users,
+        "requests": n_requests,
+        "llm_calls": Settings.llm.calls,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(n_requests / elapsed, 1),
+        **latency_summary(latencies),
+    }
+
+
+def compare(baseline, results):
+    """
+    Prints each metric next to its baseline value; a change of more than 10% in the bad direction
+    is flagged as a regression.
+    """
+    print(f"compared with {baseline.get('commit') or 'baseline'}:")
+    for scenario, metrics in results["scenarios"].items():
+        old_metrics = baseline.get("scenarios", {}).get(scenario)
+        if not old_metrics:
+            continue
+        for name, value in metrics.items():
+            old = old_metrics.get(name)
+            if not (name in THROUGHPUT_METRICS or name.endswith("_ms")) or not old:
+                continue
+            ratio = value / old
+            regression = ratio < 0.9 if name in THROUGHPUT_METRICS else ratio > 1.1
+            print(f"  {scenario}.{name}: {old} -> {value} ({ratio:.2f}x){'  REGRESSION' if regression else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--corpus", help="directory of recorded study JSON files")
+    parser.add_argument("--studies", type=int, default=1000, help="number of synthetic studies without --corpus")
+    parser.add_argument("--repeat", type=int, default=5, help="extraction runs, the best one is kept")
+    parser.add_argument("--load-trials", type=int, default=200, help="trials loaded by the load_trials scenario")
+    parser.add_argument("--table", default="bench_load_trials")
+    parser.add_argument("--embed-dim", type=int, default=config.embed_dim)
+    parser.add_argument("--ctgov-latency", type=float, default=0.05, help="seconds per stub API response")
+    parser.add_argument("--embed-latency", type=float, default=0.1, help="seconds per embedding request")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds before the first LLM token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between LLM tokens")
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=5, help="requests per user")
+    parser.add_argument("--questions", type=int, default=17, help="distinct questions asked in the chat scenario")
+    parser.add_argument("--chat-trials", type=int, default=50, help="trials in the in-memory chat index")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    Settings.embed_model = FakeEmbedding(embed_dim=args.embed_dim, latency=args.embed_latency)
+    Settings.llm = FakeLLM(latency=args.llm_latency, token_latency=args.token_latency)
+    studies = load_studies(args.corpus, args.studies)
+
+    benchmarks = {"extraction": bench_extraction, "load_trials": bench_load_trials, "chat": bench_chat}
+    results = {"commit": git_commit(), "timestamp": time.time(), "params": vars(args), "scenarios": {}}
+    for name in scenarios:
+        print(f"running {name}...")
+        results["scenarios"][name] = benchmarks[name](studies, args)
+        print("  " + "  ".join(f"{key}={value}" for key, value in results["scenarios"][name].items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Local stand-in for the ClinicalTrials.gov v2 API, serving recorded study JSON.
+
+Only GET /api/v2/studies/<NCT ID> is served, from a dict of NCT ID -> study loaded from a directory
+of recorded study JSON files (one study per file, see bench_extraction.py) or generated synthetic
+studies. Unknown NCT IDs get a 404, like the real API.
+
+Used by run_benchmarks.py; it can also be run on its own to point a server at it:
+    python benchmarks/stub_ctgov.py --corpus path/to/studies --port 8099
+    CTGOV_API_URL=http://127.0.0.1:8099/api/v2 uvicorn main:app ...
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_extraction import load_corpus, synthetic_study
+
+STUDIES_PATH = "/api/v2/studies/"
+
+
+def study_nct_id(study):
+    return study["protocolSection"]["identificationModule"]["nctId"]
+
+
+def load_studies(corpus=None, n_studies=1000, seed=0):
+    """
+    Return: a dict of NCT ID -> study, from the recorded studies in the corpus directory if given,
+    else n_studies synthetic ones.
+    """
+    if corpus:
+        studies = load_corpus(corpus)
+    else:
+        rng = random.Random(seed)
+        studies = [synthetic_study(i, rng) for i in range(n_studies)]
+    return {study_nct_id(study): study for study in studies}
+
+
+class StubCTGovServer:
+    """
+    Serves studies over HTTP on a background thread, each response delayed by latency seconds
+    to mimic the round trip to clinicaltrials.gov. Use as a context manager.
+    """
+
+    def __init__(self, studies, host="127.0.0.1", port=0, latency=0.0):
+        # bodies are encoded once, the server should not be the bottleneck of what it measures
+        bodies = {nct_id: json.dumps(study).encode("utf-8") for nct_id, study in studies.items()}
+        self.requests = 0
+        counter_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with counter_lock:
+                    server.requests += 1
+                if latency:
+                    time.sleep(latency)
+                body = None
+                if self.path.startswith(STUDIES_PATH):
+                    body = bodies.get(self.path[len(STUDIES_PATH):].split("?", 1)[0])
+                if body is None:
+                    body = json.dumps({"message": f"Not found: {self.path}"}).encode("utf-8")
+                    self.send_response(404)
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/api/v2"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="stub-ctgov", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="directory of recorded study JSON files")
+    parser.add_argument("--studies", type=int, default=1000, help="number of synthetic studies without --corpus")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+    args = parser.parse_args()
+
+    studies = load_studies(args.corpus, args.studies)
+    server = StubCTGovServer(studies, host=args.host, port=args.port, latency=args.latency)
+    print(f"serving {len(studies)} studies on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()